@@ -52,7 +52,10 @@ def main():
     # Get a pandas multi-indexed dataframe indexed by datetime and symbol
     stock_data_store = StockDataStore('./data/')
     
-    stock_data = stock_data_store.get_stock_data(symbols, keys)
+    # Only load the study period, plus enough trading days before it for the estimation window
+    # and the volume changes of the first event.
+    lookback = estimation_window + buffer + 5
+    stock_data = stock_data_store.get_stock_data(symbols, keys, start_date, lookback=lookback)
     #print(stock_data.head())
 
 
@@ -60,18 +63,18 @@ def main():
     eem = ExampleEventMatrix(stock_data.index.levels[1], symbols,value_threshold, csv_file_name)
                              
 
-    # Get a dataframe with an index of all trading days, and columns of all symbols.
-    event_matrix = eem.build_event_matrix(start_date, end_date)
+    # Fill the event matrix with the events. The calculators read its sparse events directly.
+    eem.build_event_matrix(start_date, end_date)
     
     #print(event_matrix[event_matrix['S1'] == 1])
 
-    logger.info("Number of events: " + str(len(event_matrix[(event_matrix == 1.0).any(axis=1)])))
+    logger.info("Number of events: " + str(len(eem.event_dates())))
     #logger.info(event_matrix[(event_matrix == 1.0).any(axis=1)])
 
     #import pdb; pdb.set_trace()
 
     calculator = Calculator()
-    ccr = calculator.calculate_cars_cavcs(event_matrix, stock_data[['adjusted_close','volume']], market_symbol,
+    ccr = calculator.calculate_cars_cavcs(eem, stock_data[['adjusted_close','volume']], market_symbol,
                                           estimation_window, buffer, pre_event_window, post_event_window)
                                           
     # print results to file and Plots
@@ -36,15 +36,15 @@ def main():
     eem = ExampleEventMatrix(stock_data.index.levels[1], symbols,
                              value_threshold, csv_file_name)
 
-    # Get a dataframe with an index of all trading days, and columns of all symbols.
-    event_matrix = eem.build_event_matrix(start_date, end_date)
+    # Fill the event matrix with the events. The calculators read its sparse events directly.
+    eem.build_event_matrix(start_date, end_date)
 
-    print("Number of events:" + str(len(event_matrix[(event_matrix == 1.0).any(axis=1)])))
+    print("Number of events:" + str(len(eem.event_dates())))
     # print(event_matrix[(event_matrix == 1.0).any(axis=1)])
 
     calculator = Calculator()
     car, std_err, num_events = calculator.calculate_car_qstk(
-        event_matrix, stock_data['close'], market_symbol, look_back, look_forward)
+        eem, stock_data['close'], market_symbol, look_back, look_forward)
 
     print(std_err)
 
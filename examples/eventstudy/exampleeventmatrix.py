@@ -20,25 +20,11 @@ class ExampleEventMatrix(EventMatrix):
         raw_event_dates = pd.read_csv(self.csv_file_name,
                                       encoding="ISO-8859-1",
                                       usecols=["Date", "Value"],
-                                      parse_dates=['Date'],
-                                      index_col='Date')
+                                      parse_dates=['Date'])
 
-        # Sort by date
-        raw_event_dates = raw_event_dates.sort_index()
-
-        # Select between certain dates.
-        raw_event_dates = raw_event_dates.loc[start_date:end_date]
-        raw_event_dates = raw_event_dates[raw_event_dates['Value'] >= self.value_threshold]
-        raw_event_dates = raw_event_dates.drop(['Value'], axis=1)
-
-        # for each event, put a "1" in the matrix on that day. If the event didn't fall on a trading day,
-        # put the event on the first trading day after.
-        for index, row in raw_event_dates.iterrows():
-            # find the trading day equal to it or after it
-            index_df = self.event_matrix.index.get_loc(index, method="backfill")
-            # print(df.iloc[index_df])
-            for symbol in self.symbols:
-                self.event_matrix.iloc[index_df] = 1
-                # print(event_matrix.iloc[index_event_matrix])
+        # for each event between the dates with a big enough value, put a "1" in the matrix on that day.
+        # If the event didn't fall on a trading day, put the event on the first trading day after.
+        self.add_dated_events(raw_event_dates, value_column='Value', value_threshold=self.value_threshold,
+                              start_date=start_date, end_date=end_date)
 
         return self.event_matrix
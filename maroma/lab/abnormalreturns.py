@@ -0,0 +1,296 @@
+import numpy as np
+
+
+class MarketAdjusted(object):
+    '''
+    The abnormal return is the stock's return less the market's, as if every stock had a slope of 1 and no
+    intercept on the market. Nothing is estimated.
+    '''
+
+    factors = ()
+    estimated = False
+
+    def key(self):
+        '''
+        :return: a tuple telling the model apart from others, for caches
+        '''
+        return ('market_adjusted',)
+
+    def fit(self, x, y):
+        '''
+        :param x: 2-d array (days x regressors) of the market values over the estimation window, followed by
+            those of the model's factors
+        :param y: 2-d array (days x stocks) of the stock values over the estimation window
+        :return: 2-d array (1 + regressors x stocks) with the intercept and then the slopes of every stock
+        '''
+        return _market_adjusted(np.asarray(y).shape[1])
+
+    def fit_windows(self, x, y, starts, stops):
+        '''
+        :param x: 2-d array (days x regressors) of the market values, followed by those of the model's factors
+        :param y: 2-d array (days x stocks) of the stock values
+        :param starts: the position of the first day of each estimation window
+        :param stops: the position one past the last day of each estimation window
+        :return: 3-d array (windows x 1 + regressors x stocks) with the intercept and then the slopes of every
+            stock in each window
+        '''
+        coefficients = _market_adjusted(np.asarray(y).shape[1])
+        return np.repeat(coefficients[np.newaxis], len(starts), axis=0)
+
+
+class MarketModel(object):
+    '''
+    The abnormal return is what a least squares fit of the stock's values on the market's over the estimation
+    window doesn't explain.
+    '''
+
+    factors = ()
+    estimated = True
+
+    def key(self):
+        return ('market_model',)
+
+    def fit(self, x, y):
+        '''
+        See MarketAdjusted.fit
+        '''
+        slopes, intercepts = regress_batch(np.asarray(x)[:, 0], y)
+        return np.vstack((intercepts, slopes))
+
+    def fit_windows(self, x, y, starts, stops):
+        '''
+        See MarketAdjusted.fit_windows
+        '''
+        slopes, intercepts = regress_windows(np.asarray(x)[:, 0], y, starts, stops)
+        return np.stack((intercepts, slopes), axis=1)
+
+
+class FactorModel(object):
+
+    estimated = True
+
+    def __init__(self, factors):
+        '''
+        :param factors: the symbols of the factors. Their series are columns of the stock data like those of
+            the stocks, e.g. the prices of factor portfolios, and their returns are computed the same way.
+
+        The abnormal return is what a least squares fit of the stock's values on the market's and the factors'
+        over the estimation window doesn't explain. All stocks share the regressors, so they are fitted
+        together: one lstsq call for a single window, one batched solve of the normal equations for many.
+        '''
+        self.factors = tuple(factors)
+
+    def key(self):
+        return ('factor_model',) + self.factors
+
+    def fit(self, x, y):
+        '''
+        See MarketAdjusted.fit
+        '''
+        return regress_factors(x, y)
+
+    def fit_windows(self, x, y, starts, stops):
+        '''
+        See MarketAdjusted.fit_windows
+        '''
+        return regress_factor_windows(x, y, starts, stops)
+
+
+def _market_adjusted(num_stocks):
+    return np.vstack((np.zeros(num_stocks), np.ones(num_stocks)))
+
+
+def regress_batch(x, y):
+    '''
+    :param x: 1-d array of the regressor, e.g. the market returns over the estimation window
+    :param y: 2-d array (days x stocks) of the values to regress on x
+    :return slopes: 1-d array with the slope of every column of y
+    :return intercepts: 1-d array with the intercept of every column of y
+
+    The least squares fits are computed in closed form, so all stocks are estimated with a couple of
+    array operations instead of one lstsq call per stock. The sums run down each column on its own, so the
+    fit of a stock is the same to the last bit whichever other stocks it is fitted with.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    x_mean = x.mean()
+    x_dev = x - x_mean
+    y_mean = y.mean(axis=0)
+
+    slopes = (x_dev[:, np.newaxis] * (y - y_mean)).sum(axis=0) / x_dev.dot(x_dev)
+    intercepts = y_mean - slopes * x_mean
+
+    return slopes, intercepts
+
+
+def regress_windows(x, y, starts, stops):
+    '''
+    :param x: 1-d array (days) of the regressor, e.g. the market returns
+    :param y: 2-d array (days x stocks) of the values to regress on x
+    :param starts: the position of the first day of each estimation window
+    :param stops: the position one past the last day of each estimation window
+    :return slopes: 2-d array (windows x stocks) of slopes
+    :return intercepts: 2-d array (windows x stocks) of intercepts
+
+    The sums of x, y, x^2 and xy over each window are read off cumulative sums, so every fit costs the
+    same no matter how long the window is.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+
+    # Centre the series first. The fits don't change, but the sums stay small, which keeps the
+    # differences of the cumulative sums accurate.
+    x_shift = x.mean()
+    y_shift = y.mean(axis=0)
+    x = x - x_shift
+    y = y - y_shift
+
+    zero_row = np.zeros((1, y.shape[1]))
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_xx = np.concatenate(([0.0], np.cumsum(x * x)))
+    cum_y = np.concatenate((zero_row, np.cumsum(y, axis=0)))
+    cum_xy = np.concatenate((zero_row, np.cumsum(x[:, np.newaxis] * y, axis=0)))
+
+    n = (stops - starts)[:, np.newaxis]
+    sum_x = (cum_x[stops] - cum_x[starts])[:, np.newaxis]
+    sum_xx = (cum_xx[stops] - cum_xx[starts])[:, np.newaxis]
+    sum_y = cum_y[stops] - cum_y[starts]
+    sum_xy = cum_xy[stops] - cum_xy[starts]
+
+    slopes = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+    intercepts = (sum_y - slopes * sum_x) / n
+
+    # Undo the centring
+    intercepts = intercepts + y_shift - slopes * x_shift
+
+    return slopes, intercepts
+
+
+def regress_factors(x, y):
+    '''
+    :param x: 2-d array (days x regressors) of the regressors over the estimation window
+    :param y: 2-d array (days x stocks) of the values to regress on them
+    :return: 2-d array (1 + regressors x stocks) with the intercept and then the slopes of every column of y
+
+    The normal equations of the deviations from the means are solved. Their matrix is the same for every stock,
+    so it is inverted once, and as in regress_batch the sums run down each column on its own.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    x_mean = x.mean(axis=0)
+    x_dev = x - x_mean
+    y_mean = y.mean(axis=0)
+
+    xty = (x_dev[:, :, np.newaxis] * (y - y_mean)[:, np.newaxis, :]).sum(axis=0)
+    slopes = _multiply(np.linalg.inv(x_dev.T.dot(x_dev)), xty)
+    intercepts = y_mean - _multiply(x_mean[np.newaxis], slopes)[0]
+
+    return np.vstack((intercepts, slopes))
+
+
+def regress_factor_windows(x, y, starts, stops):
+    '''
+    :param x: 2-d array (days x regressors) of the regressors
+    :param y: 2-d array (days x stocks) of the values to regress on them
+    :param starts: the position of the first day of each estimation window
+    :param stops: the position one past the last day of each estimation window
+    :return: 3-d array (windows x 1 + regressors x stocks) with the intercept and then the slopes of every
+        column of y in each window
+
+    As in regress_windows the sums of the normal equations are read off cumulative sums. The matrices of all
+    windows are inverted in one batched call.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+
+    x_shift = x.mean(axis=0)
+    y_shift = y.mean(axis=0)
+
+    # the columns of the design are a constant and the centred regressors
+    design = np.column_stack((np.ones(len(x)), x - x_shift))
+    k = design.shape[1]
+
+    cum_dd = np.concatenate((np.zeros((1, k, k)), np.cumsum(design[:, :, np.newaxis] * design[:, np.newaxis, :],
+                                                            axis=0)))
+    cum_dy = np.concatenate((np.zeros((1, k, y.shape[1])),
+                             np.cumsum(design[:, :, np.newaxis] * (y - y_shift)[:, np.newaxis, :], axis=0)))
+
+    coefficients = _multiply(np.linalg.inv(cum_dd[stops] - cum_dd[starts]), cum_dy[stops] - cum_dy[starts])
+
+    # Undo the centring
+    coefficients[:, 0] += y_shift - _multiply(x_shift[np.newaxis], coefficients[:, 1:])[:, 0]
+
+    return coefficients
+
+
+def residual_variances(x, y, starts, stops, coefficients):
+    '''
+    :param x: 2-d array (days x regressors) of the regressors
+    :param y: 2-d array (days x stocks) of the values regressed on them
+    :param starts: the position of the first day of each estimation window
+    :param stops: the position one past the last day of each estimation window
+    :param coefficients: 3-d array (windows x 1 + regressors x stocks) with the intercept and then the slopes
+        fitted in each window, e.g. from regress_factor_windows
+    :return: 2-d array (windows x stocks) of the variance of the residuals of each fit over its own window,
+        with (window length - 1 - regressors) degrees of freedom
+
+    The sum of the squared residuals of coefficients b is y'y - 2 b'D'y + b'D'D b, where D is the design of a
+    constant and the regressors. The sums y'y, D'y and D'D of each window are read off cumulative sums as in
+    regress_factor_windows, so every window costs the same no matter how long it is.
+    '''
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+
+    # Centre the series first, as in the fits, and carry the intercepts over to the centred series
+    x_shift = x.mean(axis=0)
+    y_shift = y.mean(axis=0)
+    coefficients = np.array(coefficients, dtype=float)
+    coefficients[:, 0] += _multiply(x_shift[np.newaxis], coefficients[:, 1:])[:, 0] - y_shift
+
+    design = np.column_stack((np.ones(len(x)), x - x_shift))
+    y = y - y_shift
+    k = design.shape[1]
+
+    cum_dd = np.concatenate((np.zeros((1, k, k)), np.cumsum(design[:, :, np.newaxis] * design[:, np.newaxis, :],
+                                                            axis=0)))
+    cum_dy = np.concatenate((np.zeros((1, k, y.shape[1])),
+                             np.cumsum(design[:, :, np.newaxis] * y[:, np.newaxis, :], axis=0)))
+    cum_yy = np.concatenate((np.zeros((1, y.shape[1])), np.cumsum(y * y, axis=0)))
+
+    sum_dy = cum_dy[stops] - cum_dy[starts]
+    fitted_dd = _multiply(cum_dd[stops] - cum_dd[starts], coefficients)
+
+    squares = cum_yy[stops] - cum_yy[starts]
+    for j in range(k):
+        squares = squares - coefficients[:, j] * (2 * sum_dy[:, j] - fitted_dd[:, j])
+
+    dof = (stops - starts - k)[:, np.newaxis]
+
+    return np.maximum(squares, 0) / dof
+
+
+def _multiply(a, b):
+    '''
+    :param a: array (... x n x k)
+    :param b: array (... x k x stocks)
+    :return: the matrix product (... x n x stocks), summed term by term so every stock's column is computed
+        the same whichever other stocks are in b
+    '''
+
+    product = a[..., :, 0, np.newaxis] * b[..., np.newaxis, 0, :]
+    for j in range(1, a.shape[-1]):
+        product = product + a[..., :, j, np.newaxis] * b[..., np.newaxis, j, :]
+    return product
@@ -0,0 +1,156 @@
+import io
+import os
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+def save_arrays(file_name, arrays):
+    '''
+    :param file_name: the .npz file to write
+    :param arrays: a dict mapping names to arrays
+
+    The arrays are stored without compression, so load_arrays can memory-map them from the file. The file is
+    written to a temporary file of its own next to file_name first and then moved over it, so a reader never
+    sees half of a file, even when several processes save the same file at once.
+    '''
+
+    _write_replacing(file_name, '.tmp.npz', lambda f: np.savez(f, **arrays))
+
+
+def load_arrays(file_name, mmap_mode='r'):
+    '''
+    :param file_name: a .npz file, e.g. written by save_arrays
+    :param mmap_mode: 'r', 'r+' or 'c' to memory-map the arrays in place in the zip file, None to read them
+    :return: a dict mapping names to arrays
+
+    np.load can't memory-map the members of a .npz. An uncompressed member is a plain .npy file at some
+    offset in the zip though, so it is mapped with np.memmap at that offset. Compressed members, 0-d arrays
+    and arrays of python objects are read into memory.
+    '''
+
+    arrays = {}
+    with open(file_name, 'rb') as f, zipfile.ZipFile(f) as npz:
+        for info in npz.infolist():
+            if not info.filename.endswith('.npy'):
+                continue
+            name = info.filename[:-len('.npy')]
+
+            if mmap_mode is not None and info.compress_type == zipfile.ZIP_STORED:
+                array = _map_member(file_name, f, info, mmap_mode)
+                if array is not None:
+                    arrays[name] = array
+                    continue
+
+            with npz.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+
+    return arrays
+
+
+def _map_member(file_name, f, info, mmap_mode):
+    '''
+    :return: the member memory-mapped, or None when it can't be
+    '''
+
+    # the local header is 30 bytes, then the name and an extra field of its own length
+    f.seek(info.header_offset)
+    local_header = f.read(30)
+    if local_header[:4] != b'PK\x03\x04':
+        raise ValueError('load_arrays: bad zip member ' + info.filename + ' in ' + file_name)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+
+    f.seek(info.header_offset + 30 + name_length + extra_length)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    else:
+        return None
+
+    if dtype.hasobject or len(shape) == 0 or 0 in shape:
+        return None
+
+    return np.memmap(file_name, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def append_rows(file_name, rows):
+    '''
+    :param file_name: a .npy file of an array in C order, e.g. written by np.save
+    :param rows: an array shaped like the rows of the file's array, i.e. with the same trailing dimensions
+    :return: the number of rows the file's array has now
+
+    The rows are written after the data that is there and then the shape in the header is updated, so the
+    rows already in the file are never rewritten, and arrays other processes have mapped stay valid. np.save
+    pads the header with spaces, so the longer shape nearly always fits; when it doesn't the file is written
+    again whole. Until the header is updated readers see the array as it was.
+    '''
+
+    with open(file_name, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            raise ValueError('append_rows: unsupported .npy version of ' + file_name)
+        data_offset = f.tell()
+
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if fortran_order or dtype.hasobject or len(shape) == 0 or rows.shape[1:] != shape[1:]:
+            raise ValueError('append_rows: the rows do not fit the array of ' + file_name)
+
+        new_shape = (shape[0] + len(rows),) + shape[1:]
+        header = _npy_header(version, new_shape, dtype)
+
+        if len(header) == data_offset:
+            f.seek(data_offset + dtype.itemsize * int(np.prod(shape)))
+            f.write(rows.tobytes())
+            f.truncate()
+            f.flush()
+            f.seek(0)
+            f.write(header)
+            return new_shape[0]
+
+    values = np.concatenate((np.load(file_name), rows))
+    _write_replacing(file_name, '.tmp.npy', lambda f: np.save(f, values))
+    return new_shape[0]
+
+
+def _write_replacing(file_name, suffix, write):
+    '''
+    :param file_name: the file to replace
+    :param suffix: the suffix of the temporary file, which readers of the directory skip
+    :param write: a function writing the content to an open binary file
+
+    The content is written to a uniquely named file in the directory of file_name, which is then moved over
+    file_name in one step. The temporary file is removed when anything fails.
+    '''
+
+    directory, name = os.path.split(file_name)
+    fd, tmp_file = tempfile.mkstemp(suffix=suffix, prefix=name + '.', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_file, file_name)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _npy_header(version, shape, dtype):
+    '''
+    :return: the bytes of the magic string and header of a .npy file, padded the way np.save pads them
+    '''
+
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}
+    buffer = io.BytesIO()
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(buffer, header)
+    else:
+        np.lib.format.write_array_header_2_0(buffer, header)
+    return buffer.getvalue()
@@ -0,0 +1,219 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from maroma.lab.benchmark.synthetic import generate_stock_data
+from maroma.lab.calculator import StudyData, cars_cavcs_statistics, excess_windows, fit_market_models
+from maroma.lab.eventmatrix import EventMatrix
+from maroma.lab.stockdatastore import StockDataStore
+from maroma.lab.stockpanel import StockPanel
+
+
+STAGES = ['load', 'panel', 'event_matrix', 'symbol_event_matrix', 'returns', 'estimation', 'windowing',
+          'statistics']
+
+
+def run_benchmark(work_dir, symbol_counts, year_counts, repeat=3, seed=0, workers=None, cache=False,
+                  estimation_window=200, buffer=5, pre_event_window=10, post_event_window=10, log=None):
+    '''
+    :param work_dir: the directory the synthetic data (and the cache) are kept in. Data sets that are
+        already there are reused.
+    :param symbol_counts: the numbers of stocks to run with
+    :param year_counts: the numbers of years to run with
+    :param repeat: the number of times each stage is run. The fastest time is kept.
+    :param seed: the seed of the synthetic data
+    :param workers: passed to StockDataStore
+    :param cache: if True StockDataStore uses a binary cache, which is filled before the load is timed
+    :param estimation_window: the estimation window. Histories of less than twice that use half of their days.
+    :param log: optional function taking a line of progress
+    :return: a dict with the environment and, for every scale, the seconds each stage took
+
+    Stages:
+    load: StockDataStore.get_stock_data of adjusted_close and volume
+    panel: StockPanel.from_frame
+    event_matrix: EventMatrix.add_dated_events of the market wide events
+    symbol_event_matrix: EventMatrix.add_dated_events of the events of single stocks
+    returns: the daily returns and volume changes of StudyData
+    estimation: fit_market_models
+    windowing: excess_windows
+    statistics: cars_cavcs_statistics
+    '''
+
+    runs = []
+    for years in year_counts:
+        for num_symbols in symbol_counts:
+            data_dir = os.path.join(work_dir, str(num_symbols) + 'x' + str(years))
+            symbols = generate_stock_data(data_dir, num_symbols, years, seed)
+            if log is not None:
+                log('benchmarking ' + str(num_symbols) + ' symbols over ' + str(years) + ' years')
+
+            times = dict((stage, []) for stage in STAGES)
+            for _ in range(repeat):
+                for stage, seconds in _time_stages(data_dir, symbols, workers, cache, estimation_window, buffer,
+                                                   pre_event_window, post_event_window):
+                    times[stage].append(seconds)
+
+            runs.append({'num_symbols': num_symbols, 'years': years,
+                         'stages': dict((stage, min(seconds)) for stage, seconds in times.items())})
+
+    return {'commit': _git_commit(), 'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'repeat': repeat, 'seed': seed,
+            'workers': workers, 'cache': cache, 'runs': runs}
+
+
+def compare(results, baseline, threshold=1.1):
+    '''
+    :param results: a dict returned by run_benchmark
+    :param baseline: a dict returned by run_benchmark, e.g. on an earlier commit
+    :param threshold: the ratio of the times above which a stage counts as slower
+    :return: a list of (num_symbols, years, stage, baseline seconds, seconds) of the stages that got slower
+    '''
+
+    before = dict(((run['num_symbols'], run['years']), run['stages']) for run in baseline['runs'])
+
+    slower = []
+    for run in results['runs']:
+        stages = before.get((run['num_symbols'], run['years']), {})
+        for stage, seconds in sorted(run['stages'].items()):
+            if stage in stages and seconds > threshold * stages[stage]:
+                slower.append((run['num_symbols'], run['years'], stage, stages[stage], seconds))
+
+    return slower
+
+
+def _time_stages(data_dir, symbols, workers, cache, estimation_window, buffer, pre_event_window,
+                 post_event_window):
+    '''
+    Run the stages of an event study once.
+    :return: a list of (stage, seconds)
+    '''
+
+    market_symbol = symbols[0]
+    data_dir = os.path.join(data_dir, '')
+    cache_dir = os.path.join(data_dir, 'cache') if cache else None
+    store = StockDataStore(data_dir, cache_dir, workers)
+    if cache:
+        store.get_stock_data(symbols, ['adjusted_close', 'volume'])
+
+    times = []
+    clock = _Clock(times)
+
+    stock_data = store.get_stock_data(symbols, ['adjusted_close', 'volume'])
+    clock.stop('load')
+
+    panel = StockPanel.from_frame(stock_data, market_symbol)
+    clock.stop('panel')
+
+    # Leave room for the estimation window and the volume changes before the first event. Short histories
+    # use a shorter estimation window, so that they still have events.
+    estimation_window = min(estimation_window, len(panel.dates) // 2)
+    start_date = panel.dates[min(estimation_window + buffer + pre_event_window + 10, len(panel.dates) - 1)]
+    end_date = panel.dates[max(len(panel.dates) - post_event_window - 1, 0)]
+
+    raw_events = pd.read_csv(data_dir + 'eventdates.csv', parse_dates=['Date'])
+    raw_symbol_events = pd.read_csv(data_dir + 'symbolevents.csv', parse_dates=['Date'])
+    clock.restart()
+
+    event_matrix = EventMatrix(panel.dates, panel.symbols)
+    event_matrix.add_dated_events(raw_events, value_column='Value', value_threshold=5,
+                                  start_date=start_date, end_date=end_date)
+    clock.stop('event_matrix')
+
+    symbol_event_matrix = EventMatrix(panel.dates, panel.symbols)
+    symbol_event_matrix.add_dated_events(raw_symbol_events, symbol_column='Symbol')
+    clock.stop('symbol_event_matrix')
+
+    study = StudyData(panel, market_symbol)
+    clock.stop('returns')
+
+    positions = study.event_positions(event_matrix.event_dates(), pre_event_window, post_event_window)
+    fits = fit_market_models(study, positions, estimation_window, buffer)
+    clock.stop('estimation')
+
+    ccarray, cvarray = excess_windows(study, positions, fits, pre_event_window, post_event_window)
+    clock.stop('windowing')
+
+    cars_cavcs_statistics(study.stocks, ccarray, cvarray, pre_event_window + post_event_window + 1,
+                          fits.cars_regressions, fits.cavcs_regressions)
+    clock.stop('statistics')
+
+    return times
+
+
+class _Clock(object):
+
+    def __init__(self, times):
+        self.__times = times
+        self.__start = time.perf_counter()
+
+    def restart(self):
+        self.__start = time.perf_counter()
+
+    def stop(self, stage):
+        '''
+        Record the time since the last stop or restart as the time of a stage.
+        '''
+        now = time.perf_counter()
+        self.__times.append((stage, now - self.__start))
+        self.__start = now
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the stages of an event study on synthetic stock data.')
+    parser.add_argument('--symbols', type=int, nargs='+', default=[10, 100, 1000, 5000],
+                        help='the numbers of stocks to run with')
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 5, 30], help='the numbers of years to run with')
+    parser.add_argument('--work-dir', default='benchmark_data', help='where the synthetic data is kept')
+    parser.add_argument('--output', default='benchmark.json', help='the json file to write the results to')
+    parser.add_argument('--baseline', help='a json file of earlier results to compare to')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='the ratio of the times above which a stage counts as slower than the baseline')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--cache', action='store_true', help='load through the binary cache of StockDataStore')
+    args = parser.parse_args(argv)
+
+    def log(line):
+        sys.stderr.write(line + '\n')
+
+    results = run_benchmark(args.work_dir, args.symbols, args.years, args.repeat, args.seed, args.workers,
+                            args.cache, log=log)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for run in results['runs']:
+        log(str(run['num_symbols']) + ' symbols, ' + str(run['years']) + ' years: ' +
+            ', '.join(stage + ' ' + '%.4f' % run['stages'][stage] for stage in STAGES))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        for num_symbols, years, stage, before, after in slower:
+            log('slower: ' + str(num_symbols) + ' symbols, ' + str(years) + ' years, ' + stage + ': ' +
+                '%.4f' % before + 's -> ' + '%.4f' % after + 's')
+        return 1 if slower else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+
+CSV_COLUMNS = ['open', 'high', 'low', 'close', 'adjusted_close', 'volume', 'dividend_amount', 'split_coefficient']
+
+TRADING_DAYS_PER_YEAR = 252
+
+
+def generate_stock_data(data_dir, num_symbols, years, seed=0, market_symbol='MKT', events_per_year=12,
+                        symbol_events_per_year=4, end_date='2018-12-31', chunk_size=250):
+    '''
+    :param data_dir: the directory to write the files to
+    :param num_symbols: the number of stocks, not counting the market
+    :param years: the number of years of trading days
+    :param seed: the seed of everything that is drawn. The same arguments always give the same files.
+    :param market_symbol:
+    :param events_per_year: the number of market wide events per year, written to eventdates.csv
+    :param symbol_events_per_year: the number of events per stock and year, written to symbolevents.csv
+    :param end_date: the last trading day
+    :param chunk_size: the number of stocks generated at once, which bounds the memory used
+    :return: the symbols written, the market symbol first
+
+    Writes daily_adjusted_<SYMBOL>.csv files in the format StockDataStore reads, plus:
+    eventdates.csv: Date,Value of the market wide events, like examples/eventstudy/data/eventdates.csv
+    symbolevents.csv: Date,Symbol,Value of the events of single stocks
+    synthetic.json: the arguments. When it matches, the files are already there and nothing is written.
+
+    Returns come from a factor model: the market, one of a few sectors and noise of the stock's own.
+    Log volumes are persistent around a level of the stock's own and rise with the size of the day's
+    move. On market wide events every stock gets an abnormal return and abnormal volumes, so event
+    studies of the data find something.
+    '''
+
+    symbols = [market_symbol] + ['S' + str(i) for i in range(num_symbols)]
+    params = {'num_symbols': num_symbols, 'years': years, 'seed': seed, 'market_symbol': market_symbol,
+              'events_per_year': events_per_year, 'symbol_events_per_year': symbol_events_per_year,
+              'end_date': str(end_date)}
+
+    meta_file = os.path.join(data_dir, 'synthetic.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f) == params:
+                return symbols
+        os.remove(meta_file)
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    num_days = int(round(years * TRADING_DAYS_PER_YEAR))
+    dates = pd.bdate_range(end=end_date, periods=num_days)
+
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=2 + (num_symbols + chunk_size - 1) // chunk_size)
+    rs = np.random.RandomState(seeds[0])
+
+    num_sectors = 10
+    market_returns = rs.normal(0.0003, 0.01, num_days)
+    sector_returns = rs.normal(0, 0.006, (num_days, num_sectors))
+
+    num_events = max(int(round(events_per_year * num_days / float(TRADING_DAYS_PER_YEAR))), 1)
+    event_days = np.sort(rs.choice(num_days, min(num_events, num_days), replace=False))
+    event_values = rs.randint(1, 30, len(event_days))
+
+    pd.DataFrame({'Date': dates[event_days].strftime('%Y-%m-%d'), 'Value': event_values},
+                 columns=['Date', 'Value']).to_csv(os.path.join(data_dir, 'eventdates.csv'), index=False)
+
+    gaps, volumes = _volumes(rs, market_returns[:, np.newaxis], np.array([0.01]), event_days, 0.2)
+    _write_symbol(data_dir, market_symbol, dates, market_returns, gaps[:, 0], volumes[:, 0])
+
+    symbol_events = []
+    for k, first in enumerate(range(0, num_symbols, chunk_size)):
+        rs = np.random.RandomState(seeds[2 + k])
+        chunk = symbols[1 + first:1 + min(first + chunk_size, num_symbols)]
+        n = len(chunk)
+
+        betas = rs.normal(1.0, 0.3, n)
+        sectors = rs.randint(0, num_sectors, n)
+        noise = rs.uniform(0.01, 0.03, n)
+
+        returns = (betas * market_returns[:, np.newaxis] + sector_returns[:, sectors] +
+                   rs.normal(0, 1, (num_days, n)) * noise)
+        returns[event_days] += rs.normal(0.005, 0.01, (len(event_days), n))
+
+        gaps, volumes = _volumes(rs, returns, noise, event_days, 0.5)
+
+        for i, symbol in enumerate(chunk):
+            _write_symbol(data_dir, symbol, dates, returns[:, i], gaps[:, i], volumes[:, i])
+
+        num_symbol_events = max(int(round(symbol_events_per_year * num_days / float(TRADING_DAYS_PER_YEAR))), 1)
+        for symbol in chunk:
+            days = rs.randint(0, num_days, num_symbol_events)
+            symbol_events.append(pd.DataFrame({'Date': dates[days].strftime('%Y-%m-%d'), 'Symbol': symbol,
+                                               'Value': rs.randint(1, 30, num_symbol_events)},
+                                              columns=['Date', 'Symbol', 'Value']))
+
+    rs = np.random.RandomState(seeds[1])
+    if symbol_events:
+        symbol_events = pd.concat(symbol_events)
+        symbol_events = symbol_events.iloc[rs.permutation(len(symbol_events))]
+    else:
+        symbol_events = pd.DataFrame(columns=['Date', 'Symbol', 'Value'])
+    symbol_events.to_csv(os.path.join(data_dir, 'symbolevents.csv'), index=False)
+
+    with open(meta_file, 'w') as f:
+        json.dump(params, f)
+
+    return symbols
+
+
+def _volumes(rs, returns, noise, event_days, event_boost):
+    '''
+    :return gaps: the (days x stocks) relative moves that set the open, high and low around the closes
+    :return volumes: the (days x stocks) traded volumes
+    '''
+
+    num_days, n = returns.shape
+
+    levels = np.log(rs.uniform(1e5, 1e7, n))
+    shocks = lfilter([1.0], [1.0, -0.7], rs.normal(0, 0.3, (num_days, n)), axis=0)
+    log_volumes = levels + shocks + 8.0 * np.abs(returns) / (1.0 + noise / 0.01)
+    log_volumes[event_days] += event_boost
+    if num_days > 1:
+        log_volumes[np.minimum(event_days + 1, num_days - 1)] += event_boost / 2
+
+    return rs.normal(0, 0.003, (num_days, n)), np.round(np.exp(log_volumes))
+
+
+def _write_symbol(data_dir, symbol, dates, returns, gaps, volumes):
+    '''
+    Write the csv of one symbol, newest day first like the files of the data vendor.
+    '''
+
+    close = 50.0 * np.cumprod(1.0 + returns)
+    open_ = np.concatenate(([close[0]], close[:-1])) * (1.0 + gaps)
+    high = np.maximum(open_, close) * (1.0 + np.abs(gaps))
+    low = np.minimum(open_, close) * (1.0 - np.abs(gaps))
+
+    stock_df = pd.DataFrame({'open': open_, 'high': high, 'low': low, 'close': close, 'adjusted_close': close,
+                             'volume': volumes.astype(np.int64), 'dividend_amount': 0.0, 'split_coefficient': 1.0},
+                            index=pd.Index(dates.strftime('%Y-%m-%d'), name='timestamp'), columns=CSV_COLUMNS)
+
+    stock_df.iloc[::-1].to_csv(os.path.join(data_dir, 'daily_adjusted_' + symbol + '.csv'), float_format='%.4f')
@@ -1,13 +1,50 @@
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
 from scipy import stats
 
+from maroma.lab.abnormalreturns import MarketAdjusted, MarketModel, regress_batch, regress_windows, residual_variances
+from maroma.lab.arrayfile import load_arrays, save_arrays
+from maroma.lab.derivedseries import as_derived_series
+from maroma.lab.eventmatrix import EventMatrix
+from maroma.lab.instrumentation import StageRecord, as_instrumentation
+from maroma.lab.resultcache import data_fingerprint, fingerprint
+from maroma.lab.stockpanel import StockPanel
+
 
 class CarsCavcsResult(object):
+
+    __slots__ = ('num_events',
+                 'cars', 'cars_std_err', 'cars_t_test', 'cars_significant', 'cars_positive',
+                 'cars_num_stocks_positive', 'cars_num_stocks_negative',
+                 'cavcs', 'cavcs_std_err', 'cavcs_t_test', 'cavcs_significant', 'cavcs_positive',
+                 'cavcs_num_stocks_positive', 'cavcs_num_stocks_negative',
+                 'cars_regressions', 'cavcs_regressions', 'stages',
+                 'stocks', 'event_dates', 'abnormal_returns', 'abnormal_volume_changes',
+                 'stock_cars_t_tests', 'stock_cars_significant', 'stock_cars_positive',
+                 'stock_cavcs_t_tests', 'stock_cavcs_significant', 'stock_cavcs_positive',
+                 'cars_num_stocks_significant', 'cavcs_num_stocks_significant',
+                 'stock_cars_p_values', 'stock_cavcs_p_values',
+                 'cars_patell_z', 'cars_patell_p_value', 'cars_bmp_t', 'cars_bmp_p_value',
+                 'cavcs_patell_z', 'cavcs_patell_p_value', 'cavcs_bmp_t', 'cavcs_bmp_p_value')
+
     def __init__(self, num_events,
                   cars, cars_std_err, cars_t_test, cars_significant, cars_positive, cars_num_stocks_positive,
                   cars_num_stocks_negative,
                   cavcs, cavcs_std_err, cavcs_t_test, cavcs_significant, cavcs_positive, cavcs_num_stocks_positive,
-                  cavcs_num_stocks_negative):
+                  cavcs_num_stocks_negative, cars_regressions=None, cavcs_regressions=None, stages=None,
+                  stocks=None, event_dates=None, abnormal_returns=None, abnormal_volume_changes=None,
+                  stock_cars_t_tests=None, stock_cars_significant=None, stock_cars_positive=None,
+                  stock_cavcs_t_tests=None, stock_cavcs_significant=None, stock_cavcs_positive=None,
+                  cars_num_stocks_significant=None, cavcs_num_stocks_significant=None,
+                  stock_cars_p_values=None, stock_cavcs_p_values=None,
+                  cars_patell_z=None, cars_patell_p_value=None, cars_bmp_t=None, cars_bmp_p_value=None,
+                  cavcs_patell_z=None, cavcs_patell_p_value=None, cavcs_bmp_t=None, cavcs_bmp_p_value=None):
         '''
         :param num_events: the number of events in the matrix
         :param cars: time series of Cumulative Abnormal Return
@@ -24,8 +61,39 @@ class CarsCavcsResult(object):
         :param cavcs_positive: True if the CAVC is  positive
         :param cavcs_num_stocks_positive: The number of stocks for which the CAVC was significantly positive
         :param cavcs_num_stocks_negative: The number of stocks for which the CAVC was significantly negative
+        :param cars_regressions: RegressionDiagnostics of the market model fitted to the returns
+        :param cavcs_regressions: RegressionDiagnostics of the market model fitted to the volume changes
+        :param stages: the StageRecords of the run, see maroma.lab.instrumentation
+
+        The detail of each stock and event, all optional:
+        :param stocks: the stocks, one per row of the arrays below
+        :param event_dates: the date of each event
+        :param abnormal_returns: 3-d array (stocks x events x window) of the abnormal returns around each event
+        :param abnormal_volume_changes: 3-d array (stocks x events x window) of the abnormal volume changes
+        :param stock_cars_t_tests: the t-test statistic of the CARs of each stock
+        :param stock_cars_significant: True for the stocks whose CARs are significant
+        :param stock_cars_positive: True for the stocks whose CAR is positive
+        :param stock_cavcs_t_tests: the t-test statistic of the CAVCs of each stock
+        :param stock_cavcs_significant: True for the stocks whose CAVCs are significant
+        :param stock_cavcs_positive: True for the stocks whose CAVC is positive
+        :param cars_num_stocks_significant: The number of stocks for which the CAR was significant
+        :param cavcs_num_stocks_significant: The number of stocks for which the CAVC was significant
+        :param stock_cars_p_values: the p-value of the t-test of the CARs of each stock
+        :param stock_cavcs_p_values: the p-value of the t-test of the CAVCs of each stock
+
+        The standardized tests of all stocks and events, see standardized_tests, also optional:
+        :param cars_patell_z: the Patell test statistic of the abnormal returns
+        :param cars_patell_p_value: its two sided p-value
+        :param cars_bmp_t: the BMP test statistic of the abnormal returns
+        :param cars_bmp_p_value: its two sided p-value
+        :param cavcs_patell_z: the Patell test statistic of the abnormal volume changes
+        :param cavcs_patell_p_value: its two sided p-value
+        :param cavcs_bmp_t: the BMP test statistic of the abnormal volume changes
+        :param cavcs_bmp_p_value: its two sided p-value
 
         All of the above t-tests are significant when they are in the 95% confidence levels
+
+        Results can be written to one file with save and read back with load, which memory-maps the arrays.
         '''
         self.num_events = num_events
         self.cars = cars
@@ -42,20 +110,230 @@ class CarsCavcsResult(object):
         self.cavcs_positive = cavcs_positive
         self.cavcs_num_stocks_positive = cavcs_num_stocks_positive
         self.cavcs_num_stocks_negative = cavcs_num_stocks_negative
+        self.cars_regressions = cars_regressions
+        self.cavcs_regressions = cavcs_regressions
+        self.stages = list(stages or [])
+        self.stocks = None if stocks is None else list(stocks)
+        self.event_dates = event_dates
+        self.abnormal_returns = abnormal_returns
+        self.abnormal_volume_changes = abnormal_volume_changes
+        self.stock_cars_t_tests = stock_cars_t_tests
+        self.stock_cars_significant = stock_cars_significant
+        self.stock_cars_positive = stock_cars_positive
+        self.stock_cavcs_t_tests = stock_cavcs_t_tests
+        self.stock_cavcs_significant = stock_cavcs_significant
+        self.stock_cavcs_positive = stock_cavcs_positive
+        self.cars_num_stocks_significant = cars_num_stocks_significant
+        self.cavcs_num_stocks_significant = cavcs_num_stocks_significant
+        self.stock_cars_p_values = stock_cars_p_values
+        self.stock_cavcs_p_values = stock_cavcs_p_values
+        self.cars_patell_z = cars_patell_z
+        self.cars_patell_p_value = cars_patell_p_value
+        self.cars_bmp_t = cars_bmp_t
+        self.cars_bmp_p_value = cars_bmp_p_value
+        self.cavcs_patell_z = cavcs_patell_z
+        self.cavcs_patell_p_value = cavcs_patell_p_value
+        self.cavcs_bmp_t = cavcs_bmp_t
+        self.cavcs_bmp_p_value = cavcs_bmp_p_value
+
+    def stock_results(self):
+        '''
+        :return: a dataframe indexed by (stock, 'cars' or 'cavs') with the positive, significant, t_test and
+            p_value of each stock. The p_value is nan when the result has none.
+        '''
+
+        if self.stocks is None:
+            raise ValueError('CarsCavcsResult: the result has no per stock detail')
+
+        index = pd.MultiIndex.from_product([self.stocks, ['cars', 'cavs']], names=['first', 'second'])
+
+        p_values = np.full((len(self.stocks), 2), np.nan)
+        if self.stock_cars_p_values is not None:
+            p_values[:, 0] = self.stock_cars_p_values
+        if self.stock_cavcs_p_values is not None:
+            p_values[:, 1] = self.stock_cavcs_p_values
+
+        return pd.DataFrame({'positive': np.column_stack((self.stock_cars_positive,
+                                                          self.stock_cavcs_positive)).ravel(),
+                             'significant': np.column_stack((self.stock_cars_significant,
+                                                             self.stock_cavcs_significant)).ravel(),
+                             't_test': np.column_stack((self.stock_cars_t_tests,
+                                                        self.stock_cavcs_t_tests)).ravel(),
+                             'p_value': p_values.ravel()},
+                            index=index, columns=['positive', 'significant', 't_test', 'p_value'])
+
+    def save(self, file_name):
+        '''
+        :param file_name: the .npz file to write the result to
+
+        The arrays are stored uncompressed, one member each, and everything else in a json member.
+        '''
+
+        arrays = {}
+        for name in _RESULT_ARRAYS:
+            value = getattr(self, name)
+            if value is not None:
+                arrays[name] = np.asarray(value)
+        if self.stocks is not None:
+            arrays['stocks'] = np.array(self.stocks, dtype=str)
+
+        meta = {'format': _RESULT_FORMAT, 'stages': [record.to_dict() for record in self.stages]}
+        for name in _RESULT_SCALARS:
+            meta[name] = _to_json(getattr(self, name))
+
+        for name in ('cars_regressions', 'cavcs_regressions'):
+            regressions = getattr(self, name)
+            if regressions is not None:
+                meta[name] = {'symbols': regressions.symbols, 'cumulate': regressions.cumulate}
+                for key in ('x', 'y', 'slopes', 'intercepts', 'factors', 'factor_slopes'):
+                    if getattr(regressions, key) is not None:
+                        arrays[name + '_' + key] = np.asarray(getattr(regressions, key))
+
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        save_arrays(file_name, arrays)
+
+    @classmethod
+    def load(cls, file_name, mmap_mode='r'):
+        '''
+        :param file_name: a file written by save
+        :param mmap_mode: see arrayfile.load_arrays. With the default the arrays are memory-mapped, read only.
+        :return: the CarsCavcsResult
+        '''
+
+        arrays = load_arrays(file_name, mmap_mode)
+        meta = json.loads(str(arrays.pop('meta')))
+        if meta.get('format') != _RESULT_FORMAT:
+            raise ValueError('CarsCavcsResult: ' + file_name + ' is not a saved result of this version')
+
+        regressions = {}
+        for name in ('cars_regressions', 'cavcs_regressions'):
+            if name in meta:
+                regressions[name] = RegressionDiagnostics(meta[name]['symbols'], arrays[name + '_x'],
+                                                          arrays[name + '_y'], arrays[name + '_slopes'],
+                                                          arrays[name + '_intercepts'], meta[name]['cumulate'],
+                                                          arrays.get(name + '_factors'),
+                                                          arrays.get(name + '_factor_slopes'))
+
+        stages = []
+        for stage in meta['stages']:
+            record = StageRecord(stage['stage'], stage['counts'])
+            record.seconds = stage['seconds']
+            record.peak_bytes = stage['peak_bytes']
+            stages.append(record)
+
+        kwargs = dict((name, meta[name]) for name in _RESULT_SCALARS)
+        kwargs.update((name, arrays.get(name)) for name in _RESULT_ARRAYS)
+        kwargs.update(regressions)
+        kwargs['stages'] = stages
+        if 'stocks' in arrays:
+            kwargs['stocks'] = arrays['stocks'].tolist()
+
+        return cls(**kwargs)
+
+
+_RESULT_FORMAT = 2
+
+_RESULT_SCALARS = ('num_events',
+                   'cars_t_test', 'cars_significant', 'cars_positive', 'cars_num_stocks_positive',
+                   'cars_num_stocks_negative',
+                   'cavcs_t_test', 'cavcs_significant', 'cavcs_positive', 'cavcs_num_stocks_positive',
+                   'cavcs_num_stocks_negative', 'cars_num_stocks_significant', 'cavcs_num_stocks_significant',
+                   'cars_patell_z', 'cars_patell_p_value', 'cars_bmp_t', 'cars_bmp_p_value',
+                   'cavcs_patell_z', 'cavcs_patell_p_value', 'cavcs_bmp_t', 'cavcs_bmp_p_value')
+
+_RESULT_ARRAYS = ('cars', 'cars_std_err', 'cavcs', 'cavcs_std_err', 'event_dates',
+                  'abnormal_returns', 'abnormal_volume_changes',
+                  'stock_cars_t_tests', 'stock_cars_significant', 'stock_cars_positive',
+                  'stock_cavcs_t_tests', 'stock_cavcs_significant', 'stock_cavcs_positive',
+                  'stock_cars_p_values', 'stock_cavcs_p_values')
+
+
+def _to_json(value):
+    '''
+    :return: a numpy scalar as the python number json can write
+    '''
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    return value
+
+
+class RegressionDiagnostics(object):
+    def __init__(self, symbols, x, y, slopes, intercepts, cumulate, factors=None, factor_slopes=None):
+        '''
+        :param symbols: the stocks, one per column of y
+        :param x: 1-d array of the market values over the estimation window
+        :param y: 2-d array (days x stocks) of the stock values over the estimation window
+        :param slopes: 1-d array with the fitted slope of each stock
+        :param intercepts: 1-d array with the fitted intercept of each stock
+        :param cumulate: how the excess values add up over time, 'cumprod' for returns and 'cumsum' for volume changes
+        :param factors: for a FactorModel, 2-d array (days x factors) of the factor values over the estimation window
+        :param factor_slopes: for a FactorModel, 2-d array (factors x stocks) of the fitted factor slopes
+        '''
+        self.symbols = list(symbols)
+        self.x = x
+        self.y = y
+        self.slopes = slopes
+        self.intercepts = intercepts
+        self.cumulate = cumulate
+        self.factors = factors
+        self.factor_slopes = factor_slopes
+
+    def excess(self):
+        '''
+        :return: 2-d array (days x stocks) of what the market model doesn't explain
+        '''
+        excess = self.y - (self.slopes * self.x[:, np.newaxis] + self.intercepts)
+        if self.factor_slopes is not None:
+            excess = excess - self.factors.dot(self.factor_slopes)
+        return excess
+
+    def cumulative_excess(self):
+        '''
+        :return: 2-d array (days x stocks) of the excess values added up over the estimation window
+        '''
+        if self.cumulate == 'cumprod':
+            return np.cumprod(self.excess() + 1, axis=0)
+        return np.cumsum(self.excess(), axis=0)
 
 
 class Calculator(object):
-    def __init__(self):
-        pass
+    def __init__(self, instrumentation=None, cache=None):
+        '''
+        :param instrumentation: optional maroma.lab.instrumentation.Instrumentation timing the stages of each run
+        :param cache: optional maroma.lab.resultcache.ResultCache. Results are then looked up there before they
+            are computed, and stored there after. The lookup is timed as the cache stage, with hit=1 or hit=0,
+            and the storing as the cache_store stage.
+        '''
+        self.__instrumentation = as_instrumentation(instrumentation)
+        self.__cache = cache
 
-    def calculate_car_qstk(self, event_matrix, stock_data, market_symbol, look_back, look_forward):
+    def calculate_car_qstk(self, event_matrix, stock_data, market_symbol, look_back, look_forward,
+                           price_key='adjusted_close', data_version=None, model=None, estimation_window=200,
+                           buffer=5):
         '''
 
-        :param event_matrix:
+        :param event_matrix: an EventMatrix, or a dataframe with the weight of each event (e.g. 1)
+            on its (date, symbol) and nan elsewhere. Either way every event counts, whatever its weight. The events
+            are placed on the dates of stock_data by date; those on other dates are left out.
         :param stock_data:
         :param market_symbol:
         :param look_back:
         :param look_forward:
+        :param price_key: the field of the prices to use when stock_data is a StockPanel or a DerivedSeries
+        :param data_version: with a cache, a string that changes whenever stock_data does, e.g.
+            StockDataStore.content_version of the arguments stock_data was loaded with. Without one the cache key
+            is a fingerprint of all of stock_data, which takes a read of it.
+        :param model: how the abnormal returns are computed, one of the models of maroma.lab.abnormalreturns.
+            Defaults to MarketAdjusted. The factors of a FactorModel are symbols of stock_data.
+        :param estimation_window: for the models that are estimated, the number of days each event's fit uses
+        :param buffer: for the models that are estimated, the number of days between the estimation window and
+            the event. Events without the history for their estimation window are left out, like those too
+            close to the start.
         :return car: time series of Cumulative Abnormal Return
         :return std_err: the standard error
         :return num_events: the number of events in the matrix
@@ -64,59 +342,94 @@ class Calculator(object):
         https://github.com/brettelliot/QuantSoftwareToolkit/blob/master/QSTK/qstkstudy/EventProfiler.py
         '''
 
-        # Copy the stock prices into a new dataframe which will become filled with the returns
-        daily_returns = stock_data.copy()
+        instrumentation = self.__instrumentation
+
+        if model is None:
+            model = MarketAdjusted()
+
+        key = None
+        if self.__cache is not None:
+            key, result = self._cache_get(['car_qstk', _CACHE_FORMAT, market_symbol, look_back, look_forward,
+                                           price_key, list(model.key()), estimation_window, buffer,
+                                           events_fingerprint(event_matrix)],
+                                          stock_data, data_version, _load_car_qstk)
+            if result is not None:
+                return result
+
+        # Accept the multi-index (symbol, timestamp) series returned by StockDataStore, a StockPanel and a
+        # DerivedSeries as well as a dataframe with datetime indices and columns of stock symbols.
+        series = as_derived_series(stock_data, key=price_key)
+
+        # The regressors of the model: the market returns and then those of the factors. They aren't stocks.
+        regressor_symbols = [market_symbol] + list(model.factors)
+        stocks = [x for x in series.symbols if x not in regressor_symbols]
+
+        with instrumentation.stage('returns', days=len(series.dates), symbols=len(series.symbols)):
+
+            # Convert prices into daily returns.
+            # This is the amount that the specific stock increased or decreased in value for one day.
+            # The returns belong to the series and are shared, so they are only read from here on.
+            daily_returns = series.returns(price_key, padded=True)
+
+            market_col = series.panel.symbol_positions([market_symbol])[0]
+            regressors = daily_returns[:, series.panel.symbol_positions(regressor_symbols)]
+
+        # the first date position an event can have
+        first_row = look_back
+        if model.estimated:
+            first_row = max(look_back, buffer + estimation_window - 1)
+
+        # A dataframe is read into an EventMatrix, so both kinds of event matrices give the same events: every
+        # cell that isn't nan, on the dates of the series
+        if not isinstance(event_matrix, EventMatrix):
+            dense = event_matrix
+            event_matrix = EventMatrix(dense.index, dense.columns)
+            event_matrix.event_matrix = dense
+
+        # leave the market symbol and the factors out of the event matrix
+        rows, cols, _ = event_matrix.event_positions()
+        event_symbols = pd.Index(event_matrix.symbols)[np.unique(cols)]
+        missing = sorted(set(event_symbols) - set(series.symbols))
+        if missing:
+            raise ValueError('calculate_car_qstk: symbols with events not found in data: ' + ', '.join(missing))
+
+        # Place the sparse events on the stocks and drop the ones at the start and the end
+        rows, cols, _ = event_matrix.event_positions(series.dates, stocks)
+        inside = (rows >= first_row) & (rows < len(series.dates) - look_forward)
+        order = np.lexsort((rows[inside], cols[inside]))
+        rows, cols = rows[inside][order], series.panel.symbol_positions(stocks)[cols[inside][order]]
+
+        # Number of events
+        i_no_events = len(rows)
+        assert i_no_events > 0, "Zero events in the event matrix"
+
+        with instrumentation.stage('windows', events=i_no_events):
 
-        # Convert prices into daily returns.
-        # This is the amount that the specific stock increased or decreased in value for one day.
-        daily_returns = daily_returns.pct_change().fillna(0)
+            # Pull all of the event windows out of the returns in one read
+            na_event_rets = gather_event_windows(daily_returns, rows, cols, look_back, look_forward)
 
-        # Subtract the market returns from all of the stock's returns. The result is the abnormal return.
-        # beta = get_beta()
-        beta = 1.0  # deal with beta later
-        abnormal_returns = daily_returns.subtract(beta * daily_returns[market_symbol], axis='index')
+            if model.estimated:
+                na_event_rets = na_event_rets - expected_event_returns(model, regressors, daily_returns, rows, cols,
+                                                                       look_back, look_forward, estimation_window,
+                                                                       buffer)
+            else:
+                # Subtract the market returns from the stock's returns. The result is the abnormal return.
+                na_event_rets = na_event_rets - gather_event_windows(daily_returns[:, market_col], rows, None,
+                                                                     look_back, look_forward)
 
-        # remove the market symbol from the returns and event matrix. It's no longer needed.
-        del daily_returns[market_symbol]
-        del abnormal_returns[market_symbol]
-        del event_matrix[market_symbol]
-        # print("abnormal_returns:")
-        # print(abnormal_returns.tail())
+        with instrumentation.stage('statistics', events=i_no_events):
 
-        # From QSTK
-        # daily_returns = daily_returns.reindex(columns=event_matrix.columns)
+            # Computing daily rets and retuns
+            na_event_rets = np.cumprod(na_event_rets + 1, axis=1)
+            na_event_rets = (na_event_rets.T / na_event_rets[:, look_back]).T
 
-        # Removing the starting and the end events
-        event_matrix.values[0:look_back, :] = np.NaN
-        event_matrix.values[-look_forward:, :] = np.NaN
+            # Study Params
+            na_mean = np.mean(na_event_rets, axis=0)
+            na_std = np.std(na_event_rets, axis=0)
 
-        # Number of events
-        i_no_events = int(np.logical_not(np.isnan(event_matrix.values)).sum())
-        assert i_no_events > 0, "Zero events in the event matrix"
-        na_event_rets = "False"
-
-        # Looking for the events and pushing them to a matrix
-        for i, s_sym in enumerate(event_matrix.columns):
-            for j, dt_date in enumerate(event_matrix.index):
-                if event_matrix[s_sym][dt_date] == 1:
-                    na_ret = abnormal_returns[s_sym][j - look_back:j + 1 + look_forward]
-                    if type(na_event_rets) == type(""):
-                        na_event_rets = na_ret
-                    else:
-                        na_event_rets = np.vstack((na_event_rets, na_ret))
-
-        if len(na_event_rets.shape) == 1:
-            na_event_rets = np.expand_dims(na_event_rets, axis=0)
-
-        # Computing daily rets and retuns
-        na_event_rets = np.cumprod(na_event_rets + 1, axis=1)
-        na_event_rets = (na_event_rets.T / na_event_rets[:, look_back]).T
-
-        # Study Params
-        na_mean = np.mean(na_event_rets, axis=0)
-        # print(na_mean)
-        # print(na_mean.shape)
-        na_std = np.std(na_event_rets, axis=0)
+        if key is not None:
+            self._cache_put(key, lambda file_name: save_arrays(file_name, {'car': na_mean, 'std_err': na_std,
+                                                                          'num_events': np.array(i_no_events)}))
 
         return na_mean, na_std, i_no_events
 
@@ -124,425 +437,803 @@ class Calculator(object):
 
 
     def calculate_cars_cavcs(self, event_matrix, stock_data, market_symbol, estimation_window=200, buffer=5,
-                             pre_event_window=10, post_event_window=10):
+                             pre_event_window=10, post_event_window=10, per_event_estimation=False,
+                             volume_transform='mean_adjusted', volume_window=5, processes=None, data_version=None,
+                             model=None):
         '''
 
-        :param event_matrix:
+        :param event_matrix: an EventMatrix, or a dataframe with the weight of each event (e.g. 1)
+            on its (date, symbol) and nan elsewhere.
+            Every stock is studied around every date on which any symbol had an event.
         :param stock_data:
         :param market_symbol:
         :param estimation_window:
         :param buffer:
         :param pre_event_window:
         :param post_event_window:
-        :return cars_cavcs_result: An instance of CarsCavcsResult containing the results.
+        :param per_event_estimation: if True every event gets its own market model fitted over
+            [t - buffer - estimation_window, t - buffer]. Otherwise one fit before the first event is used for all.
+        :param volume_transform: how volumes are turned into volume changes, one of
+            maroma.lab.volumechanges.VOLUME_TRANSFORMS or a function taking (volumes, window)
+        :param volume_window: the number of days the volume transform looks at, including the current one
+        :param processes: the number of worker processes to split the stocks between. None studies them all in
+            this process. The workers memory-map the panel (a StockPanel from StockPanel.open is used in place,
+            anything else is saved to a temporary directory first), so it is never pickled, and the results
+            are the same as those of a single process.
+        :param data_version: see calculate_car_qstk
+        :param model: how the abnormal returns are computed, one of the models of maroma.lab.abnormalreturns.
+            Defaults to MarketModel. The factors of a FactorModel are symbols of stock_data, which aren't
+            studied. The abnormal volume changes always come from the market model.
+        :return cars_cavcs_result: An instance of CarsCavcsResult containing the results. A result from the
+            cache is memory-mapped from its file and has the stages of this call.
 
 
         Modeled after http://arno.uvt.nl/show.cgi?fid=129765
 
         '''
         
-        import pandas as pd
-        import numpy as np
-        import matplotlib.pyplot as plt
-        import datetime as dt
+        instrumentation = self.__instrumentation
+        mark = len(instrumentation.records)
+
+        if model is None:
+            model = MarketModel()
+
+        # Only the dates of the events count. The number of processes doesn't change the results. A volume
+        # transform that is a function has no name to key on, so its results aren't cached.
+        key = None
+        if self.__cache is not None and isinstance(volume_transform, str):
+            key, ccr = self._cache_get(['cars_cavcs', _CACHE_FORMAT, market_symbol, estimation_window, buffer,
+                                        pre_event_window, post_event_window, per_event_estimation, volume_transform,
+                                        volume_window, list(model.key()), event_dates(event_matrix).values],
+                                       stock_data, data_version, CarsCavcsResult.load)
+            if ccr is not None:
+                ccr.stages = instrumentation.since(mark)
+                return ccr
+
+        if processes is not None and processes > 1:
+            ccr = sharded_cars_cavcs(event_dates(event_matrix), stock_data, market_symbol, estimation_window, buffer,
+                                     pre_event_window, post_event_window, per_event_estimation,
+                                     volume_transform, volume_window, processes, instrumentation, model)
+            ccr.stages = instrumentation.since(mark)
+            if key is not None:
+                self._cache_put(key, ccr.save)
+            return ccr
+
+        # Work on a dense (days x symbols) panel. The trading calendar is the market's.
+
+        study = StudyData(stock_data, market_symbol, volume_transform, volume_window, instrumentation=instrumentation,
+                          factors=model.factors)
+
+        positions = study.event_positions(event_dates(event_matrix), pre_event_window, post_event_window)
+
+        with instrumentation.stage('regression', events=len(positions), stocks=len(study.stocks),
+                                   estimation_window=estimation_window):
+            fits = fit_market_models(study, positions, estimation_window, buffer, per_event_estimation, model=model)
+
+        with instrumentation.stage('windows', events=len(positions), stocks=len(study.stocks)):
+            ccarray, cvarray = excess_windows(study, positions, fits, pre_event_window, post_event_window)
+
+        with instrumentation.stage('statistics', events=len(positions), stocks=len(study.stocks)):
+            ccr = cars_cavcs_statistics(study.stocks, ccarray, cvarray, pre_event_window + post_event_window + 1,
+                                        fits.cars_regressions, fits.cavcs_regressions, study.dates[positions].values,
+                                        fits.cars_residual_variances, fits.cavcs_residual_variances)
+
+        ccr.stages = instrumentation.since(mark)
+        if key is not None:
+            self._cache_put(key, ccr.save)
+        return ccr
 
-        num_events = len(event_matrix[(event_matrix == 1.0).any(axis=1)])
-        
-        events = event_matrix[(event_matrix == 1.0).any(axis=1)]
+    def _cache_get(self, parts, stock_data, data_version, load):
+        '''
+        :param parts: what the result depends on besides stock_data
+        :return key: the cache key
+        :return result: the result stored under it, or None
+        '''
+        with self.__instrumentation.stage('cache') as record:
+            key = fingerprint(*(parts + [data_version or data_fingerprint(stock_data)]))
+            result = self.__cache.get(key, load)
+            record.count(hit=int(result is not None))
+        return key, result
 
-        dates = stock_data.loc['MKT', slice(None)].index
-        date1 = events.index[0]
-        index1 = dates.tolist().index(date1)
-        date11 = dates[index1 - buffer]
-        date12 = dates[index1 - (buffer + estimation_window)]
+    def _cache_put(self, key, save):
+        with self.__instrumentation.stage('cache_store'):
+            self.__cache.put(key, save)
 
-        #import pdb; pdb.set_trace()
-        
-        closing_prices  = stock_data['adjusted_close']
-        volumes  = stock_data['volume']
 
+_CACHE_FORMAT = 3
 
-        stock_ret = closing_prices.copy()
-        vlm_changes0 = closing_prices.copy()
-        vlm_changes = closing_prices.copy()
-        
-        symbols = stock_data.index.get_level_values(0).unique().tolist()
-        
-        mypct = lambda x : x[-1] - np.mean(x[:-1])
 
+def events_fingerprint(event_matrix):
+    '''
+    :param event_matrix: an EventMatrix, or a dataframe with the weight of each event (e.g. 1)
+        on its (date, symbol) and nan elsewhere
+    :return: a fingerprint of the (date, symbol, weight) of every event. An EventMatrix and the dataframe of its
+        event_matrix have the same one.
+    '''
 
-        for symbol in symbols:
-            stock_ret[symbol] = closing_prices[symbol].pct_change().fillna(0)
-            #import pdb; pdb.set_trace()
-            vlm_changes[symbol] = volumes[symbol].rolling(5,5).apply(mypct).fillna(0)
-            #vlm_changes[symbol] = volumes[symbol].pct_change().fillna(0).apply(lambda x : min(3,x))
+    if isinstance(event_matrix, EventMatrix):
+        rows, cols, weights = event_matrix.event_positions()
+        return fingerprint(event_matrix.datetimes.values[rows], event_matrix.symbols, cols, weights)
 
-        
-        # do regeression
+    values = np.asarray(event_matrix.values, dtype=float)
+    rows, cols = np.nonzero(np.logical_not(np.isnan(values)))
+    return fingerprint(pd.DatetimeIndex(event_matrix.index).values[rows], list(event_matrix.columns), cols,
+                       values[rows, cols])
 
-        pre_stock_returns = stock_ret[
-            (stock_data.index.get_level_values(1) > date12) & (stock_data.index.get_level_values(1) <= date11)]
 
-        pre_stock_vlms = vlm_changes[
-            (stock_data.index.get_level_values(1) > date12) & (stock_data.index.get_level_values(1) <= date11)]
+def _load_car_qstk(file_name):
+    arrays = load_arrays(file_name, None)
+    return arrays['car'], arrays['std_err'], int(arrays['num_events'])
+
+
+class StudyData(object):
+    def __init__(self, stock_data, market_symbol, volume_transform='mean_adjusted', volume_window=5, stocks=None,
+                 instrumentation=None, factors=()):
+        '''
+        :param stock_data: a DerivedSeries, a StockPanel or a multi-index dataframe with adjusted_close and volume
+            columns
+        :param market_symbol:
+        :param volume_transform: see Calculator.calculate_cars_cavcs
+        :param volume_window: see Calculator.calculate_cars_cavcs
+        :param stocks: the stocks to study. Defaults to every symbol but the market. When it is a subset only
+            the columns of the market and of those stocks are read from the panel.
+        :param instrumentation: optional Instrumentation timing the returns and volume_changes stages
+        :param factors: the symbols of the factors of a FactorModel. They are regressors, not stocks.
+
+        The (days x symbols) daily returns and volume changes an event study runs on, laid out on the
+        market's trading calendar. They only depend on the data, so they can be shared by many studies. They
+        are read from the DerivedSeries of the data, so studies of the same DerivedSeries compute them once.
+        '''
+
+        series = as_derived_series(stock_data, market_symbol)
+
+        symbols = series.symbols
+
+        missing = [x for x in factors if x not in symbols]
+        if missing:
+            raise ValueError('calculate_cars_cavcs: factors not found in data: ' + ', '.join(missing))
 
-        #**************
-        #First compute cars ******
-        #***************
-        
-        #import pdb; pdb.set_trace()
-        
-        
-        dates =stock_data.index.get_level_values(1).unique().tolist()
-        
-    
-        
         if(market_symbol in symbols):
-            stocks =[ x for x in symbols if x != market_symbol]
+            if stocks is None:
+                stocks =[ x for x in symbols if x != market_symbol and x not in factors]
         else:
             raise ValueError('calculate_cars_cavcs: market_symbol not found in data')
-        
-        
-        
-        ar1 = ['cars','cavs']; ar2 = ['slope','intercept']
-        
-        from itertools import product
-        tuples = [(i,j) for i,j in product(ar1,ar2)]  #         tuples = list(zip(*arrays))
 
-        index = pd.MultiIndex.from_tuples(tuples, names=['first', 'second'])
-        
-        df_regress = pd.DataFrame(0.0,index=index,columns=symbols)
-        
-        #import pdb; pdb.set_trace()
-        
-        for stock in stocks:
-            
-            #set up data
-            
-            x1 = pre_stock_returns[market_symbol]
-
-            y1 = pre_stock_returns[stock]
-            
-            
-            slope1,intercept1,cars0 = regress_vals(x1,y1)
-            cars = np.cumprod(cars0 + 1, axis=0)
-            
-            # plot if you need
-
-            plot_regressvals(x1,y1,slope1, intercept1,cars,stock)
-            
-            # the same for cvals
-            
-            x2 = pre_stock_vlms[market_symbol]
-
-            y2 = pre_stock_vlms[stock]
-            
-            #y2.argsort()[::-1][:n]
-
-    
-            #import pdb; pdb.set_trace()
-            
-            slope2,intercept2,cavs0= regress_vals(x2,y2)
-            cavs = np.cumsum(cavs0)
-            
-            plot_regressvals(x2,y2,slope2, intercept2,cavs,stock)
-            
-
-            # store the regresion values
-            
-
-            df_regress.loc[('cars','slope'),stock] = slope1
-
-            df_regress.loc[('cars','intercept'),stock] = intercept1
-
-
-            df_regress.loc[('cavs','slope'),stock] = slope2
-            
-            df_regress.loc[('cavs','intercept'),stock] = intercept2
-        
-        
-            # do the same for volumes
-            
-            
-        #***************
-        # now the event cars and cavs computations
+        self.dates = series.dates
+        self.stocks = list(stocks)
+        self.factors = list(factors)
 
-        ar11  = stocks
-        ar12 = ['cars','cavs']
+        if len(self.stocks) == len(symbols) - 1 - len(self.factors):
+            self.symbols = symbols
+            self.market = symbols.index(market_symbol)
+            self.factor_cols = series.panel.symbol_positions(self.factors)
+            self.stock_cols = series.panel.symbol_positions(self.stocks)
+        else:
+            series = series.select([market_symbol] + self.factors + self.stocks)
+            self.symbols = series.symbols
+            self.market = 0
+            self.factor_cols = np.arange(1, 1 + len(self.factors))
+            self.stock_cols = np.arange(1 + len(self.factors), len(self.symbols))
 
+        instrumentation = as_instrumentation(instrumentation)
 
-        tuples2 = [(i,j) for i,j in product(ar11,ar12)]  #         tuples = list(zip(*arrays))
-        
-        index2 = pd.MultiIndex.from_tuples(tuples2, names=['first', 'second'])
-        
-        df_results = pd.DataFrame(0.0,index=index2,columns= ['positive','significant'])
-        
-        ccarray = []
-        cvarray = []
-        
-        # now the big loop
-
-        #import pdb; pdb.set_trace()
-            
-        for stock in stocks:
-            
-            slope1 = df_regress.loc[('cars','slope'),stock]
-            intercept1 = df_regress.loc[('cars','intercept'),stock]
-            
-            slope2 = df_regress.loc[('cavs','slope'),stock]
-            intercept2 = df_regress.loc[('cavs','intercept'),stock]
-
-            ccr=[]
-            cvr = []
-            
-            for event in events.iterrows():
-            
-            
-                dt1 = event[0]
-                idx1 = dates.index(dt1)
-                window = dates[idx1-pre_event_window:idx1+post_event_window+1]
-                
-                event_rets = stock_ret[stock][window]
-                event_mkt_ret =  stock_ret[market_symbol][window]
-                # calculate excess returns
-                event_ex_ret = event_rets - (slope1 * event_mkt_ret + intercept1)
-                
-                event_cum_rets = np.cumprod(event_rets + 1, axis=0)
-                #plot_regressvals(event_mkt_ret,event_rets,slope1, intercept1,event_cum_rets,stock)
-                
-                ccr.append(event_ex_ret.tolist())
-
-                cars = (event_cum_rets[-1] -1)/len(window)
-            
-            
-                # now for vols
-                event_vols =  vlm_changes[stock][window]
-                mkt_vols  =  vlm_changes[market_symbol][window]
-                event_ex_vols = event_vols - (slope2 * mkt_vols + intercept2)
-                event_cum_ex_vols = np.cumsum(event_ex_vols)
-                #plot_regressvals(mkt_vols,event_ex_vols,slope2, intercept2,event_cum_ex_vols,stock)
-                cvr.append(event_ex_vols.tolist())
-
-
-            #*********************
-            # now do computations for the whole stock
-
-            #import pdb; pdb.set_trace()
-
-            cars_stock   =  np.array(ccr)
-            
-            ccarray.append(cars_stock)
-            #df_results.loc[(slice(None),stock),'cars'].tolist()
-        
-            cars = np.mean(cars_stock,axis=0)
-            
-            std1 = np.std(cars)
-            
-            cars_t_test = np.mean(cars) /std1 * np.sqrt(len(window))
-
-                
-            pval1 = 1 - stats.t.cdf(cars_t_test,df=len(cars))
-                
-            if(pval1 < .05):
-                cars_significant = True
-            else:
-                cars_significant = False
+        # read-only arrays of the series
+        with instrumentation.stage('returns', days=len(self.dates), symbols=len(self.symbols)):
+            self.stock_ret = series.returns('adjusted_close')
 
+        with instrumentation.stage('volume_changes', days=len(self.dates), symbols=len(self.symbols)):
+            self.vlm_changes = series.volume_changes(volume_transform, volume_window)
 
-            if np.mean(cars) >= 0 :
-                cars_positive = True
-            else:
-                cars_positive = False
+    def event_positions(self, events, pre_event_window, post_event_window):
+        '''
+        :param events: the event dates
+        :return: the position of each event on the calendar
 
-            cars_cum = np.cumprod(cars + 1, axis=0)
+        Every event date is turned into a position once, so that all the windows of a study are positional
+        slices of the (days x symbols) arrays.
+        '''
 
-            #import pdb; pdb.set_trace()
+        dates = self.dates
 
-            #plt.plot(cars_cum); plt.title('Cars'); plt.show()
+        positions = dates.searchsorted(events)
 
-            # do the same for volumes
-            #***************
-            
-            cavs_stock  = np.array(cvr)
-            
-            cvarray.append(cavs_stock)
+        if (positions >= len(dates)).any() or not (dates[np.minimum(positions, len(dates) - 1)] == events).all():
+            raise ValueError('calculate_cars_cavcs: event dates must be trading days of the market symbol')
 
-            cavs = np.mean(cavs_stock,axis=0)
-            
-            std2 = np.std(cavs)
-            
-            cavs_t_test = np.mean(cavs) /std2 * np.sqrt(len(window))
+        if len(positions) == 0:
+            raise ValueError('calculate_cars_cavcs: zero events in the event matrix')
 
-            pval2 = 1 - stats.t.cdf(cavs_t_test,df=len(cavs))
-            
-            if(pval2 < .05):
-                cavs_significant = True
-            else:
-                cavs_significant = False
-            
-            
-            if np.mean(cavs) >= 0 :
-                cavs_positive = True
-            else:
-                cavs_positive = False
+        if positions.min() < pre_event_window or positions.max() + post_event_window >= len(dates):
+            raise ValueError('calculate_cars_cavcs: not enough data around the events for the event window')
 
-            cavs_cum = np.cumsum(cavs, axis=0)
+        return positions
 
-            #import pdb; pdb.set_trace()
 
+class MarketModelFits(object):
+    def __init__(self, cars_slopes, cars_intercepts, cavs_slopes, cavs_intercepts, cars_regressions, cavcs_regressions,
+                 cars_factor_slopes=None, cars_residual_variances=None, cavcs_residual_variances=None):
+        '''
+        :param cars_slopes: 2-d array (events x stocks) of the slope used for each event of each stock's returns
+        :param cars_intercepts: 2-d array (events x stocks) of the matching intercepts
+        :param cavs_slopes: 2-d array (events x stocks) of the slope used for each event of each stock's volume changes
+        :param cavs_intercepts: 2-d array (events x stocks) of the matching intercepts
+        :param cars_regressions: RegressionDiagnostics of the returns regression before the first event
+        :param cavcs_regressions: RegressionDiagnostics of the volume changes regression before the first event
+        :param cars_factor_slopes: for a FactorModel, 3-d array (events x factors x stocks) of the factor slopes
+            used for each event of each stock's returns
+        :param cars_residual_variances: with per event estimation, 2-d array (events x stocks) of the variance of
+            the residuals of each event's returns fit over its own estimation window. None when every event uses
+            the fit of cars_regressions.
+        :param cavcs_residual_variances: the same for the volume changes fits
+        '''
+        self.cars_slopes = cars_slopes
+        self.cars_intercepts = cars_intercepts
+        self.cavs_slopes = cavs_slopes
+        self.cavs_intercepts = cavs_intercepts
+        self.cars_regressions = cars_regressions
+        self.cavcs_regressions = cavcs_regressions
+        self.cars_factor_slopes = cars_factor_slopes
+        self.cars_residual_variances = cars_residual_variances
+        self.cavcs_residual_variances = cavcs_residual_variances
 
-            #plt.plot(cavs_cum); plt.title('Cavs'); plt.show()
 
+def fit_market_models(study, positions, estimation_window, buffer, per_event_estimation=False, cache=None,
+                      model=None):
+    '''
+    :param study: the StudyData
+    :param positions: the calendar position of each event
+    :param estimation_window:
+    :param buffer:
+    :param per_event_estimation: see Calculator.calculate_cars_cavcs
+    :param cache: optional dict to keep fits in. Studies on the same StudyData that share a dict only fit each
+        (model, estimation_window, buffer, event position) once.
+    :param model: the model of the returns, see Calculator.calculate_cars_cavcs. The volume changes are always
+        fitted with the market model.
+    :return: the MarketModelFits of the events
+    '''
 
-            #  store the results *******
+    if cache is None:
+        cache = {}
 
-            df_results.loc[(stock,'cars'),'positive'] = cars_positive
-                                                             
-            df_results.loc[(stock,'cars'),'significant'] = cars_significant
-                                                             
-            df_results.loc[(stock,'cavs'),'positive'] = cavs_positive
-             
-            df_results.loc[(stock,'cavs'),'significant'] = cavs_significant
+    if model is None:
+        model = MarketModel()
 
+    if list(model.factors) != study.factors:
+        raise ValueError('fit_market_models: the study has other factors than the model')
 
+    stocks = study.stocks
+    stock_cols = study.stock_cols
+    market = study.market
+    stock_ret = study.stock_ret
+    vlm_changes = study.vlm_changes
 
-        #import pdb; pdb.set_trace()
-        
-        # aggregate results for output
-        #****************
+    # the market returns and then those of the factors
+    regressor_cols = np.concatenate(([market], study.factor_cols)).astype(int)
 
-        positive1 = df_results.loc[(slice(None),'cars'),'positive'].tolist()
-                                                             
-        significant1 = df_results.loc[(slice(None),'cars'),'significant'].tolist()
-        
-        cars_num_stocks_positive = sum(positive1)
-        cars_num_stocks_negative =  sum(np.logical_not(positive1))
-        
-        
-        cars_num_stocks_significant = sum(significant1)
-        
-        
-        
-        positive2 = df_results.loc[(slice(None),'cavs'),'positive'].tolist()
-        
-        significant2 = df_results.loc[(slice(None),'cavs'),'significant'].tolist()
-        
-        
-        cavcs_num_stocks_positive = sum(positive2)
-        cavcs_num_stocks_negative =  sum(np.logical_not(positive2))
-        
-        
-        cavcs_num_stocks_significant = sum(significant2)
+    # do regeression over the window (t - buffer - estimation_window, t - buffer] of the first event
 
+    index1 = positions[0]
 
-        
+    key = ('first',) + model.key() + (estimation_window, buffer, index1)
 
-        # The full calculations *********
-        
-        #import pdb; pdb.set_trace()
-        
-        Cars = np.mean(np.array(ccarray),axis=0)
-        
-        num_events = len(Cars)
+    if key not in cache:
 
-        cars_std_err = np.std(Cars,axis=0)
+        pre_returns = stock_ret[index1 - (buffer + estimation_window) + 1:index1 - buffer + 1]
 
-        cars =  np.mean(Cars,axis=0)
-        
-        cars_cum  = np.cumprod(cars + 1, axis=0)
-        
-        cars_t_testf  = np.mean(Cars) /np.std(cars) * np.sqrt(len(window))
-        
-        pval1 = 1 - stats.t.cdf(cars_t_testf,df=len(Cars))
-        
-        
-        if(pval1 < .05):
-            cars_significant = True
-        else:
-            cars_significant = False
+        pre_vlms = vlm_changes[index1 - (buffer + estimation_window) + 1:index1 - buffer + 1]
 
+        # estimate the market model of every stock at once from (days x stocks) blocks
 
-        if np.mean(cars) > 0 :
-            cars_positive = True
-        else:
-            cars_positive = False
+        cars_coefficients = model.fit(pre_returns[:, regressor_cols], pre_returns[:, stock_cols])
 
+        cavs_slopes, cavs_intercepts = regress_batch(pre_vlms[:, market], pre_vlms[:, stock_cols])
 
+        # keep what is needed to draw the regressions, see Plotter.plot_regressions
 
-        #***********
-        #Now cavs ******
-        #*************
+        factors, factor_slopes = None, None
+        if study.factors:
+            factors, factor_slopes = pre_returns[:, study.factor_cols], cars_coefficients[2:]
 
-        #import pdb; pdb.set_trace()
-        Cavcs = np.mean(np.array(cvarray),axis=0)
+        cars_regressions = RegressionDiagnostics(stocks, pre_returns[:, market], pre_returns[:, stock_cols],
+                                                 cars_coefficients[1], cars_coefficients[0], 'cumprod',
+                                                 factors, factor_slopes)
 
-        cavcs_std_err = np.std(Cavcs,axis=0)
+        cavcs_regressions = RegressionDiagnostics(stocks, pre_vlms[:, market], pre_vlms[:, stock_cols],
+                                                  cavs_slopes, cavs_intercepts, 'cumsum')
 
-        cavcs =  np.mean(Cavcs,axis=0)
+        cache[key] = (cars_regressions, cavcs_regressions)
 
-        cavcs_cum  = np.cumsum(cavcs , axis=0)
+    cars_regressions, cavcs_regressions = cache[key]
 
+    # the fit used for each (event, stock)
 
-        cavcs_t_testf  = np.mean(Cavcs) /np.std(cavcs) * np.sqrt(len(window))
+    if per_event_estimation:
 
+        keys = [('event',) + model.key() + (estimation_window, buffer, position) for position in positions]
 
-        pval2 = 1 - stats.t.cdf(cavcs_t_testf,df=len(Cavcs))
+        missing = np.unique([position for position, key in zip(positions, keys) if key not in cache])
 
+        if len(missing):
 
-        if(pval2 < .05):
-            cavcs_significant = True
-        else:
-            cavcs_significant = False
+            stops = missing - buffer + 1
 
+            starts = stops - estimation_window
 
-        if np.mean(cavcs) > 0 :
-            cavcs_positive = True
-        else:
-            cavcs_positive = False
+            if starts.min() < 0:
+                raise ValueError('calculate_cars_cavcs: not enough data before the first event for the estimation window')
 
+            cars_coefficients = model.fit_windows(stock_ret[:, regressor_cols], stock_ret[:, stock_cols], starts,
+                                                  stops)
+            cavs_slopes, cavs_intercepts = regress_windows(vlm_changes[:, market], vlm_changes[:, stock_cols],
+                                                           starts, stops)
 
+            # the residuals of each event's own fits, for the standardized tests
+            fitted = (cars_coefficients, cavs_slopes, cavs_intercepts,
+                      residual_variances(stock_ret[:, regressor_cols], stock_ret[:, stock_cols], starts, stops,
+                                         cars_coefficients),
+                      residual_variances(vlm_changes[:, [market]], vlm_changes[:, stock_cols], starts, stops,
+                                         np.stack((cavs_intercepts, cavs_slopes), axis=1)))
 
-        #Final  Results to CarsCavcsResult
+            for k, position in enumerate(missing):
+                cache[('event',) + model.key() + (estimation_window, buffer, position)] = \
+                    tuple(values[k] for values in fitted)
 
-        #import pdb; pdb.set_trace()
-        ccr = CarsCavcsResult(num_events,
-                      cars_cum, cars_std_err, cars_t_testf, cars_significant,
-                      cars_positive, cars_num_stocks_positive, cars_num_stocks_negative,
-                      cavcs_cum, cavcs_std_err, cavcs_t_testf, cavcs_significant,
-                      cavcs_positive, cavcs_num_stocks_positive, cavcs_num_stocks_negative)
+        rows = [cache[key] for key in keys]
 
+        # (events x 1 + regressors x stocks)
+        cars_coefficients = np.array([row[0] for row in rows])
 
-        return ccr
+        return MarketModelFits(cars_coefficients[:, 1], cars_coefficients[:, 0],
+                               np.array([row[1] for row in rows]), np.array([row[2] for row in rows]),
+                               cars_regressions, cavcs_regressions,
+                               cars_coefficients[:, 2:] if study.factors else None,
+                               np.array([row[3] for row in rows]), np.array([row[4] for row in rows]))
+
+    shape = (len(positions), len(stocks))
+
+    cars_factor_slopes = None
+    if study.factors:
+        cars_factor_slopes = np.broadcast_to(cars_regressions.factor_slopes,
+                                             (len(positions),) + cars_regressions.factor_slopes.shape)
+
+    return MarketModelFits(np.broadcast_to(cars_regressions.slopes, shape),
+                           np.broadcast_to(cars_regressions.intercepts, shape),
+                           np.broadcast_to(cavcs_regressions.slopes, shape),
+                           np.broadcast_to(cavcs_regressions.intercepts, shape),
+                           cars_regressions, cavcs_regressions, cars_factor_slopes)
+
+
+def cars_cavcs_result(study, positions, fits, pre_event_window, post_event_window):
+    '''
+    :param study: the StudyData
+    :param positions: the calendar position of each event
+    :param fits: the MarketModelFits of the events
+    :param pre_event_window:
+    :param post_event_window:
+    :return cars_cavcs_result: An instance of CarsCavcsResult containing the results.
+    '''
+
+    ccarray, cvarray = excess_windows(study, positions, fits, pre_event_window, post_event_window)
+
+    return cars_cavcs_statistics(study.stocks, ccarray, cvarray, pre_event_window + post_event_window + 1,
+                                 fits.cars_regressions, fits.cavcs_regressions, study.dates[positions].values,
+                                 fits.cars_residual_variances, fits.cavcs_residual_variances)
+
+
+def excess_windows(study, positions, fits, pre_event_window, post_event_window):
+    '''
+    :param study: the StudyData
+    :param positions: the calendar position of each event
+    :param fits: the MarketModelFits of the events
+    :param pre_event_window:
+    :param post_event_window:
+    :return ccarray: 3-d array (stocks x events x window) of the abnormal returns around each event
+    :return cvarray: 3-d array (stocks x events x window) of the abnormal volume changes around each event
+    '''
+
+    stock_cols = study.stock_cols
+    market = study.market
+    stock_ret = study.stock_ret
+    vlm_changes = study.vlm_changes
+
+    # gather the (events x window x stocks) windows of every stock in one read
+
+    event_rets = gather_event_windows(stock_ret, positions, None,
+                                      pre_event_window, post_event_window)[:, :, stock_cols]
+    event_mkt_ret = gather_event_windows(stock_ret[:, market], positions, None,
+                                         pre_event_window, post_event_window)
+
+    # calculate excess returns
+
+    event_ex_ret = event_rets - (fits.cars_slopes[:, np.newaxis, :] * event_mkt_ret[:, :, np.newaxis] +
+                                 fits.cars_intercepts[:, np.newaxis, :])
+
+    if fits.cars_factor_slopes is not None:
+        event_factors = gather_event_windows(stock_ret[:, study.factor_cols], positions, None,
+                                             pre_event_window, post_event_window)
+        for f in range(len(study.factor_cols)):
+            event_ex_ret = event_ex_ret - (fits.cars_factor_slopes[:, np.newaxis, f, :] *
+                                           event_factors[:, :, f, np.newaxis])
+
+    # now for vols
+
+    event_vols = gather_event_windows(vlm_changes, positions, None,
+                                      pre_event_window, post_event_window)[:, :, stock_cols]
+    mkt_vols = gather_event_windows(vlm_changes[:, market], positions, None,
+                                    pre_event_window, post_event_window)
+
+    event_ex_vols = event_vols - (fits.cavs_slopes[:, np.newaxis, :] * mkt_vols[:, :, np.newaxis] +
+                                  fits.cavs_intercepts[:, np.newaxis, :])
+
+    # (stocks x events x window)
+
+    ccarray = event_ex_ret.transpose(2, 0, 1)
+    cvarray = event_ex_vols.transpose(2, 0, 1)
+
+    return ccarray, cvarray
+
+
+def cars_cavcs_statistics(stocks, ccarray, cvarray, window_length, cars_regressions=None, cavcs_regressions=None,
+                          event_dates=None, cars_residual_variances=None, cavcs_residual_variances=None):
+    '''
+    :param stocks: the stocks, one per row of ccarray and cvarray
+    :param ccarray: 3-d array (stocks x events x window) of abnormal returns, see excess_windows
+    :param cvarray: 3-d array (stocks x events x window) of abnormal volume changes
+    :param window_length: pre_event_window + post_event_window + 1
+    :param cars_regressions: passed on to the CarsCavcsResult. Without it there are no standardized tests of the
+        returns.
+    :param cavcs_regressions: passed on to the CarsCavcsResult. Without it there are no standardized tests of
+        the volume changes.
+    :param event_dates: passed on to the CarsCavcsResult
+    :param cars_residual_variances: with per event estimation, the residual variances of each event's returns
+        fits, see MarketModelFits. They standardize the abnormal returns instead of those of cars_regressions.
+    :param cavcs_residual_variances: the same for the volume changes
+    :return cars_cavcs_result: An instance of CarsCavcsResult containing the results, with the abnormal values
+        and the statistics of each stock.
+
+    The statistics of all stocks are computed together, with array operations over the (stocks x events x window)
+    arrays.
+    '''
+
+    # the result keeps the abnormal values, in contiguous arrays
+    ccarray = np.ascontiguousarray(ccarray)
+    cvarray = np.ascontiguousarray(cvarray)
+
+    # now the cars and cavs of each stock, averaged over its events
+
+    (stock_cars_positive, stock_cars_t_tests, stock_cars_p_values,
+     stock_cars_significant) = stock_window_tests(ccarray.mean(axis=1), window_length)
+
+    (stock_cavcs_positive, stock_cavcs_t_tests, stock_cavcs_p_values,
+     stock_cavcs_significant) = stock_window_tests(cvarray.mean(axis=1), window_length)
+
+    # The full calculations *********
+
+    Cars = np.mean(ccarray,axis=0)
+
+    num_events = len(Cars)
+
+    cars_std_err = np.std(Cars,axis=0)
+
+    cars =  np.mean(Cars,axis=0)
+
+    cars_cum  = np.cumprod(cars + 1, axis=0)
+
+    cars_t_testf, cars_significant = window_t_test(np.mean(Cars), np.std(cars), window_length, len(Cars))
+
+    cars_tests = standardized_tests(ccarray, cars_regressions, window_length, cars_residual_variances)
+
+    #***********
+    #Now cavs ******
+    #*************
+
+    Cavcs = np.mean(cvarray,axis=0)
+
+    cavcs_std_err = np.std(Cavcs,axis=0)
+
+    cavcs =  np.mean(Cavcs,axis=0)
+
+    cavcs_cum  = np.cumsum(cavcs , axis=0)
+
+    cavcs_t_testf, cavcs_significant = window_t_test(np.mean(Cavcs), np.std(cavcs), window_length, len(Cavcs))
+
+    cavcs_tests = standardized_tests(cvarray, cavcs_regressions, window_length, cavcs_residual_variances)
+
+    #Final  Results to CarsCavcsResult
+
+    return CarsCavcsResult(num_events,
+                           cars_cum, cars_std_err, cars_t_testf, cars_significant,
+                           bool(np.mean(cars) > 0), int(stock_cars_positive.sum()),
+                           int(np.logical_not(stock_cars_positive).sum()),
+                           cavcs_cum, cavcs_std_err, cavcs_t_testf, cavcs_significant,
+                           bool(np.mean(cavcs) > 0), int(stock_cavcs_positive.sum()),
+                           int(np.logical_not(stock_cavcs_positive).sum()),
+                           cars_regressions, cavcs_regressions,
+                           stocks=stocks, event_dates=event_dates, abnormal_returns=ccarray,
+                           abnormal_volume_changes=cvarray,
+                           stock_cars_t_tests=stock_cars_t_tests, stock_cars_significant=stock_cars_significant,
+                           stock_cars_positive=stock_cars_positive,
+                           stock_cavcs_t_tests=stock_cavcs_t_tests, stock_cavcs_significant=stock_cavcs_significant,
+                           stock_cavcs_positive=stock_cavcs_positive,
+                           cars_num_stocks_significant=int(stock_cars_significant.sum()),
+                           cavcs_num_stocks_significant=int(stock_cavcs_significant.sum()),
+                           stock_cars_p_values=stock_cars_p_values, stock_cavcs_p_values=stock_cavcs_p_values,
+                           cars_patell_z=cars_tests[0], cars_patell_p_value=cars_tests[1],
+                           cars_bmp_t=cars_tests[2], cars_bmp_p_value=cars_tests[3],
+                           cavcs_patell_z=cavcs_tests[0], cavcs_patell_p_value=cavcs_tests[1],
+                           cavcs_bmp_t=cavcs_tests[2], cavcs_bmp_p_value=cavcs_tests[3])
+
+
+def stock_window_tests(stock_means, window_length):
+    '''
+    :param stock_means: 2-d array (stocks x window) of the mean abnormal value of each stock over its events, per
+        day of the window
+    :param window_length: pre_event_window + post_event_window + 1
+    :return positive: True for the stocks whose mean over the window is at least 0
+    :return t_tests: the window t-test statistic of each stock
+    :return p_values: the p-value of each t_test
+    :return significant: True for the stocks whose t-test is in the 95% confidence level
+    '''
+
+    means = stock_means.mean(axis=1)
+
+    t_tests = means / stock_means.std(axis=1) * np.sqrt(window_length)
+    p_values = window_p_value(t_tests, window_length)
+
+    return means >= 0, t_tests, p_values, p_values < .05
+
+
+def standardized_tests(abnormal, regressions, window_length, residual_variances=None):
+    '''
+    :param abnormal: 3-d array (stocks x events x window) of abnormal values
+    :param regressions: the RegressionDiagnostics of the fits the abnormal values are the excess of, or None.
+        With per event estimation, those of the fit before the first event.
+    :param window_length: pre_event_window + post_event_window + 1
+    :param residual_variances: with per event estimation, 2-d array (events x stocks) of the residual variance
+        of each event's own fit, see MarketModelFits. Otherwise None, and every event is standardized by the
+        residuals of regressions.
+    :return patell_z: the Patell test statistic of the abnormal values summed over the window
+    :return patell_p_value: its two sided p-value
+    :return bmp_t: the standardized cross-sectional (Boehmer, Musumeci and Poulsen) test statistic
+    :return bmp_p_value: its two sided p-value
+
+    The abnormal values of each stock and event are standardized by the standard deviation of the residuals of
+    the fit they come from, over its estimation window, without the correction for the error of the fit's
+    prediction. The Patell test takes the standardized sums to be independent with known variance. The BMP test
+    estimates their variance across stocks and events, so it holds up when the event moves the variance too. All
+    four are None without regressions.
+    '''
+
+    if regressions is None:
+        return None, None, None, None
+
+    residuals = regressions.excess()
+    num_regressors = 1 if regressions.factor_slopes is None else 1 + len(regressions.factor_slopes)
+    dof = len(residuals) - 1 - num_regressors
+
+    if residual_variances is None:
+        residual_std = np.sqrt((residuals * residuals).sum(axis=0) / dof)[:, np.newaxis]
+    else:
+        residual_std = np.sqrt(residual_variances).T
+
+    # (stocks x events) standardized cumulative abnormal values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scar = abnormal.sum(axis=2) / (residual_std * np.sqrt(window_length))
+
+    n = scar.size
+
+    patell_z = float(scar.sum() / np.sqrt(n * dof / (dof - 2.0)))
+    bmp_t = float(scar.mean() / (scar.std(ddof=1) / np.sqrt(n)))
+
+    return patell_z, float(2 * stats.norm.sf(abs(patell_z))), bmp_t, float(2 * stats.t.sf(abs(bmp_t), n - 1))
+
+
+def window_t_test(mean, std, window_length, df):
+    '''
+    :param mean: the mean abnormal value over the event window. Can be an array, to test many at once.
+    :param std: the standard deviation of the abnormal values over the event window
+    :param window_length: pre_event_window + post_event_window + 1
+    :param df: the degrees of freedom of the t distribution
+    :return t_test: the t-test statistic
+    :return significant: True where the statistic is in the 95% confidence level
+    '''
+
+    t_test = mean / std * np.sqrt(window_length)
+
+    pval = window_p_value(t_test, df)
+
+    if np.ndim(pval) == 0:
+        return t_test, bool(pval < .05)
+
+    return t_test, pval < .05
+
+
+def window_p_value(t_test, df):
+    '''
+    :return: the one sided p-value of a window t-test statistic, the chance of one at least as large
+    '''
+    return 1 - stats.t.cdf(t_test, df=df)
+
+
+def sharded_cars_cavcs(events, stock_data, market_symbol, estimation_window, buffer, pre_event_window,
+                       post_event_window, per_event_estimation, volume_transform, volume_window, processes,
+                       instrumentation=None, model=None):
+    '''
+    :param events: the event dates
+    :param processes: the number of worker processes
+    :param instrumentation: optional Instrumentation timing the shards and statistics stages
+    :param model: the model of the returns, see Calculator.calculate_cars_cavcs
+    :return cars_cavcs_result: An instance of CarsCavcsResult containing the results.
+
+    The other parameters are those of Calculator.calculate_cars_cavcs. Every stock's fits and event windows
+    only depend on that stock and the market, so the stocks are split into one shard per process. Each worker
+    memory-maps the panel, studies its shard and writes the abnormal values into a shared memory-mapped
+    array. The statistics across stocks are then computed here from that array, exactly as with one process.
+    '''
+
+    instrumentation = as_instrumentation(instrumentation)
+
+    if model is None:
+        model = MarketModel()
+
+    panel = as_derived_series(stock_data, market_symbol).panel
+
+    if market_symbol not in panel.symbols:
+        raise ValueError('calculate_cars_cavcs: market_symbol not found in data')
+
+    stocks = [x for x in panel.symbols if x != market_symbol and x not in model.factors]
+    window_length = pre_event_window + post_event_window + 1
+
+    work_dir = tempfile.mkdtemp(prefix='maroma-')
+    try:
+        panel_dir = panel.panel_dir
+        if panel_dir is None:
+            panel_dir = os.path.join(work_dir, 'panel')
+            panel.save(panel_dir)
+
+        out_file = os.path.join(work_dir, 'excess.npy')
+        out = np.lib.format.open_memmap(out_file, mode='w+', dtype=float,
+                                        shape=(2, len(events), window_length, len(stocks)))
+        del out
+
+        shards = []
+        for columns in np.array_split(np.arange(len(stocks)), max(1, min(processes, len(stocks)))):
+            shards.append((panel_dir, market_symbol, [stocks[i] for i in columns], columns[0] if len(columns) else 0,
+                           events, estimation_window, buffer, pre_event_window, post_event_window,
+                           per_event_estimation, volume_transform, volume_window, model, out_file))
+
+        with instrumentation.stage('shards', processes=processes, events=len(events), stocks=len(stocks)):
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                fits = list(pool.map(_study_shard, shards))
+
+        out = np.load(out_file, mmap_mode='r')
+        # (stocks x events x window) views of (events x window x stocks) arrays, laid out as in one process
+        ccarray = np.array(out[0]).transpose(2, 0, 1)
+        cvarray = np.array(out[1]).transpose(2, 0, 1)
+        del out
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    cars_residual_variances, cavcs_residual_variances = None, None
+    if per_event_estimation:
+        cars_residual_variances = np.concatenate([shard_fits.cars_residual_variances for shard_fits in fits], axis=1)
+        cavcs_residual_variances = np.concatenate([shard_fits.cavcs_residual_variances for shard_fits in fits],
+                                                  axis=1)
+
+    with instrumentation.stage('statistics', events=len(events), stocks=len(stocks)):
+        return cars_cavcs_statistics(stocks, ccarray, cvarray, window_length,
+                                     join_regressions([shard_fits.cars_regressions for shard_fits in fits]),
+                                     join_regressions([shard_fits.cavcs_regressions for shard_fits in fits]),
+                                     pd.DatetimeIndex(events).values, cars_residual_variances,
+                                     cavcs_residual_variances)
+
+
+def _study_shard(shard):
+    '''
+    Study the stocks of one shard in a worker process and write their abnormal values to the shared output.
+    :return: the MarketModelFits of the shard
+    '''
+
+    (panel_dir, market_symbol, stocks, first, events, estimation_window, buffer, pre_event_window,
+     post_event_window, per_event_estimation, volume_transform, volume_window, model, out_file) = shard
+
+    study = StudyData(StockPanel.open(panel_dir), market_symbol, volume_transform, volume_window, stocks,
+                      factors=model.factors)
+
+    positions = study.event_positions(events, pre_event_window, post_event_window)
+
+    fits = fit_market_models(study, positions, estimation_window, buffer, per_event_estimation, model=model)
+
+    ccarray, cvarray = excess_windows(study, positions, fits, pre_event_window, post_event_window)
+
+    out = np.load(out_file, mmap_mode='r+')
+    out[0, :, :, first:first + len(stocks)] = ccarray.transpose(1, 2, 0)
+    out[1, :, :, first:first + len(stocks)] = cvarray.transpose(1, 2, 0)
+    out.flush()
+    del out
+
+    # only the diagnostics and the residual variances go back to the parent, the per-event fits are not needed there
+    return MarketModelFits(None, None, None, None, fits.cars_regressions, fits.cavcs_regressions, None,
+                           fits.cars_residual_variances, fits.cavcs_residual_variances)
+
+
+def join_regressions(regressions):
+    '''
+    :param regressions: RegressionDiagnostics of disjoint sets of stocks, fitted on the same market values
+    :return: one RegressionDiagnostics of all of the stocks
+    '''
+
+    factor_slopes = None
+    if regressions[0].factor_slopes is not None:
+        factor_slopes = np.concatenate([diagnostics.factor_slopes for diagnostics in regressions], axis=1)
+
+    return RegressionDiagnostics([symbol for diagnostics in regressions for symbol in diagnostics.symbols],
+                                 regressions[0].x,
+                                 np.concatenate([diagnostics.y for diagnostics in regressions], axis=1),
+                                 np.concatenate([diagnostics.slopes for diagnostics in regressions]),
+                                 np.concatenate([diagnostics.intercepts for diagnostics in regressions]),
+                                 regressions[0].cumulate, regressions[0].factors, factor_slopes)
+
+
+def event_dates(event_matrix):
+    '''
+    :param event_matrix: an EventMatrix, or a dataframe with the weight of each event (e.g. 1)
+        on its (date, symbol) and nan elsewhere
+    :return: the datetimes on which at least one symbol has an event. As in an EventMatrix every cell that isn't
+        nan is an event, whatever its weight.
+    '''
+
+    if isinstance(event_matrix, EventMatrix):
+        return event_matrix.event_dates()
+
+    return event_matrix.index[event_matrix.notnull().any(axis=1).values]
+
+
+def expected_event_returns(model, x, y, rows, cols, look_back, look_forward, estimation_window, buffer):
+    '''
+    :param model: one of the estimated models of maroma.lab.abnormalreturns
+    :param x: 2-d array (days x regressors) of the market returns and then those of the model's factors
+    :param y: 2-d array (days x stocks) of the stock returns
+    :param rows: the date position of each event
+    :param cols: the stock position of each event
+    :param look_back: number of days before the event to include
+    :param look_forward: number of days after the event to include
+    :param estimation_window: the number of days of each fit
+    :param buffer: the number of days between the estimation window and the event
+    :return: an (events x window) array of the returns the model expects for each event's stock around it
 
+    Every stock is fitted over the estimation window of every date with an event, all in one call of the model.
+    '''
 
-def plot_regressvals(x,y,slope, intercept,cars,stock):
+    dates, inverse = np.unique(rows, return_inverse=True)
+    stops = dates - buffer + 1
 
-    import matplotlib.pyplot as plt
-    #import pdb; pdb.set_trace()
-    plt.figure(1)
-    ax1 = plt.subplot(211)
-    plt.title('Regression for stock: '+stock)
-    ax1.plot(x, y, 'o', label='Original data', markersize=10)
-    ax1.plot(x, slope*x + intercept, 'r', label='Fitted line')
-    ax1.legend()
+    # (events x 1 + regressors) coefficients of the stock of each event
+    coefficients = model.fit_windows(x, y, stops - estimation_window, stops)[inverse, :, cols]
 
-    ax2 = plt.subplot(212)
-    ax2.plot(cars,label ='excess return')
-    #plt.show()
+    event_x = gather_event_windows(x, rows, None, look_back, look_forward)
 
+    return coefficients[:, np.newaxis, 0] + np.einsum('ewr,er->ew', event_x, coefficients[:, 1:])
 
-def regress_vals(x,y):
-    
-    import numpy as np
 
-    A = np.vstack([x, np.ones(len(x))]).T
+def gather_event_windows(values, rows, cols, look_back, look_forward):
+    '''
+    :param values: array indexed by date position first, e.g. a (days x symbols) array of abnormal returns
+    :param rows: the date position of each event
+    :param cols: the symbol position of each event, or None to take the windows of every symbol
+    :param look_back: number of days before the event to include
+    :param look_forward: number of days after the event to include
+    :return: an (events x window) array whose row k is values[rows[k] - look_back:rows[k] + look_forward + 1, cols[k]].
+        When cols is None the trailing dimensions of values are kept, e.g. (events x window x symbols).
 
-    slope, intercept = np.linalg.lstsq(A, y, rcond=None)[0]
+    Every window is read with a single fancy-indexed lookup instead of one slice per event.
+    '''
 
-    #print(slope, intercept)
-    yhat = slope * x + intercept
-    cars0 =  y -yhat
-    #cars = np.cumprod(cars0 + 1, axis=0)
+    offsets = np.arange(-look_back, look_forward + 1)
+    index = np.asarray(rows)[:, np.newaxis] + offsets
 
-    return slope,intercept,cars0
+    if cols is None:
+        return np.asarray(values)[index]
 
+    return np.asarray(values)[index, np.asarray(cols)[:, np.newaxis]]
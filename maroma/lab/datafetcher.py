@@ -0,0 +1,299 @@
+import asyncio
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlsplit
+
+from maroma.lab.instrumentation import as_instrumentation
+
+
+class StockDataFetchError(ValueError):
+
+    def __init__(self, failures, changed):
+        '''
+        :param failures: a dict mapping each symbol that could not be fetched to the exception it raised
+        :param changed: the symbols that were fetched and whose files changed, as fetch would have returned
+        '''
+        self.failures = failures
+        self.changed = changed
+        ValueError.__init__(self, 'fetch: could not fetch ' + str(len(failures)) + ' symbols: ' +
+                            '; '.join(symbol + ' (' + repr(error) + ')' for symbol, error in sorted(failures.items())))
+
+
+class DailyAdjustedFetcher(object):
+
+    def __init__(self, store, url_template, concurrency=4, rate_limit=None, retries=3, backoff=1.0, timeout=60.0,
+                 instrumentation=None):
+        '''
+        :param store: the StockDataStore the daily_adjusted_<SYMBOL>.csv files are written into
+        :param url_template: the url of the csv of a symbol, with {symbol} where the symbol goes, e.g.
+            'https://www.alphavantage.co/query?function=TIME_SERIES_DAILY_ADJUSTED&symbol={symbol}&datatype=csv'
+            followed by the outputsize and apikey parameters. http and https urls are supported, and up to
+            5 redirects are followed.
+        :param concurrency: the number of requests in flight at once. Each host gets at most as many connections,
+            which are kept open and reused for the next requests.
+        :param rate_limit: optional maximum number of requests started per second, e.g. the vendor's quota
+        :param retries: the number of times a request is tried again after a network error, a timeout, a 429 or
+            5xx status, or a reply that isn't a csv (the vendor answers a request over its quota with a note)
+        :param backoff: the seconds to wait before the first retry. The wait doubles with every retry.
+        :param timeout: the seconds a single request may take
+        :param instrumentation: optional maroma.lab.instrumentation.Instrumentation timing the fetch stage
+
+        Downloads the csv files of many symbols at once on an asyncio event loop, with a small HTTP/1.1
+        client of the standard library.
+        '''
+        self.__store = store
+        self.__url_template = url_template
+        self.__concurrency = concurrency
+        self.__rate_limit = rate_limit
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__timeout = timeout
+        self.__instrumentation = as_instrumentation(instrumentation)
+
+    def fetch(self, symbols):
+        '''
+        :param symbols:
+        :return: the symbols whose csv file changed
+
+        Every file is written with StockDataStore.write_symbol_csv as soon as it is downloaded: atomically, only
+        when its content changed, and with the store's binary cache of the symbol brought up to date.
+
+        Every symbol is attempted. If any of them can't be fetched a StockDataFetchError listing all of the
+        failed symbols is raised. The files of the others are written all the same.
+        '''
+
+        with self.__instrumentation.stage('fetch', symbols=len(symbols)) as record:
+
+            # the files are written on threads of a pool of the fetch, which is shut down with its loop
+            loop = asyncio.new_event_loop()
+            executor = ThreadPoolExecutor(max_workers=self.__concurrency)
+            try:
+                outcomes = loop.run_until_complete(self._fetch_all(symbols, executor))
+            finally:
+                loop.close()
+                executor.shutdown(wait=True)
+
+            failures = dict((symbol, error) for symbol, (_, error) in zip(symbols, outcomes) if error is not None)
+            changed = [symbol for symbol, (was_changed, _) in zip(symbols, outcomes) if was_changed]
+
+            record.count(changed=len(changed), failed=len(failures))
+
+        if failures:
+            raise StockDataFetchError(failures, changed)
+
+        return changed
+
+    async def _fetch_all(self, symbols, executor):
+        session = _Session(self.__concurrency, self.__timeout, self.__rate_limit)
+        try:
+            return await asyncio.gather(*[self._fetch_symbol(session, executor, symbol) for symbol in symbols])
+        finally:
+            session.close()
+
+    async def _fetch_symbol(self, session, executor, symbol):
+        '''
+        :return: (True when the file changed, None) when the symbol was fetched and (False, exception) when it
+            wasn't
+        '''
+        try:
+            content = await self._get(session, symbol)
+            # writing and parsing block, so they run on a thread while the other downloads go on
+            changed = await asyncio.get_running_loop().run_in_executor(executor, self.__store.write_symbol_csv,
+                                                                        symbol, content)
+            return changed, None
+        except Exception as error:
+            return False, error
+
+    async def _get(self, session, symbol):
+        '''
+        :return: the csv of a symbol, tried again with backoff when the request fails in a way that may pass
+        '''
+
+        url = self.__url_template.format(symbol=quote(symbol))
+
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                status, headers, content = await session.get(url)
+                if status in _REDIRECT_STATUSES and 'location' in headers and redirects < _MAX_REDIRECTS:
+                    url = urljoin(url, headers['location'])
+                    redirects += 1
+                    continue
+                if status == 200:
+                    if not content.startswith(b'timestamp'):
+                        raise ValueError('fetch: the reply for ' + symbol + ' is not a csv: ' +
+                                         repr(content[:200]))
+                    return content
+                error = IOError('fetch: HTTP status ' + str(status) + ' for ' + symbol +
+                                (' after ' + str(redirects) + ' redirects' if redirects else ''))
+                retry = status == 429 or status >= 500
+            except _RETRY_ERRORS as caught:
+                error, retry = caught, True
+
+            if not retry or attempt >= self.__retries:
+                raise error
+
+            await asyncio.sleep(self.__backoff * 2 ** attempt)
+            attempt += 1
+
+
+# network errors (timeouts are OSErrors on newer pythons), connections closed mid reply, and bad replies
+_RETRY_ERRORS = (OSError, EOFError, ValueError, asyncio.TimeoutError)
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+_MAX_REDIRECTS = 5
+
+
+class _Session(object):
+
+    def __init__(self, concurrency, timeout, rate_limit):
+        '''
+        A minimal HTTP/1.1 client. The connections of each (scheme, host, port) are kept open between requests
+        and reused. It has to be made and used on one event loop.
+        '''
+        self.__idle = {}
+        self.__slots = asyncio.Semaphore(concurrency)
+        self.__timeout = timeout
+        self.__limiter = _RateLimiter(rate_limit)
+        self.__ssl_context = None
+
+    async def get(self, url):
+        '''
+        :return status: the HTTP status of the reply
+        :return headers: a dict of its headers, by lower case name
+        :return content: the bytes of its body
+        '''
+
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        request = ('GET ' + target + ' HTTP/1.1\r\nHost: ' + parts.netloc + '\r\nUser-Agent: maroma-lab\r\n'
+                   'Connection: keep-alive\r\n\r\n').encode('latin-1')
+
+        async with self.__slots:
+            await self.__limiter.wait()
+
+            idle = self.__idle.setdefault(origin, [])
+            while idle:
+                # the server may have closed an idle connection in the meantime, then it takes a new one
+                connection = idle.pop()
+                try:
+                    return await self._exchange(origin, connection, request)
+                except (OSError, EOFError):
+                    pass
+
+            return await self._exchange(origin, await self._connect(origin), request)
+
+    async def _connect(self, origin):
+        scheme, host, port = origin
+        context = None
+        if scheme == 'https':
+            if self.__ssl_context is None:
+                self.__ssl_context = ssl.create_default_context()
+            context = self.__ssl_context
+        return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context), self.__timeout)
+
+    async def _exchange(self, origin, connection, request):
+        '''
+        Send the request on the connection and read the reply. The connection goes back to the idle ones when
+        the server keeps it open, and is closed otherwise.
+        '''
+
+        reader, writer = connection
+        try:
+            status, headers, content, keep_alive = await asyncio.wait_for(_request(reader, writer, request),
+                                                                           self.__timeout)
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive:
+            self.__idle.setdefault(origin, []).append(connection)
+        else:
+            writer.close()
+
+        return status, headers, content
+
+    def close(self):
+        for connections in self.__idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.__idle = {}
+
+
+class _RateLimiter(object):
+
+    def __init__(self, rate):
+        '''
+        :param rate: the requests per second, or None for no limit. Requests are spaced evenly.
+        '''
+        self.__interval = 0.0 if rate is None else 1.0 / rate
+        self.__next = 0.0
+
+    async def wait(self):
+        if not self.__interval:
+            return
+        now = time.monotonic()
+        start = max(now, self.__next)
+        self.__next = start + self.__interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+async def _request(reader, writer, request):
+    '''
+    :return status: the HTTP status of the reply
+    :return headers: a dict of its headers, by lower case name
+    :return content: the bytes of its body
+    :return keep_alive: True when the connection can be used for another request
+    '''
+
+    writer.write(request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise EOFError('fetch: the connection was closed before a reply')
+    version, status = status_line.decode('latin-1').split(None, 2)[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+    if int(status) in (204, 304) or int(status) < 200:
+        content = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        content = await _read_chunked(reader)
+    elif 'content-length' in headers:
+        content = await reader.readexactly(int(headers['content-length']))
+    else:
+        # the body runs to the end of the connection
+        content = await reader.read()
+        keep_alive = False
+
+    return int(status), headers, content, keep_alive
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+
+    # the trailer ends with an empty line
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+
+    return b''.join(chunks)
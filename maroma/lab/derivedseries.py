@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from maroma.lab.stockpanel import StockPanel
+from maroma.lab.volumechanges import volume_changes
+
+
+class DerivedSeries(object):
+
+    def __init__(self, panel):
+        '''
+        :param panel: a StockPanel
+
+        The series derived from a panel: daily returns, log returns and volume changes, as (days x symbols)
+        arrays aligned with the panel. Each one is computed the first time it is asked for and kept, so
+        calculators and studies given the same DerivedSeries share it. The arrays are read-only; they are
+        never copied out to callers, and nobody can change them under the others.
+
+        Two threads asking for the same series at once may both compute it. The results are the same.
+        '''
+        self.panel = panel
+        self.__memo = {}
+
+    @property
+    def dates(self):
+        return self.panel.dates
+
+    @property
+    def symbols(self):
+        return self.panel.symbols
+
+    def returns(self, key='adjusted_close', padded=False):
+        '''
+        :param key: the field of the prices
+        :param padded: if True a missing price is taken to be the last one before it, as pandas' pct_change
+            does, so the move over a gap shows up on the day after it. Otherwise the returns next to a missing
+            price are missing too.
+        :return: the (days x symbols) array of daily returns. The first day and the missing returns are 0.
+        '''
+
+        def compute():
+            prices = self.panel.field(key)
+            if padded:
+                prices = _forward_fill(prices)
+            return _zero_filled(daily_returns(prices))
+
+        return self._memoized(('returns', key, padded), compute)
+
+    def log_returns(self, key='adjusted_close', padded=False):
+        '''
+        :return: the (days x symbols) array of daily log returns, see returns. The first day and the missing
+            returns are 0.
+        '''
+        return self._memoized(('log_returns', key, padded), lambda: np.log1p(self.returns(key, padded)))
+
+    def volume_changes(self, transform='mean_adjusted', window=5, key='volume'):
+        '''
+        :param transform: see maroma.lab.volumechanges.volume_changes
+        :param window: see maroma.lab.volumechanges.volume_changes
+        :param key: the field of the volumes
+        :return: the (days x symbols) array of volume changes. The days without one are 0.
+        '''
+        return self._memoized(('volume_changes', key, transform, window),
+                              lambda: _zero_filled(volume_changes(self.panel.field(key), transform, window)))
+
+    def select(self, symbols):
+        '''
+        :param symbols: some of the symbols, in the order wanted
+        :return: a DerivedSeries of only those columns. The series already computed here are carried over.
+        '''
+
+        columns = self.panel.symbol_positions(symbols)
+        panel = StockPanel(self.dates, symbols, dict((key, values[:, columns])
+                                                     for key, values in self.panel.fields.items()))
+
+        selected = DerivedSeries(panel)
+        for name, values in self.__memo.items():
+            selected.__memo[name] = _read_only(values[:, columns])
+        return selected
+
+    def _memoized(self, name, compute):
+        values = self.__memo.get(name)
+        if values is None:
+            values = _read_only(compute())
+            self.__memo[name] = values
+        return values
+
+
+def as_derived_series(stock_data, calendar_symbol=None, key='adjusted_close'):
+    '''
+    :param stock_data: a DerivedSeries, a StockPanel, a multi-index dataframe or series as returned by
+        StockDataStore.get_stock_data, or a dataframe with datetime indices and columns of stock symbols
+    :param calendar_symbol: the symbol whose dates are the trading calendar of a multi-index dataframe
+    :param key: the field the values of a series or of a dataframe of symbols are, e.g. the prices
+    :return: a DerivedSeries. A DerivedSeries is returned as it is, so what it already computed is reused.
+    '''
+
+    if isinstance(stock_data, DerivedSeries):
+        return stock_data
+
+    if isinstance(stock_data, StockPanel):
+        return DerivedSeries(stock_data)
+
+    if isinstance(stock_data, pd.Series):
+        return DerivedSeries(StockPanel.from_frame(stock_data.to_frame(key), calendar_symbol))
+
+    if isinstance(stock_data.index, pd.MultiIndex):
+        return DerivedSeries(StockPanel.from_frame(stock_data, calendar_symbol))
+
+    return DerivedSeries(StockPanel(stock_data.index, stock_data.columns,
+                                    {key: np.asarray(stock_data.values, dtype=float)}))
+
+
+def daily_returns(prices):
+    '''
+    :param prices: a (days x symbols) array of prices
+    :return: the (days x symbols) array of daily returns. The first day is nan.
+    '''
+
+    prices = np.asarray(prices, dtype=float)
+    returns = np.empty(prices.shape)
+    returns[0] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns[1:] = prices[1:] / prices[:-1] - 1
+
+    return returns
+
+
+def _forward_fill(values):
+    '''
+    :return: values with each nan replaced by the last value above it in its column. Leading nans stay.
+    '''
+
+    values = np.asarray(values, dtype=float)
+    found = ~np.isnan(values)
+    if found.all():
+        return values
+
+    last = np.where(found, np.arange(len(values))[:, np.newaxis], 0)
+    np.maximum.accumulate(last, axis=0, out=last)
+    return values[last, np.arange(values.shape[1])]
+
+
+def _zero_filled(values):
+    values = np.array(values, dtype=float)
+    values[np.isnan(values)] = 0
+    return values
+
+
+def _read_only(values):
+    values.flags.writeable = False
+    return values
@@ -7,18 +7,22 @@ class EventMatrix(object):
         '''
         :param datetimes:
         :param symbols:
-        Constructs A pandas dataframe indexed by datetimes and with columns for each symbol.
-        The constructor fills this with all NANs and an abstract base method exists to be customized.
+        Constructs an empty event matrix for the datetimes and symbols. An abstract base method exists to be customized.
+
+        Events are stored sparsely, as (date position, symbol position, weight) arrays sorted by date and then
+        by symbol. An event counts whatever its weight, in this class and in the calculators given the dataframe
+        of event_matrix, where every cell that isn't NAN is an event. The pandas dataframe indexed by datetimes and
+        with columns for each symbol (NANs everywhere but at the events) is only built when event_matrix is read.
+        It is cached until the events change and every read returns a copy of it, so changing the returned
+        dataframe doesn't change the rows, cols and weights; assign it back to event_matrix for that.
         '''
 
-        # Build an empty event matrix with an index of all the datetimes and columns for each symbol.
-        # Fill with NANs
-        self.event_matrix = pd.DataFrame({'Date': datetimes})
-        self.event_matrix = self.event_matrix.set_index('Date')
-        self.event_matrix.tz_localize(tz='America/New_York')
-        self.symbols = symbols
-        for symbol in self.symbols:
-            self.event_matrix[symbol] = np.nan
+        self.datetimes = pd.DatetimeIndex(datetimes, name='Date')
+        self.symbols = list(symbols)
+        self.rows = np.zeros(0, dtype=int)
+        self.cols = np.zeros(0, dtype=int)
+        self.weights = np.zeros(0)
+        self.__dense = None
 
     def build_event_matrix(self, start_date, end_date):
         '''
@@ -29,3 +33,158 @@ class EventMatrix(object):
         '''
         raise NotImplementedError("Please Implement this method in a base class")
 
+    def add_events(self, rows, cols=None, weights=None):
+        '''
+        :param rows: the date position of each event
+        :param cols: the symbol position of each event, or None to put each event on every symbol
+        :param weights: optional weight of each event, 1 by default
+        An event added to a (date, symbol) that already has one replaces it.
+        '''
+
+        rows = np.asarray(rows, dtype=int).ravel()
+        if weights is None:
+            weights = np.ones(len(rows))
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), rows.shape)
+
+        if cols is None:
+            num_symbols = len(self.symbols)
+            cols = np.tile(np.arange(num_symbols), len(rows))
+            rows = np.repeat(rows, num_symbols)
+            weights = np.repeat(weights, num_symbols)
+        cols = np.asarray(cols, dtype=int).ravel()
+
+        if ((rows < 0) | (rows >= len(self.datetimes)) | (cols < 0) | (cols >= len(self.symbols))).any():
+            raise ValueError('add_events: event positions outside of the event matrix')
+
+        rows = np.concatenate((self.rows, rows))
+        cols = np.concatenate((self.cols, cols))
+        weights = np.concatenate((self.weights, weights))
+
+        # Sort by date and then symbol. Of duplicates keep the one added last.
+        keys = rows * len(self.symbols) + cols
+        _, last = np.unique(keys[::-1], return_index=True)
+        keep = len(keys) - 1 - last
+
+        self.rows = rows[keep]
+        self.cols = cols[keep]
+        self.weights = weights[keep]
+        self.__dense = None
+
+    def add_dated_events(self, events, date_column='Date', symbol_column=None, weight_column=None, value_column=None,
+                         value_threshold=None, max_value=None, start_date=None, end_date=None):
+        '''
+        :param events: a dataframe of raw events, one per row
+        :param date_column: the column with the date of each event
+        :param symbol_column: the column with the symbol of each event. If None every event is put on every symbol.
+        :param weight_column: optional column with the weight of each event
+        :param value_column: the column value_threshold and max_value are applied to
+        :param value_threshold: only keep events whose value is at least this
+        :param max_value: only keep events whose value is at most this
+        :param start_date: only keep events on or after this date
+        :param end_date: only keep events on or before this date
+        :return: the number of (date, symbol) events added
+
+        Events that don't fall on a trading day are put on the first trading day after. All events are snapped to
+        the calendar with one searchsorted call and filtered with array masks, so this costs O(events).
+        Events after the last trading day and events on unknown symbols are dropped.
+        '''
+
+        if not self.datetimes.is_monotonic_increasing:
+            raise ValueError('add_dated_events: the datetimes of the event matrix must be sorted')
+
+        dates = pd.DatetimeIndex(pd.to_datetime(events[date_column]))
+        keep = np.ones(len(events), dtype=bool)
+
+        if start_date is not None:
+            keep &= dates >= pd.Timestamp(start_date)
+        if end_date is not None:
+            keep &= dates <= pd.Timestamp(end_date)
+        if value_threshold is not None or max_value is not None:
+            values = np.asarray(events[value_column], dtype=float)
+            if value_threshold is not None:
+                keep &= values >= value_threshold
+            if max_value is not None:
+                keep &= values <= max_value
+
+        # find the trading day equal to it or after it
+        rows = self.datetimes.searchsorted(dates)
+        keep &= rows < len(self.datetimes)
+
+        cols = None
+        if symbol_column is not None:
+            cols = pd.Index(self.symbols).get_indexer(events[symbol_column])
+            keep &= cols >= 0
+            cols = cols[keep]
+
+        weights = None
+        if weight_column is not None:
+            weights = np.asarray(events[weight_column], dtype=float)[keep]
+
+        num_events = self.num_events
+        self.add_events(rows[keep], cols, weights)
+
+        return self.num_events - num_events
+
+    @property
+    def num_events(self):
+        '''
+        :return: the number of (date, symbol) events
+        '''
+        return len(self.rows)
+
+    def event_dates(self):
+        '''
+        :return: the datetimes on which at least one symbol has an event, of any weight
+        '''
+        return self.datetimes[np.unique(self.rows)]
+
+    def event_positions(self, datetimes=None, symbols=None):
+        '''
+        :param datetimes: the calendar to place the events on. Defaults to the event matrix's own.
+        :param symbols: the symbols to place the events on. Defaults to the event matrix's own.
+        :return rows, cols, weights: the events that fall on the datetimes and symbols, with their positions
+            there, sorted by date and then symbol. Events of any weight are returned.
+        '''
+
+        rows, cols, weights = self.rows, self.cols, self.weights
+
+        if datetimes is not None:
+            rows = pd.DatetimeIndex(datetimes).get_indexer(self.datetimes[rows])
+        if symbols is not None:
+            cols = pd.Index(symbols).get_indexer(pd.Index(self.symbols)[cols])
+
+        found = (rows >= 0) & (cols >= 0)
+        rows, cols, weights = rows[found], cols[found], weights[found]
+
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order], weights[order]
+
+    @property
+    def event_matrix(self):
+        '''
+        :return: a dense pandas dataframe indexed by datetimes and with columns for each symbol. Each cell holds
+        the event's weight (1 by default) if there was an event for that datetime and symbol, and NAN otherwise.
+        The dataframe is a copy; change events with add_events or by assigning a dataframe to event_matrix.
+        '''
+
+        if self.__dense is None:
+            values = np.full((len(self.datetimes), len(self.symbols)), np.nan)
+            values[self.rows, self.cols] = self.weights
+            self.__dense = pd.DataFrame(values, index=self.datetimes, columns=self.symbols)
+
+        return self.__dense.copy()
+
+    @event_matrix.setter
+    def event_matrix(self, dense):
+        '''
+        Replace the events with the non-NAN cells of a dataframe indexed by the datetimes, with a column for each
+        symbol.
+        '''
+
+        dense = dense.reindex(index=self.datetimes, columns=self.symbols)
+        rows, cols = np.nonzero(np.logical_not(np.isnan(dense.values)))
+
+        self.rows = np.zeros(0, dtype=int)
+        self.cols = np.zeros(0, dtype=int)
+        self.weights = np.zeros(0)
+        self.add_events(rows, cols, dense.values[rows, cols])
@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+
+from maroma.lab.abnormalreturns import MarketModel
+from maroma.lab.calculator import (CarsCavcsResult, MarketModelFits, StudyData, event_dates, excess_windows,
+                                   fit_market_models, stock_window_tests, window_t_test)
+from maroma.lab.stockpanel import StockPanel, as_panel
+
+
+class RunningMoments(object):
+
+    def __init__(self, shape):
+        '''
+        :param shape: the shape of the values that are added
+
+        The count, mean and variance of the values added so far, updated one value at a time with Welford's
+        method, so nothing that was added needs to be kept.
+        '''
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, values):
+        self.count += 1
+        delta = values - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (values - self.mean)
+
+    @property
+    def std(self):
+        '''
+        :return: the standard deviation of the values added, with ddof=0 like np.std
+        '''
+        return np.sqrt(self.m2 / self.count)
+
+
+class IncrementalEventStudy(object):
+
+    def __init__(self, stock_data, market_symbol, estimation_window=200, buffer=5, pre_event_window=10,
+                 post_event_window=10, per_event_estimation=False, volume_transform='mean_adjusted', volume_window=5,
+                 model=None):
+        '''
+        :param stock_data: a StockPanel or a multi-index dataframe with adjusted_close and volume columns
+        :param market_symbol:
+        The other parameters are those of Calculator.calculate_cars_cavcs.
+
+        An event study that is kept up to date as bars and events come in, see append_bars and add_events.
+        An event is added to the statistics once the bars of its whole event window are in. Only running sums
+        are kept for the events already added, and only the bars still needed by the events to come, so the
+        cost of an update doesn't grow with the history.
+
+        The results are those of calculate_cars_cavcs on all of the bars and events, up to rounding.
+        '''
+
+        panel = as_panel(stock_data, market_symbol)
+
+        if market_symbol not in panel.symbols:
+            raise ValueError('IncrementalEventStudy: market_symbol not found in data')
+
+        if model is None:
+            model = MarketModel()
+
+        self.__market_symbol = market_symbol
+        self.__symbols = panel.symbols
+        self.__stocks = [x for x in panel.symbols if x != market_symbol and x not in model.factors]
+        self.__dates = panel.dates
+        self.__closes = np.asarray(panel.field('adjusted_close'), dtype=float)
+        self.__volumes = np.asarray(panel.field('volume'), dtype=float)
+
+        self.__estimation_window = estimation_window
+        self.__buffer = buffer
+        self.__pre_event_window = pre_event_window
+        self.__post_event_window = post_event_window
+        self.__per_event_estimation = per_event_estimation
+        self.__volume_transform = volume_transform
+        self.__volume_window = volume_window
+        self.__model = model
+
+        # the bars kept before the first event still to come: the estimation window, the pre event window,
+        # and the days the returns and the volume transform look back
+        self.__lookback = max(buffer + estimation_window, pre_event_window) + volume_window + 1
+
+        window_length = pre_event_window + post_event_window + 1
+
+        self.__pending = []
+        self.__seen = set()
+        self.__added = []
+        self.__first_fits = None
+
+        # the cross-stock mean of each event, per day of the window
+        self.__cars = RunningMoments(window_length)
+        self.__cavcs = RunningMoments(window_length)
+
+        # the sum over events of each stock, per day of the window
+        self.__stock_cars = np.zeros((len(self.__stocks), window_length))
+        self.__stock_cavcs = np.zeros((len(self.__stocks), window_length))
+
+    @property
+    def num_events(self):
+        '''
+        :return: the number of events in the statistics. Events whose window isn't complete yet are not counted.
+        '''
+        return self.__cars.count
+
+    @property
+    def pending_events(self):
+        '''
+        :return: the dates of the events waiting for the bars of their window
+        '''
+        return pd.DatetimeIndex(self.__pending)
+
+    def append_bars(self, stock_data):
+        '''
+        :param stock_data: a StockPanel or a multi-index dataframe with the new bars of every symbol. Bars on
+            or before the last bar already in are ignored.
+        :return: the number of events added to the statistics
+        '''
+
+        panel = as_panel(stock_data, self.__market_symbol)
+
+        new = panel.dates > self.__dates[-1]
+        if not new.any():
+            return 0
+
+        columns = panel.symbol_positions(self.__symbols)
+        closes = np.asarray(panel.field('adjusted_close'), dtype=float)[new][:, columns]
+        volumes = np.asarray(panel.field('volume'), dtype=float)[new][:, columns]
+
+        self.__dates = self.__dates.append(panel.dates[new])
+        self.__closes = np.concatenate((self.__closes, closes))
+        self.__volumes = np.concatenate((self.__volumes, volumes))
+
+        return self._update()
+
+    def add_events(self, event_matrix):
+        '''
+        :param event_matrix: an EventMatrix, or a dataframe with the weight of each event (e.g. 1)
+            on its (date, symbol) and nan elsewhere. As in calculate_cars_cavcs every stock is studied around every
+            date on which any symbol had an event.
+            Events may be later than the last bar; they wait for their bars. As it isn't known yet whether such a
+            date will be a trading day, it is moved to the first bar on or after it when that bar comes in.
+            Dates already added are ignored.
+        :return: the number of events added to the statistics
+
+        The dates are checked before any of them is added, so the study is unchanged when a ValueError is raised.
+        '''
+
+        events = [date for date in event_dates(event_matrix) if date not in self.__seen]
+
+        if events:
+            dates = self.__dates
+            positions = dates.searchsorted(events)
+            within = positions < len(dates)
+
+            if min(events) < dates[0]:
+                raise ValueError('IncrementalEventStudy: events before the bars that are kept')
+
+            if not (dates[positions[within]] == pd.DatetimeIndex(events)[within]).all():
+                raise ValueError('IncrementalEventStudy: event dates must be trading days of the market symbol')
+
+            if positions.min() - (self.__buffer + self.__estimation_window) + 1 < 0:
+                raise ValueError('IncrementalEventStudy: not enough data before the events for the estimation window')
+
+        self.__seen.update(events)
+        self.__pending = sorted(self.__pending + events)
+
+        return self._update()
+
+    def result(self):
+        '''
+        :return cars_cavcs_result: An instance of CarsCavcsResult of the events added so far. The abnormal values
+            of each event aren't kept, so it has the statistics of each stock but not abnormal_returns,
+            abnormal_volume_changes and the standardized tests.
+        '''
+
+        if self.num_events == 0:
+            raise ValueError('IncrementalEventStudy: zero events with a complete window')
+
+        window_length = self.__pre_event_window + self.__post_event_window + 1
+
+        cars = self.__cars.mean
+        cars_t_test, cars_significant = window_t_test(np.mean(cars), np.std(cars), window_length, self.num_events)
+
+        cavcs = self.__cavcs.mean
+        cavcs_t_test, cavcs_significant = window_t_test(np.mean(cavcs), np.std(cavcs), window_length,
+                                                        self.num_events)
+
+        # the mean of each stock over the events, per day of the window
+        stock_cars = self.__stock_cars / self.num_events
+        stock_cavcs = self.__stock_cavcs / self.num_events
+
+        (stock_cars_positive, stock_cars_t_tests, stock_cars_p_values,
+         stock_cars_significant) = stock_window_tests(stock_cars, window_length)
+        (stock_cavcs_positive, stock_cavcs_t_tests, stock_cavcs_p_values,
+         stock_cavcs_significant) = stock_window_tests(stock_cavcs, window_length)
+
+        return CarsCavcsResult(self.num_events,
+                               np.cumprod(cars + 1, axis=0), self.__cars.std, cars_t_test, cars_significant,
+                               bool(np.mean(cars) > 0), int(stock_cars_positive.sum()),
+                               int(np.logical_not(stock_cars_positive).sum()),
+                               np.cumsum(cavcs, axis=0), self.__cavcs.std, cavcs_t_test, cavcs_significant,
+                               bool(np.mean(cavcs) > 0), int(stock_cavcs_positive.sum()),
+                               int(np.logical_not(stock_cavcs_positive).sum()),
+                               self.__first_fits.cars_regressions, self.__first_fits.cavcs_regressions,
+                               stocks=self.__stocks, event_dates=pd.DatetimeIndex(self.__added).values,
+                               stock_cars_t_tests=stock_cars_t_tests, stock_cars_significant=stock_cars_significant,
+                               stock_cars_positive=stock_cars_positive, stock_cavcs_t_tests=stock_cavcs_t_tests,
+                               stock_cavcs_significant=stock_cavcs_significant,
+                               stock_cavcs_positive=stock_cavcs_positive,
+                               cars_num_stocks_significant=int(stock_cars_significant.sum()),
+                               cavcs_num_stocks_significant=int(stock_cavcs_significant.sum()),
+                               stock_cars_p_values=stock_cars_p_values, stock_cavcs_p_values=stock_cavcs_p_values)
+
+    def _update(self):
+        '''
+        Add the events whose windows are complete to the statistics and drop the bars no event needs any more.
+        :return: the number of events added
+        '''
+
+        self._snap_pending()
+
+        dates = self.__dates
+        positions = dates.searchsorted(self.__pending)
+
+        ready = positions + self.__post_event_window < len(dates)
+        events = pd.DatetimeIndex(self.__pending)[ready]
+
+        if len(events):
+
+            panel = StockPanel(dates, self.__symbols, {'adjusted_close': self.__closes, 'volume': self.__volumes})
+            study = StudyData(panel, self.__market_symbol, self.__volume_transform, self.__volume_window,
+                              factors=self.__model.factors)
+
+            positions = study.event_positions(events, self.__pre_event_window, self.__post_event_window)
+
+            if positions[0] - (self.__buffer + self.__estimation_window) + 1 < 0:
+                raise ValueError('IncrementalEventStudy: not enough data before the events for the estimation window')
+
+            fits = self._fits(study, positions)
+
+            ccarray, cvarray = excess_windows(study, positions, fits,
+                                              self.__pre_event_window, self.__post_event_window)
+
+            for event in range(len(positions)):
+                self.__cars.add(np.mean(ccarray[:, event], axis=0))
+                self.__cavcs.add(np.mean(cvarray[:, event], axis=0))
+
+            self.__stock_cars += ccarray.sum(axis=1)
+            self.__stock_cavcs += cvarray.sum(axis=1)
+
+            self.__added.extend(events)
+
+            self.__pending = [date for date, done in zip(self.__pending, ready) if not done]
+
+        # keep the bars from the lookback of the next event on, or of a new event on the last bar
+
+        next_position = len(dates)
+        if self.__pending:
+            next_position = min(next_position, dates.searchsorted(self.__pending[0]))
+
+        first = max(next_position - self.__lookback, 0)
+        if first > 0:
+            self.__dates = self.__dates[first:]
+            self.__closes = self.__closes[first:]
+            self.__volumes = self.__volumes[first:]
+
+        return len(events)
+
+    def _snap_pending(self):
+        '''
+        Move the pending events on days the bars skipped to the next bar. An event moved to a bar that already
+        has one is dropped.
+        '''
+
+        dates = self.__dates
+        positions = dates.searchsorted(self.__pending)
+
+        pending = []
+        for date, position in zip(self.__pending, positions):
+            if position < len(dates) and dates[position] != date:
+                date = dates[position]
+                if date in self.__seen:
+                    continue
+                self.__seen.add(date)
+            pending.append(date)
+
+        self.__pending = pending
+
+    def _fits(self, study, positions):
+        '''
+        :return: the MarketModelFits of the events. Without per event estimation every event uses the fit
+            before the very first event, which is kept.
+        '''
+
+        fits = fit_market_models(study, positions, self.__estimation_window, self.__buffer,
+                                 self.__per_event_estimation, model=self.__model)
+
+        if self.__first_fits is None:
+            self.__first_fits = fits
+
+        if self.__per_event_estimation:
+            return fits
+
+        first = self.__first_fits
+        shape = (len(positions), len(self.__stocks))
+
+        cars_factor_slopes = None
+        if first.cars_regressions.factor_slopes is not None:
+            cars_factor_slopes = np.broadcast_to(first.cars_regressions.factor_slopes,
+                                                 (len(positions),) + first.cars_regressions.factor_slopes.shape)
+
+        return MarketModelFits(np.broadcast_to(first.cars_regressions.slopes, shape),
+                               np.broadcast_to(first.cars_regressions.intercepts, shape),
+                               np.broadcast_to(first.cavcs_regressions.slopes, shape),
+                               np.broadcast_to(first.cavcs_regressions.intercepts, shape),
+                               first.cars_regressions, first.cavcs_regressions, cars_factor_slopes)
@@ -0,0 +1,179 @@
+import json
+import logging
+import time
+import tracemalloc
+
+
+class StageRecord(object):
+
+    def __init__(self, name, counts=None):
+        '''
+        :param name: the stage, e.g. load, returns, volume_changes, regression, windows or statistics
+        :param counts: a dict of sizes of what the stage worked on, e.g. symbols, days or events
+        '''
+        self.name = name
+        self.counts = dict(counts or {})
+        self.seconds = None
+        self.peak_bytes = None
+
+    def count(self, **counts):
+        '''
+        Record sizes that are only known once the stage is running.
+        '''
+        self.counts.update(counts)
+
+    def to_dict(self):
+        return {'stage': self.name, 'seconds': self.seconds, 'peak_bytes': self.peak_bytes, 'counts': self.counts}
+
+    def __repr__(self):
+        text = self.name + ': ' + '%.6f' % self.seconds + 's'
+        if self.peak_bytes is not None:
+            text += ', peak ' + '%.1f' % (self.peak_bytes / 2.0 ** 20) + 'MB'
+        for key, value in sorted(self.counts.items()):
+            text += ', ' + key + '=' + str(value)
+        return text
+
+
+class Instrumentation(object):
+
+    def __init__(self, hooks=None, trace_memory=False):
+        '''
+        :param hooks: functions called with the StageRecord of every stage when it ends, e.g. logging_hook()
+            or a JsonSink
+        :param trace_memory: if True the peak of the memory allocated by each stage is recorded too, with
+            tracemalloc. Tracing makes allocations slower, so it is off by default.
+
+        Times the stages of Calculator and StockDataStore runs. Pass it to their constructors.
+        Stages are not nested.
+        '''
+        self.hooks = list(hooks or [])
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def stage(self, name, **counts):
+        '''
+        :return: a context manager timing a stage. It gives the StageRecord, to add counts to.
+        '''
+        return _Stage(self, StageRecord(name, counts))
+
+    def since(self, mark):
+        '''
+        :param mark: a len(records) taken earlier
+        :return: the records of the stages that ended since
+        '''
+        return self.records[mark:]
+
+    def _end(self, record):
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+
+class NullInstrumentation(object):
+    '''
+    Instrumentation that records nothing, used when none is given. Its stages cost an attribute lookup
+    and a call.
+    '''
+
+    hooks = ()
+    trace_memory = False
+    records = ()
+
+    def stage(self, name, **counts):
+        return _NULL_STAGE
+
+    def since(self, mark):
+        return []
+
+
+class _Stage(object):
+
+    def __init__(self, instrumentation, record):
+        self.__instrumentation = instrumentation
+        self.__record = record
+        self.__traced = False
+
+    def __enter__(self):
+        if self.__instrumentation.trace_memory:
+            self.__traced = not tracemalloc.is_tracing()
+            if self.__traced:
+                tracemalloc.start()
+            self.__start_bytes = tracemalloc.get_traced_memory()[0]
+            _reset_peak()
+        self.__start = time.perf_counter()
+        return self.__record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = self.__record
+        record.seconds = time.perf_counter() - self.__start
+        if self.__instrumentation.trace_memory:
+            record.peak_bytes = max(tracemalloc.get_traced_memory()[1] - self.__start_bytes, 0)
+            if self.__traced:
+                tracemalloc.stop()
+        if exc_type is None:
+            self.__instrumentation._end(record)
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return _NULL_RECORD
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _NullRecord(object):
+
+    def count(self, **counts):
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+_NULL_STAGE = _NullStage()
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def as_instrumentation(instrumentation):
+    '''
+    :return: instrumentation, or NULL_INSTRUMENTATION when it is None
+    '''
+    if instrumentation is None:
+        return NULL_INSTRUMENTATION
+    return instrumentation
+
+
+def logging_hook(logger=None, level=logging.INFO):
+    '''
+    :return: a hook that logs every stage on one line
+    '''
+
+    if logger is None:
+        logger = logging.getLogger('maroma.lab')
+
+    def hook(record):
+        logger.log(level, 'stage %r', record)
+
+    return hook
+
+
+class JsonSink(object):
+
+    def __init__(self, file_name):
+        '''
+        :param file_name: the file to append to. Every stage is written as one line of json.
+        '''
+        self.file_name = file_name
+
+    def __call__(self, record):
+        with open(self.file_name, 'a') as f:
+            f.write(json.dumps(record.to_dict(), sort_keys=True) + '\n')
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak only exists from python 3.9. Before that the peak is the peak since tracing started.
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
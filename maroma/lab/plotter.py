@@ -1,4 +1,12 @@
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import matplotlib.image
 import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
 
 
 class Plotter(object):
@@ -12,6 +20,9 @@ class Plotter(object):
 
     def plot_car(self, car, std_err, num_events, look_back, look_forward, show=True, pdf_filename=None):
 
+        car = np.asarray(car)
+        std_err = np.asarray(std_err)
+
         # plotting
         li_time = list(range(-look_back, look_forward + 1))
         # print(li_time)
@@ -21,7 +32,7 @@ class Plotter(object):
         plt.grid()
         plt.axhline(y=1.0, xmin=-look_back, xmax=look_forward, color='k')
         plt.errorbar(li_time[look_back:], car[look_back:],
-                     yerr=std_err[look_back:], ecolor='#AAAAFF',
+                     yerr=std_err[..., look_back:], ecolor='#AAAAFF',
                      alpha=0.7)
         plt.plot(li_time, car, linewidth=1, label='mean', color='b')
         plt.xlim(-look_back - 1, look_forward + 1)
@@ -34,6 +45,16 @@ class Plotter(object):
             plt.show()
 
     def plot_car_cavcs(self, num_events, car, std_err1, cavcs, std_err2, look_back, look_forward, show=True, pdf_filename=None ):
+        '''
+        std_err1 and std_err2 are either the standard errors of the CARs and CAVCs, or (2 x window) arrays of
+        the distances below and above them, e.g. the cars_yerr and cavcs_yerr of a resampling.ResamplingResult.
+        Lists work as well as arrays.
+        '''
+
+        car = np.asarray(car)
+        std_err1 = np.asarray(std_err1)
+        cavcs = np.asarray(cavcs)
+        std_err2 = np.asarray(std_err2)
 
         #printing some Output
         li_time = list(range(-look_back, look_forward + 1))
@@ -48,7 +69,7 @@ class Plotter(object):
         plt.grid()
         plt.axhline(y=1.0, xmin=-look_back, xmax=look_forward, color='k')
         plt.errorbar(li_time[look_back:], car[look_back:],
-                    yerr=std_err1[look_back:], ecolor='#AAAAFF',
+                    yerr=std_err1[..., look_back:], ecolor='#AAAAFF',
                     alpha=0.7)
         ax1.plot(li_time, car, linewidth=1, label='mean', color='b')
         plt.xlim(-look_back - 1, look_forward + 1)
@@ -62,8 +83,8 @@ class Plotter(object):
         ax2 = plt.subplot(212)
         plt.grid()
         plt.axhline(y=1.0, xmin=-look_back, xmax=look_forward, color='k')
-        plt.errorbar(li_time[look_back:], car[look_back:],
-                     yerr=std_err2[look_back:], ecolor='#AAAAFF',
+        plt.errorbar(li_time[look_back:], cavcs[look_back:],
+                     yerr=std_err2[..., look_back:], ecolor='#AAAAFF',
                      alpha=0.7)
         ax2.plot(li_time, cavcs, linewidth=1, label='mean', color='b')
         plt.xlim(-look_back - 1, look_forward + 1)
@@ -77,4 +98,112 @@ class Plotter(object):
         if show:
             plt.show()
 
+    def plot_regressions(self, cars_cavcs_result, pdf_filename, processes=None, chunk_size=16, dpi=100):
+        '''
+        :param cars_cavcs_result: the CarsCavcsResult of Calculator.calculate_cars_cavcs
+        :param pdf_filename: the multi-page pdf to write, with one page per stock
+        :param processes: the number of worker processes drawing pages. None draws them in this process.
+        :param chunk_size: the number of stocks each worker draws at a time
+        :param dpi: the resolution of the pages drawn by worker processes
+
+        Draws the market model regressions of the returns and of the volume changes of every stock, without
+        touching the pyplot figures. Pages drawn in this process are vector graphics. Worker processes draw
+        their pages off screen with the Agg backend and send them back as png images, so with processes the
+        pages are raster images of dpi dots per inch.
+        '''
+
+        cars_regressions = cars_cavcs_result.cars_regressions
+        cavcs_regressions = cars_cavcs_result.cavcs_regressions
+        width, height = plt.rcParams['figure.figsize']
+
+        chunks = []
+        for start in range(0, len(cars_regressions.symbols), chunk_size):
+            stop = start + chunk_size
+            chunks.append((_regression_pages(cars_regressions, start, stop),
+                           _regression_pages(cavcs_regressions, start, stop), width, height, dpi))
+
+        with PdfPages(pdf_filename) as pdf:
+            if processes is None:
+                for cars_pages, cavcs_pages, _, _, _ in chunks:
+                    for cars_page, cavcs_page in zip(cars_pages, cavcs_pages):
+                        figure = Figure(figsize=(width, height))
+                        FigureCanvasAgg(figure)
+                        _draw_regression_page(figure, cars_page, cavcs_page)
+                        pdf.savefig(figure)
+            else:
+                with ProcessPoolExecutor(max_workers=processes) as pool:
+                    pages = (page for rendered in pool.map(_render_regression_pages, chunks) for page in rendered)
+                    _write_pages(pdf, pages, width, height)
+
+
+def _regression_pages(regressions, start, stop):
+    '''
+    :return: a list with the (symbol, x, y, fitted line, cumulative excess) of the stocks start:stop. With
+        factors besides the market the fit isn't a line over the market values, so x is then the fitted values
+        of the whole model and the line is the diagonal, where a stock's values would be if the model explained
+        them all.
+    '''
+
+    cumulative_excess = regressions.cumulative_excess()
+    fitted_values = regressions.y - regressions.excess()
+
+    pages = []
+    for i in range(start, min(stop, len(regressions.symbols))):
+        if regressions.factor_slopes is None:
+            x = regressions.x
+            fitted = regressions.slopes[i] * x + regressions.intercepts[i]
+        else:
+            x = fitted_values[:, i]
+            fitted = x
+        pages.append((regressions.symbols[i], x, regressions.y[:, i], fitted, cumulative_excess[:, i]))
+
+    return pages
+
+
+def _render_regression_pages(chunk):
+    '''
+    :param chunk: (cars pages, cavcs pages, width, height, dpi)
+    :return: a list with one png image (as bytes) per stock
+    '''
+
+    cars_pages, cavcs_pages, width, height, dpi = chunk
+
+    images = []
+    for cars_page, cavcs_page in zip(cars_pages, cavcs_pages):
+        figure = Figure(figsize=(width, height), dpi=dpi)
+        canvas = FigureCanvasAgg(figure)
+        _draw_regression_page(figure, cars_page, cavcs_page)
+
+        image = BytesIO()
+        canvas.print_png(image)
+        images.append(image.getvalue())
+
+    return images
+
+
+def _draw_regression_page(figure, cars_page, cavcs_page):
+    '''
+    Draw the regressions of one stock on a figure: those of the returns on the left and of the volume changes
+    on the right, each above its cumulative excess.
+    '''
+
+    for column, (symbol, x, y, fitted, cumulative_excess), label in ((0, cars_page, 'returns'),
+                                                                     (1, cavcs_page, 'volume changes')):
+        ax1 = figure.add_subplot(2, 2, column + 1)
+        ax1.set_title('Regression of ' + label + ' for stock: ' + symbol)
+        ax1.plot(x, y, 'o', label='Original data', markersize=4)
+        ax1.plot(x, fitted, 'r', label='Fitted line')
+        ax1.legend()
+
+        ax2 = figure.add_subplot(2, 2, column + 3)
+        ax2.plot(cumulative_excess, label='excess ' + label)
+        ax2.legend()
+
 
+def _write_pages(pdf, images, width, height):
+    for image in images:
+        pixels = matplotlib.image.imread(BytesIO(image), format='png')
+        page = Figure(figsize=(width, height), dpi=pixels.shape[0] / float(height))
+        FigureCanvasAgg(page)
+        page.figimage(pixels, 0, 0)
+        pdf.savefig(page)
@@ -0,0 +1,261 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from maroma.lab.abnormalreturns import MarketModel
+from maroma.lab.calculator import StudyData, event_dates, excess_windows, fit_market_models
+
+
+class ResamplingResult(object):
+    def __init__(self, num_resamples, confidence, cars, cars_bands, cavcs, cavcs_bands, cars_p_value=None,
+                 cavcs_p_value=None):
+        '''
+        :param num_resamples: the number of resamples drawn
+        :param confidence: the confidence level of the bands, e.g. .95
+        :param cars: time series of Cumulative Abnormal Return of the events
+        :param cars_bands: 2-d array (2 x window) with the lower and upper bound of the band of the CARs
+        :param cavcs: time series of Cumulative Abnormal Volume Changes of the events
+        :param cavcs_bands: 2-d array (2 x window) with the lower and upper bound of the band of the CAVCs
+        :param cars_p_value: for placebo tests, the share of placebos whose final CAR is at least as far from 0
+        :param cavcs_p_value: for placebo tests, the share of placebos whose final CAVC is at least as far from 0
+        '''
+        self.num_resamples = num_resamples
+        self.confidence = confidence
+        self.cars = cars
+        self.cars_bands = cars_bands
+        self.cavcs = cavcs
+        self.cavcs_bands = cavcs_bands
+        self.cars_p_value = cars_p_value
+        self.cavcs_p_value = cavcs_p_value
+
+    @property
+    def cars_yerr(self):
+        '''
+        :return: the CAR bands as distances below and above the CARs, to pass to Plotter.plot_car_cavcs as std_err1
+        '''
+        return _yerr(self.cars, self.cars_bands)
+
+    @property
+    def cavcs_yerr(self):
+        '''
+        :return: the CAVC bands as distances below and above the CAVCs, to pass to Plotter.plot_car_cavcs as std_err2
+        '''
+        return _yerr(self.cavcs, self.cavcs_bands)
+
+
+class EventResampler(object):
+
+    def __init__(self, event_matrix, stock_data, market_symbol, estimation_window=200, buffer=5, pre_event_window=10,
+                 post_event_window=10, per_event_estimation=False, volume_transform='mean_adjusted', volume_window=5,
+                 model=None):
+        '''
+        The parameters are those of Calculator.calculate_cars_cavcs.
+
+        Non-parametric significance for the CARs and CAVCs of calculate_cars_cavcs. The abnormal values are
+        computed once, reduced to the cross-stock mean of each event (and of each day, for placebos), and
+        every resample is then a set of indices into those. A chunk of resamples is evaluated with a couple of
+        array operations.
+        '''
+
+        if model is None:
+            model = MarketModel()
+
+        study = StudyData(stock_data, market_symbol, volume_transform, volume_window, factors=model.factors)
+
+        self.__pre_event_window = pre_event_window
+        self.__post_event_window = post_event_window
+
+        self.__positions = study.event_positions(event_dates(event_matrix), pre_event_window, post_event_window)
+
+        # the first day a placebo event can have: after the estimation window before it, and with a whole
+        # window of returns and of volume changes, which are zero-filled until the volume window has filled up
+        self.__first_placebo_day = max(buffer + estimation_window, volume_window - 1 + pre_event_window,
+                                       1 + pre_event_window)
+
+        fits = fit_market_models(study, self.__positions, estimation_window, buffer, per_event_estimation,
+                                 model=model)
+
+        ccarray, cvarray = excess_windows(study, self.__positions, fits, pre_event_window, post_event_window)
+
+        # (events x window) cross-stock means
+        self.__event_cars = np.mean(ccarray, axis=0)
+        self.__event_cavcs = np.mean(cvarray, axis=0)
+
+        # (days) cross-stock means, from the models fitted before the first event
+        self.__daily_cars = _daily_excess(study.stock_ret, study.market, study.stock_cols, fits.cars_regressions,
+                                          study.factor_cols)
+        self.__daily_cavcs = _daily_excess(study.vlm_changes, study.market, study.stock_cols, fits.cavcs_regressions)
+
+    @property
+    def num_events(self):
+        return len(self.__positions)
+
+    @property
+    def placebo_days(self):
+        '''
+        :return: the calendar positions placebo events are drawn from. They have a whole event window, come after
+            the estimation window and the warm-up of the volume changes, and their windows don't overlap those of
+            the events: every day within pre_event_window + post_event_window of an event is left out.
+        '''
+
+        reach = self.__pre_event_window + self.__post_event_window
+
+        days = np.arange(self.__first_placebo_day, len(self.__daily_cars) - self.__post_event_window)
+
+        near = np.abs(days[:, np.newaxis] - self.__positions[np.newaxis, :]) <= reach
+        return days[~near.any(axis=1)]
+
+    def bootstrap(self, num_resamples=1000, confidence=.95, seed=None, memory_budget=2 ** 27, processes=None):
+        '''
+        :param num_resamples: the number of resamples of the events, drawn with replacement
+        :param confidence: the confidence level of the bands
+        :param seed: the seed of the resamples. The same seed and memory_budget give the same bands for any
+            number of processes.
+        :param memory_budget: about the most bytes a chunk of resamples may use
+        :param processes: the number of worker processes evaluating chunks. None evaluates them in this process.
+        :return: a ResamplingResult with percentile bootstrap bands around the CARs and CAVCs
+        '''
+
+        num_events, window_length = self.__event_cars.shape
+
+        # the (chunk x events) indices and counts, and the (chunk x window) paths of both measures
+        chunk_size = _chunk_size(memory_budget, 8 * (2 * num_events + 4 * window_length))
+
+        chunks = [(self.__event_cars, self.__event_cavcs, size, chunk_seed)
+                  for size, chunk_seed in _chunks(num_resamples, chunk_size, seed)]
+
+        cars_paths, cavcs_paths = _run_chunks(_bootstrap_chunk, chunks, processes)
+
+        return self._result(num_resamples, confidence, cars_paths, cavcs_paths)
+
+    def placebo(self, num_placebos=1000, confidence=.95, seed=None, memory_budget=2 ** 27, processes=None):
+        '''
+        :param num_placebos: the number of placebo studies. Each one has as many pseudo events as the study,
+            drawn with replacement from the days that aren't events and have a full window.
+        :param confidence: the confidence level of the bands
+        :param seed: the seed of the placebos, see bootstrap
+        :param memory_budget: about the most bytes a chunk of placebos may use
+        :param processes: the number of worker processes evaluating chunks. None evaluates them in this process.
+        :return: a ResamplingResult with the bands of the placebo CARs and CAVCs, i.e. what they look like
+            without events, and the p-values of the final CAR and CAVC of the study
+
+        Every day is measured against the models fitted before the first event, also with
+        per_event_estimation. The pseudo events are drawn from placebo_days.
+        '''
+
+        num_events, window_length = self.__event_cars.shape
+
+        days = self.placebo_days
+        if len(days) == 0:
+            raise ValueError('EventResampler: no days left for placebo events')
+
+        # the (chunk x events) positions and the (chunk x events x window) windows of both measures
+        chunk_size = _chunk_size(memory_budget, 8 * num_events * (2 + 2 * window_length) + 8 * 4 * window_length)
+
+        chunks = [(self.__daily_cars, self.__daily_cavcs, days, num_events, self.__pre_event_window,
+                   self.__post_event_window, size, chunk_seed)
+                  for size, chunk_seed in _chunks(num_placebos, chunk_size, seed)]
+
+        cars_paths, cavcs_paths = _run_chunks(_placebo_chunk, chunks, processes)
+
+        result = self._result(num_placebos, confidence, cars_paths, cavcs_paths)
+
+        result.cars_p_value = _p_value(result.cars[-1] - 1, cars_paths[:, -1] - 1)
+        result.cavcs_p_value = _p_value(result.cavcs[-1], cavcs_paths[:, -1])
+
+        return result
+
+    def _result(self, num_resamples, confidence, cars_paths, cavcs_paths):
+
+        quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+
+        return ResamplingResult(num_resamples, confidence,
+                                np.cumprod(np.mean(self.__event_cars, axis=0) + 1),
+                                np.percentile(cars_paths, [100 * q for q in quantiles], axis=0),
+                                np.cumsum(np.mean(self.__event_cavcs, axis=0)),
+                                np.percentile(cavcs_paths, [100 * q for q in quantiles], axis=0))
+
+
+def _daily_excess(values, market, stock_cols, regressions, factor_cols=None):
+    '''
+    :return: 1-d array (days) of the cross-stock mean of what the fitted model doesn't explain
+    '''
+    excess = values[:, stock_cols] - (regressions.slopes * values[:, market][:, np.newaxis] + regressions.intercepts)
+    if regressions.factor_slopes is not None:
+        excess = excess - values[:, factor_cols].dot(regressions.factor_slopes)
+    return np.mean(excess, axis=1)
+
+
+def _chunk_size(memory_budget, bytes_per_resample):
+    return max(int(memory_budget // bytes_per_resample), 1)
+
+
+def _chunks(num_resamples, chunk_size, seed):
+    '''
+    :return: the (size, seed) of each chunk. The seed of every chunk is drawn from the seed of the whole run,
+        so chunks can be evaluated anywhere, in any order.
+    '''
+
+    sizes = [chunk_size] * (num_resamples // chunk_size)
+    if num_resamples % chunk_size:
+        sizes.append(num_resamples % chunk_size)
+
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=len(sizes))
+
+    return list(zip(sizes, seeds))
+
+
+def _run_chunks(evaluate, chunks, processes):
+    '''
+    :return: the (resamples x window) CAR paths and CAVC paths of all chunks, in the order of the chunks
+    '''
+
+    if processes is None or processes <= 1:
+        outcomes = [evaluate(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            outcomes = list(pool.map(evaluate, chunks))
+
+    return (np.concatenate([cars_paths for cars_paths, _ in outcomes]),
+            np.concatenate([cavcs_paths for _, cavcs_paths in outcomes]))
+
+
+def _bootstrap_chunk(chunk):
+    '''
+    Resample the events of a chunk of bootstraps. Resampling the events is the same as weighting them by how
+    often they were drawn, so the means of all resamples are one (chunk x events) by (events x window) product.
+    '''
+
+    event_cars, event_cavcs, size, seed = chunk
+    num_events = len(event_cars)
+
+    draws = np.random.RandomState(seed).randint(0, num_events, size=(size, num_events))
+    draws += (np.arange(size) * num_events)[:, np.newaxis]
+    weights = np.bincount(draws.ravel(), minlength=size * num_events).reshape(size, num_events) / float(num_events)
+
+    return np.cumprod(weights.dot(event_cars) + 1, axis=1), np.cumsum(weights.dot(event_cavcs), axis=1)
+
+
+def _placebo_chunk(chunk):
+    '''
+    Draw pseudo events for a chunk of placebo studies and average their windows.
+    '''
+
+    daily_cars, daily_cavcs, days, num_events, pre_event_window, post_event_window, size, seed = chunk
+
+    positions = days[np.random.RandomState(seed).randint(0, len(days), size=(size, num_events))]
+    rows = positions[:, :, np.newaxis] + np.arange(-pre_event_window, post_event_window + 1)
+
+    return (np.cumprod(np.mean(daily_cars[rows], axis=1) + 1, axis=1),
+            np.cumsum(np.mean(daily_cavcs[rows], axis=1), axis=1))
+
+
+def _p_value(observed, placebos):
+    '''
+    :return: the two-sided share of placebos at least as far from 0 as observed, counting the observation itself
+    '''
+    return (1.0 + np.sum(np.abs(placebos) >= abs(observed))) / (1.0 + len(placebos))
+
+
+def _yerr(values, bands):
+    return np.maximum(np.array([values - bands[0], bands[1] - values]), 0)
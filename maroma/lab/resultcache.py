@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from maroma.lab.derivedseries import DerivedSeries
+from maroma.lab.stockpanel import StockPanel
+
+
+class ResultCache(object):
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        '''
+        :param cache_dir: the directory the results are kept in, one .npz file per key
+        :param max_bytes: the size the files may take up together. When a result is stored the least recently
+            used ones are removed until they fit again.
+
+        An on-disk store of results by key, see Calculator. A key is the fingerprint of everything a
+        result depends on, so equal keys always have equal results and nothing needs to be invalidated.
+        Several processes can share a directory: files are only ever replaced whole.
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get(self, key, load):
+        '''
+        :param key: a fingerprint
+        :param load: a function reading a result from a file name, e.g. CarsCavcsResult.load
+        :return: the result stored under key, or None when there is none
+        '''
+
+        file_name = self._file_name(key)
+        try:
+            result = load(file_name)
+        except _MISSING_ERRORS:
+            return None
+        except _BAD_FILE_ERRORS:
+            # written by another version, or damaged: drop it, it will be computed again
+            _remove(file_name)
+            return None
+
+        # the modification time is the time of last use
+        try:
+            os.utime(file_name, None)
+        except OSError:
+            pass
+
+        return result
+
+    def put(self, key, save):
+        '''
+        :param key: a fingerprint
+        :param save: a function writing the result to a file name, e.g. CarsCavcsResult.save
+        '''
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        file_name = self._file_name(key)
+        save(file_name)
+
+        self._evict(file_name)
+
+    def clear(self):
+        '''
+        Remove every result.
+        '''
+        for file_name, _ in self._files():
+            _remove(file_name)
+
+    def size(self):
+        '''
+        :return: the bytes the results take up
+        '''
+        return sum(stat.st_size for _, stat in self._files())
+
+    def _file_name(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _files(self):
+        '''
+        :return: a list of (file name, os.stat_result) of the results, leaving out files being written
+        '''
+
+        if not os.path.isdir(self.cache_dir):
+            return []
+
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            file_name = os.path.join(self.cache_dir, name)
+            try:
+                files.append((file_name, os.stat(file_name)))
+            except OSError:
+                pass
+        return files
+
+    def _evict(self, keep):
+        '''
+        Remove the least recently used results until the rest fit in max_bytes. keep, the result just stored,
+        stays even when it alone is too big.
+        '''
+
+        files = sorted(self._files(), key=lambda item: item[1].st_mtime)
+        total = sum(stat.st_size for _, stat in files)
+
+        for file_name, stat in files:
+            if total <= self.max_bytes:
+                break
+            if file_name == keep:
+                continue
+            if _remove(file_name):
+                total -= stat.st_size
+
+
+_MISSING_ERRORS = (IOError, OSError)
+
+_BAD_FILE_ERRORS = (ValueError, KeyError, zipfile.BadZipfile)
+
+
+def _remove(file_name):
+    '''
+    :return: True when the file was removed. It may be gone already, or be open elsewhere on windows.
+    '''
+    try:
+        os.remove(file_name)
+        return True
+    except OSError:
+        return False
+
+
+def fingerprint(*parts):
+    '''
+    :param parts: arrays, and anything else json can write
+    :return: a hex digest of the parts
+    '''
+
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray) and not part.dtype.hasobject:
+            part = np.ascontiguousarray(part).reshape(-1)
+            digest.update(('array ' + part.dtype.str + ' ' + str(len(part)) + '\n').encode('utf-8'))
+            digest.update(part.view(np.uint8))
+        else:
+            if isinstance(part, np.ndarray):
+                part = part.tolist()
+            digest.update((json.dumps(part, sort_keys=True, default=str) + '\n').encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def data_fingerprint(stock_data):
+    '''
+    :param stock_data: a DerivedSeries, a StockPanel, or a multi-index dataframe or series as returned by
+        StockDataStore.get_stock_data
+    :return: a fingerprint of the content of the data. It reads all of it; StockDataStore.content_version is
+        much cheaper when the data comes from a store.
+    '''
+
+    if isinstance(stock_data, DerivedSeries):
+        stock_data = stock_data.panel
+
+    if isinstance(stock_data, StockPanel):
+        keys = sorted(stock_data.fields)
+        return fingerprint('panel', stock_data.dates.values, stock_data.symbols, keys,
+                           *[stock_data.fields[key] for key in keys])
+
+    if isinstance(stock_data, pd.Series):
+        columns = [stock_data.name]
+    else:
+        columns = list(stock_data.columns)
+
+    return fingerprint('frame', columns, pd.util.hash_pandas_object(stock_data, index=True).values)
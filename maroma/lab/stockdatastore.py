@@ -1,38 +1,483 @@
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
 
+from maroma.lab.arrayfile import append_rows
+from maroma.lab.derivedseries import DerivedSeries
+from maroma.lab.instrumentation import as_instrumentation
+from maroma.lab.resultcache import fingerprint
+from maroma.lab.stockpanel import StockPanel
+
+
+class StockDataLoadError(ValueError):
+
+    def __init__(self, failures):
+        '''
+        :param failures: a dict mapping each symbol that could not be loaded to the exception it raised
+        '''
+        self.failures = failures
+        ValueError.__init__(self, 'get_stock_data: could not load ' + str(len(failures)) + ' files: ' +
+                            '; '.join(symbol + ' (' + repr(error) + ')' for symbol, error in sorted(failures.items())))
+
 
 class StockDataStore(object):
 
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, cache_dir=None, workers=None, executor='thread', instrumentation=None):
+        '''
+        :param data_dir: the directory holding the daily_adjusted_<SYMBOL>.csv files
+        :param cache_dir: optional directory for a binary cache of the csv files. Each symbol gets a
+            sub directory with one .npy file per column. A symbol is re-parsed from its csv when the csv's
+            modification time or size changes.
+        :param workers: the number of symbol files to read at once. None or 1 reads them one after another.
+        :param executor: 'thread' or 'process'. Threads suit slow (e.g. network) file systems, processes suit
+            parsing that is bound by the CPU.
+        :param instrumentation: optional maroma.lab.instrumentation.Instrumentation timing the load stage
+        '''
+        if executor not in _EXECUTORS:
+            raise ValueError('StockDataStore: executor must be one of ' + ', '.join(sorted(_EXECUTORS)))
+
         self.__data_dir = data_dir
+        self.__cache_dir = cache_dir
+        self.__workers = workers
+        self.__executor = executor
+        self.__instrumentation = as_instrumentation(instrumentation)
         return
 
-    def get_stock_data(self, symbols, keys):
+    def get_stock_data(self, symbols, keys, start_date=None, end_date=None, lookback=0):
         '''
         :param symbols:
         :param keys:
+        :param start_date: optional first date to load
+        :param end_date: optional last date to load
+        :param lookback: the number of extra trading days to load before start_date, e.g. for estimation windows
         :return: a multi-index dataframe where the major key is a datetime and the minor key is a stock symbol.
         The columns are the keys passed in.
         Column options are: open,high,low,close,adjusted_close,volume,dividend_amount,split_coefficient
         a pandas dataframe with datetime indices and columns of stock symbols.
         Using the midf:
         df = stocks_midf.loc['SPY']['close']
+
+        Only the rows between the dates are kept in memory. When the binary cache is used only those rows of
+        the requested columns are read from disk.
+
+        Every file is attempted. If any of them can't be read a StockDataLoadError listing all of the
+        failed symbols is raised.
         '''
 
-        keys = ['timestamp'] + keys
-        stocks = []
-        for symbol in symbols:
-            file = self.__data_dir + 'daily_adjusted_' + symbol + '.csv'
-            stock_df = pd.read_csv(file, usecols=keys, parse_dates=True, index_col=0)
-            stock_df.tz_localize(tz='America/New_York')
-            stock_df = stock_df.sort_index()
-            stocks.append(stock_df)
+        with self.__instrumentation.stage('load', symbols=len(symbols), columns=len(keys)) as record:
+
+            rows = (start_date, end_date, lookback)
+            loads = [(self.symbol_file(symbol), self.__cache_dir, symbol, keys, rows) for symbol in symbols]
+
+            if self.__workers is None or self.__workers <= 1:
+                outcomes = [_try_load_symbol(load) for load in loads]
+            else:
+                with _EXECUTORS[self.__executor](max_workers=self.__workers) as pool:
+                    outcomes = list(pool.map(_try_load_symbol, loads))
+
+            failures = dict((symbol, error) for symbol, (_, error) in zip(symbols, outcomes) if error is not None)
+            if failures:
+                raise StockDataLoadError(failures)
 
-        stocks_midf = pd.concat(stocks, keys=symbols)
-        # print(stocks_midf.loc['SPY']['close'])
+            stocks = [stock_df for stock_df, _ in outcomes]
 
-        if stocks_midf.isnull().values.any():
-            raise ValueError('get_stock_data: null values somewhere in dataframe')
+            stocks_midf = pd.concat(stocks, keys=symbols)
+
+            if stocks_midf.isnull().values.any():
+                raise ValueError('get_stock_data: null values somewhere in dataframe')
+
+            record.count(rows=len(stocks_midf))
 
         return stocks_midf
 
+    def content_version(self, symbols, keys, start_date=None, end_date=None, lookback=0):
+        '''
+        :return: a fingerprint of what get_stock_data returns for the same arguments, e.g. for the data_version
+            of Calculator. It changes when the modification time or size of any of the csv files does, and
+            only takes a stat of each file.
+        '''
+
+        stamps = [_source_stamp(self.symbol_file(symbol)) for symbol in symbols]
+
+        return fingerprint('stock_data', list(symbols), list(keys), str(start_date), str(end_date), lookback, stamps)
+
+    def symbol_file(self, symbol):
+        '''
+        :return: the name of the csv file of a symbol
+        '''
+        return self.__data_dir + 'daily_adjusted_' + symbol + '.csv'
+
+    def write_symbol_csv(self, symbol, content):
+        '''
+        :param symbol:
+        :param content: the bytes of the symbol's whole csv file, e.g. as downloaded
+        :return: True when the file changed. A file that already has the content is left alone, so its
+            modification time, and with it the cache and content_version, stay as they are.
+
+        The file is replaced in one step, so readers see the old or the new file but never part of one. With a
+        cache_dir the symbol's binary cache is brought up to date right away, so the next load doesn't parse
+        the csv. When the new file only adds rows after the last one of an up to date cache, as a download of
+        the latest bars does, only those rows are parsed and appended to the cache in place. Otherwise the
+        whole file is parsed again.
+        '''
+
+        file = self.symbol_file(symbol)
+
+        old_content = None
+        try:
+            with open(file, 'rb') as f:
+                old_content = f.read()
+        except IOError:
+            pass
+
+        if old_content == content:
+            return False
+
+        meta = None
+        if self.__cache_dir is not None and old_content is not None:
+            meta = _read_cache_meta(os.path.join(self.__cache_dir, symbol))
+            if meta is not None and meta['source'] != _source_stamp(file):
+                meta = None
+
+        tmp_file = file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+        if self.__cache_dir is not None:
+            added = None if meta is None else _added_lines(old_content, content)
+            if added is None or not _extend_cache(os.path.join(self.__cache_dir, symbol), meta, file, added):
+                # no keys: only brings the cache up to date
+                _load_symbol(file, self.__cache_dir, symbol, [], (None, None, 0))
+
+        return True
+
+    def append_bars(self, symbol, bars):
+        '''
+        :param symbol:
+        :param bars: a dataframe indexed by timestamp with the new rows of the symbol, and a column for each
+            column of its csv file. They must all come after the last timestamp stored.
+        :return: the number of rows appended
+
+        The rows are appended to the end of the csv file, whatever the order of the rows before them;
+        get_stock_data sorts them. When the binary cache of the symbol is up to date the rows are appended to
+        its .npy files too, in place, so neither the csv nor the cache is read or written whole. Other
+        processes must not load the symbol while it is being appended to.
+        '''
+
+        file = self.symbol_file(symbol)
+
+        with open(file, 'rb') as f:
+            header_line = f.readline()
+            f.seek(-1, os.SEEK_END)
+            ends_with_newline = f.read(1) == b'\n'
+
+        line_end = '\r\n' if header_line.endswith(b'\r\n') else '\n'
+        columns = header_line.decode('utf-8').strip().split(',')[1:]
+
+        missing = [column for column in columns if column not in bars.columns]
+        if missing:
+            raise ValueError('append_bars: the bars of ' + symbol + ' miss the columns ' + ', '.join(missing))
+
+        if len(bars) == 0:
+            return 0
+
+        timestamps = pd.DatetimeIndex(bars.index)
+        if not timestamps.is_monotonic_increasing or timestamps.has_duplicates:
+            raise ValueError('append_bars: the timestamps of the bars of ' + symbol + ' must be increasing')
+        if bars[columns].isnull().values.any():
+            raise ValueError('append_bars: null values in the bars of ' + symbol)
+
+        symbol_dir = None if self.__cache_dir is None else os.path.join(self.__cache_dir, symbol)
+        meta = None if symbol_dir is None else _read_cache_meta(symbol_dir)
+        if meta is not None and (meta['source'] != _source_stamp(file) or meta['columns'] != columns):
+            # out of date already, it is rebuilt on the next load
+            meta = None
+
+        # the last timestamp stored and the types of the columns, from the cache when it can be used
+        if meta is not None:
+            stored = np.load(os.path.join(symbol_dir, 'timestamp.npy'), mmap_mode='r')
+            last = pd.Timestamp(stored[-1]) if len(stored) else None
+            dtypes = dict((column, np.load(os.path.join(symbol_dir, column + '.npy'), mmap_mode='r').dtype)
+                          for column in columns)
+        else:
+            stored = pd.read_csv(file, usecols=['timestamp'], parse_dates=['timestamp'])['timestamp']
+            last = stored.max() if len(stored) else None
+            dtypes = pd.read_csv(file, nrows=100).dtypes[columns].to_dict()
+
+        if last is not None and timestamps[0] <= last:
+            raise ValueError('append_bars: the bars of ' + symbol + ' must come after ' + str(last))
+
+        values = {}
+        for column in columns:
+            given = np.asarray(bars[column].values)
+            values[column] = given.astype(dtypes[column])
+            if not (values[column] == given).all():
+                raise ValueError('append_bars: the ' + column + ' of the bars of ' + symbol + ' must be ' +
+                                 str(dtypes[column]))
+
+        date_format = '%Y-%m-%d' if (timestamps == timestamps.normalize()).all() else '%Y-%m-%d %H:%M:%S'
+        lines = []
+        for i, timestamp in enumerate(timestamps):
+            lines.append(','.join([timestamp.strftime(date_format)] +
+                                  [_format_value(values[column][i]) for column in columns]))
+        text = line_end.join(lines) + line_end
+        if not ends_with_newline:
+            text = line_end + text
+
+        if meta is not None:
+            # the cache isn't used while it is extended
+            os.remove(os.path.join(symbol_dir, 'meta.json'))
+
+        with open(file, 'ab') as f:
+            f.write(text.encode('utf-8'))
+
+        if meta is not None:
+            # the rows are parsed back like the csv is, so the cache holds what a parse of the csv would give
+            appended = pd.read_csv(io.StringIO(header_line.decode('utf-8') + text.lstrip()), parse_dates=True,
+                                   index_col=0)
+            # the timestamps go last, rows without a timestamp aren't read
+            for column in columns:
+                append_rows(os.path.join(symbol_dir, column + '.npy'), appended[column].values)
+            append_rows(os.path.join(symbol_dir, 'timestamp.npy'), appended.index.values)
+            _write_cache_meta(symbol_dir, _source_stamp(file), columns)
+
+        return len(bars)
+
+    def get_stock_panel(self, symbols, keys, panel_dir=None, calendar_symbol=None, start_date=None, end_date=None,
+                        lookback=0):
+        '''
+        :param symbols:
+        :param keys:
+        :param panel_dir: if given, the panel is written to this directory and returned memory-mapped from it,
+            so other processes can open the same pages with StockPanel.open(panel_dir)
+        :param calendar_symbol: the symbol whose dates are used as the trading calendar. Defaults to all dates.
+        :param start_date: see get_stock_data
+        :param end_date: see get_stock_data
+        :param lookback: see get_stock_data
+        :return: a StockPanel with a (days x symbols) array for each key
+        '''
+
+        stock_data = self.get_stock_data(symbols, keys, start_date, end_date, lookback)
+        panel = StockPanel.from_frame(stock_data, calendar_symbol)
+
+        if panel_dir is not None:
+            panel.save(panel_dir)
+            panel = StockPanel.open(panel_dir)
+
+        return panel
+
+    def get_derived_series(self, symbols, keys, panel_dir=None, calendar_symbol=None, start_date=None,
+                           end_date=None, lookback=0):
+        '''
+        :return: a DerivedSeries of the StockPanel get_stock_panel returns for the same arguments. Pass it as
+            the stock_data of every calculation on the data, so the returns and volume changes are computed
+            once for all of them.
+        '''
+
+        return DerivedSeries(self.get_stock_panel(symbols, keys, panel_dir, calendar_symbol, start_date, end_date,
+                                                  lookback))
+
+
+_CACHE_FORMAT = 1
+
+_EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+def _try_load_symbol(load):
+    '''
+    :param load: the (file, cache_dir, symbol, keys, rows) arguments of _load_symbol
+    :return: (dataframe, None) when the symbol was loaded and (None, exception) when it wasn't
+    '''
+    try:
+        return _load_symbol(*load), None
+    except Exception as error:
+        return None, error
+
+
+def _load_symbol(file, cache_dir, symbol, keys, rows):
+    '''
+    :param rows: the (start_date, end_date, lookback) to load
+    :return: a dataframe indexed by timestamp with the keys of one symbol, read from the cache when it
+    is up to date with the csv and from the csv otherwise.
+    '''
+
+    if cache_dir is None:
+        return _slice_rows(_read_csv(file, keys), rows)
+
+    symbol_dir = os.path.join(cache_dir, symbol)
+    source = _source_stamp(file)
+
+    meta = _read_cache_meta(symbol_dir)
+    if meta is None or meta['source'] != source or not set(keys) <= set(meta['columns']):
+        # Parse every column on a miss, so that one parse serves any keys asked for later.
+        stock_df = _read_csv(file, None)
+        _write_cache(symbol_dir, source, stock_df)
+        return _slice_rows(stock_df[[column for column in stock_df.columns if column in keys]], rows)
+
+    return _read_cache(symbol_dir, [column for column in meta['columns'] if column in keys], rows)
+
+
+def _read_csv(file, keys):
+    usecols = None if keys is None else ['timestamp'] + keys
+    stock_df = pd.read_csv(file, usecols=usecols, parse_dates=True, index_col=0)
+    stock_df.tz_localize(tz='America/New_York')
+    stock_df = stock_df.sort_index()
+    return stock_df
+
+
+def _row_range(index, rows):
+    '''
+    :param index: the sorted timestamps of a symbol
+    :param rows: the (start_date, end_date, lookback) to load
+    :return: the positions (first, last + 1) of the rows to load
+    '''
+
+    start_date, end_date, lookback = rows
+
+    first = 0
+    if start_date is not None:
+        first = max(index.searchsorted(pd.Timestamp(start_date), side='left') - lookback, 0)
+
+    stop = len(index)
+    if end_date is not None:
+        stop = index.searchsorted(pd.Timestamp(end_date), side='right')
+
+    return first, max(stop, first)
+
+
+def _slice_rows(stock_df, rows):
+    first, stop = _row_range(stock_df.index, rows)
+    if (first, stop) == (0, len(stock_df)):
+        return stock_df
+    # copy, so that the rest of the file can be freed
+    return stock_df.iloc[first:stop].copy()
+
+
+def _source_stamp(file):
+    stat = os.stat(file)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def _read_cache_meta(symbol_dir):
+    try:
+        with open(os.path.join(symbol_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if meta.get('format') != _CACHE_FORMAT:
+        return None
+    return meta
+
+
+def _read_cache(symbol_dir, columns, rows):
+    '''
+    Map the .npy files and copy out only the rows that were asked for.
+    '''
+    index = pd.DatetimeIndex(np.load(os.path.join(symbol_dir, 'timestamp.npy')), name='timestamp')
+    first, stop = _row_range(index, rows)
+    data = {}
+    for column in columns:
+        data[column] = np.array(np.load(os.path.join(symbol_dir, column + '.npy'), mmap_mode='r')[first:stop])
+    return pd.DataFrame(data, index=index[first:stop], columns=columns)
+
+
+def _write_cache(symbol_dir, source, stock_df):
+    '''
+    Write one .npy file per column and then the meta data. The old meta data is removed first and the new one
+    is written last, so a cache that was only partly written is never read.
+    '''
+
+    meta_file = os.path.join(symbol_dir, 'meta.json')
+    if not os.path.isdir(symbol_dir):
+        os.makedirs(symbol_dir)
+    elif os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    _save_array(symbol_dir, 'timestamp', stock_df.index.values)
+    for column in stock_df.columns:
+        _save_array(symbol_dir, column, stock_df[column].values)
+
+    _write_cache_meta(symbol_dir, source, list(stock_df.columns))
+
+
+def _write_cache_meta(symbol_dir, source, columns):
+    meta = {'format': _CACHE_FORMAT, 'source': source, 'columns': columns}
+    meta_file = os.path.join(symbol_dir, 'meta.json')
+    tmp_file = os.path.join(symbol_dir, 'meta.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, meta_file)
+
+
+def _added_lines(old_content, content):
+    '''
+    :return: the header and the lines of content that aren't in old_content, as bytes, when content is
+        old_content with lines added before or after its rows, and None otherwise
+    '''
+
+    old_lines = [line for line in old_content.splitlines() if line]
+    lines = [line for line in content.splitlines() if line]
+
+    if not old_lines or not lines or old_lines[0] != lines[0] or len(lines) <= len(old_lines):
+        return None
+
+    header, old_rows, rows = lines[0], old_lines[1:], lines[1:]
+    num_added = len(rows) - len(old_rows)
+
+    if rows[num_added:] == old_rows:
+        added = rows[:num_added]
+    elif rows[:len(old_rows)] == old_rows:
+        added = rows[len(old_rows):]
+    else:
+        return None
+
+    return b'\n'.join([header] + added) + b'\n'
+
+
+def _extend_cache(symbol_dir, meta, file, added):
+    '''
+    :param meta: the meta data of the cache, which is up to date with the csv file before the lines were added
+    :param added: the header and the added lines of the csv file, see _added_lines
+    :return: True when the added rows were appended to the cache, and False when they don't fit after its
+        last row, in which case the cache is left alone
+    '''
+
+    appended = pd.read_csv(io.BytesIO(added), parse_dates=True, index_col=0).sort_index()
+    if list(appended.columns) != meta['columns'] or not isinstance(appended.index, pd.DatetimeIndex):
+        return False
+
+    stored = np.load(os.path.join(symbol_dir, 'timestamp.npy'), mmap_mode='r')
+    if len(stored) and appended.index[0] <= pd.Timestamp(stored[-1]):
+        return False
+    for column in meta['columns']:
+        if np.load(os.path.join(symbol_dir, column + '.npy'), mmap_mode='r').dtype != appended[column].dtype:
+            return False
+
+    # the cache isn't used while it is extended, and the timestamps go last, see append_bars
+    os.remove(os.path.join(symbol_dir, 'meta.json'))
+    for column in meta['columns']:
+        append_rows(os.path.join(symbol_dir, column + '.npy'), appended[column].values)
+    append_rows(os.path.join(symbol_dir, 'timestamp.npy'), appended.index.values)
+    _write_cache_meta(symbol_dir, _source_stamp(file), meta['columns'])
+
+    return True
+
+
+def _format_value(value):
+    '''
+    :return: the text of a value in a csv file, from which it is read back exactly
+    '''
+    if isinstance(value, (np.integer, int)):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _save_array(symbol_dir, name, values):
+    tmp_file = os.path.join(symbol_dir, name + '.tmp.npy')
+    np.save(tmp_file, values)
+    os.replace(tmp_file, os.path.join(symbol_dir, name + '.npy'))
@@ -0,0 +1,175 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from maroma.lab.arrayfile import append_rows
+
+
+class StockPanel(object):
+
+    def __init__(self, dates, symbols, fields):
+        '''
+        :param dates: the trading calendar, a DatetimeIndex
+        :param symbols: the list of stock symbols
+        :param fields: a dict mapping a key (adjusted_close, volume, ...) to a (days x symbols) array
+
+        A dense, aligned representation of stock data. The arrays can be memory-mapped files (see save and
+        open), so several processes working on the same panel share the same physical pages.
+        panel_dir is the directory the panel was opened from, or None when it only lives in memory.
+        '''
+        self.dates = pd.DatetimeIndex(dates)
+        self.symbols = list(symbols)
+        self.fields = dict(fields)
+        self.panel_dir = None
+
+        for key, values in self.fields.items():
+            if values.shape != (len(self.dates), len(self.symbols)):
+                raise ValueError('StockPanel: field ' + key + ' does not have the shape (dates x symbols)')
+
+    @classmethod
+    def from_frame(cls, stock_data, calendar_symbol=None):
+        '''
+        :param stock_data: a multi-index dataframe as returned by StockDataStore.get_stock_data
+        :param calendar_symbol: if given, the panel uses the dates of this symbol as its trading calendar.
+            Otherwise it uses every date of every symbol.
+        :return: a StockPanel with one field per column of stock_data
+        '''
+
+        symbols = stock_data.index.get_level_values(0).unique().tolist()
+        if calendar_symbol is None:
+            dates = stock_data.index.get_level_values(1).unique().sort_values()
+        else:
+            dates = stock_data.loc[calendar_symbol].index
+
+        fields = {}
+        for key in stock_data.columns:
+            wide = stock_data[key].unstack(level=0).reindex(index=dates, columns=symbols)
+            fields[key] = np.ascontiguousarray(wide.values, dtype=float)
+
+        return cls(dates, symbols, fields)
+
+    @classmethod
+    def open(cls, panel_dir, mmap_mode='r'):
+        '''
+        :param panel_dir: a directory written by StockPanel.save
+        :param mmap_mode: passed to np.load. Use None to read the fields into memory.
+        :return: a StockPanel whose fields are memory-mapped from panel_dir. Rows past the last date, which are
+            being appended, are left out.
+        '''
+
+        with open(os.path.join(panel_dir, 'panel.json')) as f:
+            meta = json.load(f)
+
+        dates = pd.DatetimeIndex(np.load(os.path.join(panel_dir, 'dates.npy')))
+        fields = {}
+        for key in meta['fields']:
+            fields[key] = np.load(os.path.join(panel_dir, key + '.npy'), mmap_mode=mmap_mode)[:len(dates)]
+
+        panel = cls(dates, meta['symbols'], fields)
+        panel.panel_dir = panel_dir
+        return panel
+
+    def save(self, panel_dir):
+        '''
+        :param panel_dir: the directory to write the panel to. It gets dates.npy, one .npy per field and panel.json.
+        '''
+
+        if not os.path.isdir(panel_dir):
+            os.makedirs(panel_dir)
+
+        np.save(os.path.join(panel_dir, 'dates.npy'), self.dates.values)
+        for key, values in self.fields.items():
+            np.save(os.path.join(panel_dir, key + '.npy'), values)
+
+        with open(os.path.join(panel_dir, 'panel.json'), 'w') as f:
+            json.dump({'symbols': self.symbols, 'fields': list(self.fields)}, f)
+
+    def append(self, dates, fields):
+        '''
+        :param dates: the new trading days, all after the last one of the panel
+        :param fields: a dict mapping every key of the panel to a (new days x symbols) array
+
+        A panel opened from a panel_dir has the new rows appended to its files in place and is mapped again.
+        The rows already there aren't rewritten, so other processes that have the panel open keep reading the
+        old rows undisturbed, and open the new ones with StockPanel.open.
+        '''
+
+        dates = pd.DatetimeIndex(dates)
+        if sorted(fields) != sorted(self.fields):
+            raise ValueError('StockPanel: append needs the fields ' + ', '.join(sorted(self.fields)))
+        if len(dates) == 0:
+            return
+        if not dates.is_monotonic_increasing or dates.has_duplicates or \
+                (len(self.dates) and dates[0] <= self.dates[-1]):
+            raise ValueError('StockPanel: appended dates must be increasing and after the last date of the panel')
+        for key, values in fields.items():
+            if np.shape(values) != (len(dates), len(self.symbols)):
+                raise ValueError('StockPanel: appended field ' + key + ' does not have the shape (dates x symbols)')
+
+        if self.panel_dir is None:
+            self.fields = dict((key, np.concatenate((values, np.asarray(fields[key], dtype=values.dtype))))
+                               for key, values in self.fields.items())
+            self.dates = self.dates.append(dates)
+            return
+
+        # the dates go last: open leaves out rows without dates, so a panel opened meanwhile is the old one
+        for key in self.fields:
+            append_rows(os.path.join(self.panel_dir, key + '.npy'), fields[key])
+        append_rows(os.path.join(self.panel_dir, 'dates.npy'), dates.values)
+
+        for key, values in self.fields.items():
+            mmap_mode = values.mode if isinstance(values, np.memmap) else None
+            self.fields[key] = np.load(os.path.join(self.panel_dir, key + '.npy'), mmap_mode=mmap_mode)
+        self.dates = self.dates.append(dates)
+
+    def field(self, key):
+        '''
+        :return: the (days x symbols) array of a key
+        '''
+        if key not in self.fields:
+            raise ValueError('StockPanel: no field ' + str(key))
+        return self.fields[key]
+
+    def frame(self, key):
+        '''
+        :return: a dataframe with datetime indices and columns of stock symbols, backed by the field's array
+        '''
+        return pd.DataFrame(self.field(key), index=self.dates, columns=self.symbols, copy=False)
+
+    def symbol_positions(self, symbols):
+        '''
+        :return: an array with the column of each symbol
+        '''
+        columns = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        missing = [symbol for symbol in symbols if symbol not in columns]
+        if missing:
+            raise ValueError('StockPanel: symbols not found in panel: ' + ', '.join(missing))
+        return np.array([columns[symbol] for symbol in symbols], dtype=int)
+
+    def to_frame(self):
+        '''
+        :return: the multi-index dataframe StockDataStore.get_stock_data would return for this panel
+        '''
+
+        stocks = []
+        for i, symbol in enumerate(self.symbols):
+            stock_df = pd.DataFrame(dict((key, values[:, i]) for key, values in self.fields.items()),
+                                    index=self.dates, columns=list(self.fields))
+            stocks.append(stock_df.dropna(how='all'))
+
+        return pd.concat(stocks, keys=self.symbols)
+
+
+def as_panel(stock_data, calendar_symbol=None):
+    '''
+    :param stock_data: a StockPanel or a multi-index dataframe as returned by StockDataStore.get_stock_data
+    :param calendar_symbol: the symbol whose dates are the trading calendar when stock_data is a dataframe
+    :return: a StockPanel
+    '''
+
+    if isinstance(stock_data, StockPanel):
+        return stock_data
+
+    return StockPanel.from_frame(stock_data, calendar_symbol)
@@ -0,0 +1,122 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from maroma.lab.abnormalreturns import MarketModel
+from maroma.lab.calculator import StudyData, cars_cavcs_result, event_dates, fit_market_models
+
+
+class ParameterSweep(object):
+
+    def __init__(self, stock_data, market_symbol, volume_transform='mean_adjusted', volume_window=5,
+                 per_event_estimation=False, model=None):
+        '''
+        :param stock_data: a StockPanel or a multi-index dataframe with adjusted_close and volume columns
+        :param market_symbol:
+        :param volume_transform: see Calculator.calculate_cars_cavcs
+        :param volume_window: see Calculator.calculate_cars_cavcs
+        :param per_event_estimation: see Calculator.calculate_cars_cavcs
+        :param model: see Calculator.calculate_cars_cavcs
+
+        Runs calculate_cars_cavcs over a grid of parameters. The daily returns and volume changes are computed
+        once when the sweep is made, and every fit is kept, so runs that share an (estimation_window, buffer,
+        event) only fit it once. This includes runs of later calls to run.
+        '''
+
+        if model is None:
+            model = MarketModel()
+
+        self.__study = StudyData(stock_data, market_symbol, volume_transform, volume_window, factors=model.factors)
+        self.__per_event_estimation = per_event_estimation
+        self.__model = model
+        self.__fits = {}
+        self.results = []
+
+    def run(self, event_matrix, param_grid, workers=None):
+        '''
+        :param event_matrix: an EventMatrix or a dataframe of events, or a function that takes a
+            value_threshold and returns one
+        :param param_grid: a dict mapping some of estimation_window, buffer, pre_event_window, post_event_window
+            and value_threshold to the list of values to try. Parameters that aren't given keep the defaults of
+            calculate_cars_cavcs.
+        :param workers: the number of runs to compute at once. None or 1 computes them one after another.
+        :return: a dataframe with one row per combination of parameters, holding the parameters, num_events and
+            the statistics of the CarsCavcsResult. cars and cavcs are the final cumulative values.
+            The CarsCavcsResult of each row is kept in the results list, in the same order.
+        '''
+
+        unknown = [name for name in param_grid if name not in SWEEP_DEFAULTS]
+        if unknown:
+            raise ValueError('ParameterSweep: unknown parameters ' + ', '.join(sorted(unknown)))
+
+        if 'value_threshold' in param_grid and not callable(event_matrix):
+            raise ValueError('ParameterSweep: sweeping value_threshold needs a function that builds the event matrix')
+
+        names = sorted(SWEEP_DEFAULTS)
+        values = [list(param_grid.get(name, [SWEEP_DEFAULTS[name]])) for name in names]
+        configs = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+        # Build the events of each threshold once, here, so the event matrix function is never called
+        # from more than one thread.
+
+        events = {}
+        for threshold in values[names.index('value_threshold')]:
+            matrix = event_matrix(threshold) if callable(event_matrix) else event_matrix
+            events[threshold] = event_dates(matrix)
+
+        tasks = [(config, events[config['value_threshold']]) for config in configs]
+
+        if workers is None or workers <= 1:
+            self.results = [self._run_one(task) for task in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                self.results = list(pool.map(self._run_one, tasks))
+
+        rows = []
+        for config, result in zip(configs, self.results):
+            row = dict(config)
+            for name in SWEEP_COLUMNS:
+                row[name] = getattr(result, name)
+            row['cars'] = result.cars[-1]
+            row['cavcs'] = result.cavcs[-1]
+            rows.append(row)
+
+        return pd.DataFrame(rows, columns=names + SWEEP_COLUMNS + ['cars', 'cavcs'])
+
+    def _run_one(self, task):
+        config, events = task
+
+        study = self.__study
+
+        positions = study.event_positions(events, config['pre_event_window'], config['post_event_window'])
+
+        # The fits are kept in a plain dict. Two threads may both fit the same window before either stores it;
+        # they compute the same values, so that only costs time.
+        fits = fit_market_models(study, positions, config['estimation_window'], config['buffer'],
+                                 self.__per_event_estimation, self.__fits, self.__model)
+
+        result = cars_cavcs_result(study, positions, fits, config['pre_event_window'], config['post_event_window'])
+
+        # One result is kept per configuration, so leave out the (stocks x events x window) abnormal values.
+        result.abnormal_returns = None
+        result.abnormal_volume_changes = None
+
+        return result
+
+
+SWEEP_DEFAULTS = {
+    'estimation_window': 200,
+    'buffer': 5,
+    'pre_event_window': 10,
+    'post_event_window': 10,
+    'value_threshold': None,
+}
+
+SWEEP_COLUMNS = ['num_events',
+                 'cars_t_test', 'cars_significant', 'cars_positive',
+                 'cars_num_stocks_positive', 'cars_num_stocks_negative',
+                 'cavcs_t_test', 'cavcs_significant', 'cavcs_positive',
+                 'cavcs_num_stocks_positive', 'cavcs_num_stocks_negative',
+                 'cars_num_stocks_significant', 'cavcs_num_stocks_significant',
+                 'cars_patell_z', 'cars_bmp_t', 'cavcs_patell_z', 'cavcs_bmp_t']
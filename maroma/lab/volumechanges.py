@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+
+def mean_adjusted_volume_change(volumes, window=5):
+    '''
+    :param volumes: a (days x symbols) dataframe or array of traded volumes
+    :param window: the number of days in each window, including the current one
+    :return: the volume of each day minus the mean volume of the previous window - 1 days.
+        The first window - 1 days are nan.
+    '''
+
+    values = _as_float_array(volumes)
+    lag = _lag(window)
+
+    # The measure doesn't change when a column is shifted by a constant, so work on centred values
+    # to keep the cumulative sums small.
+    values = values - _column_means(values)
+    prev_sums, prev_counts = _previous_sums(values, lag)
+
+    with np.errstate(invalid='ignore'):
+        changes = values - prev_sums / lag
+
+    return _like(volumes, np.where(prev_counts == lag, changes, np.nan))
+
+
+def log_volume_change(volumes, window=5):
+    '''
+    :param volumes: a (days x symbols) dataframe or array of traded volumes
+    :param window: the number of days in each window, including the current one
+    :return: log(1 + volume) of each day minus its mean over the previous window - 1 days.
+        The first window - 1 days are nan.
+
+    One is added to the volumes so that days without trades stay finite.
+    '''
+
+    values = np.log1p(_as_float_array(volumes))
+
+    return mean_adjusted_volume_change(_like(volumes, values), window)
+
+
+def turnover_zscore(volumes, window=5):
+    '''
+    :param volumes: a (days x symbols) dataframe or array of traded volumes (or turnover)
+    :param window: the number of days in each window, including the current one
+    :return: the volume of each day minus the mean of the previous window - 1 days, divided by their
+        sample standard deviation. The first window - 1 days, and days where the previous volumes don't move, are nan.
+
+    Turnover is volume over shares outstanding. Shares outstanding is constant over a few days, so it
+    cancels out of the z-score and the score can be computed from the volumes directly.
+    '''
+
+    values = _as_float_array(volumes)
+    lag = _lag(window)
+    if lag < 2:
+        raise ValueError('turnover_zscore: window must be at least 3 to estimate a standard deviation')
+
+    values = values - _column_means(values)
+    prev_sums, prev_counts = _previous_sums(values, lag)
+    prev_squares, _ = _previous_sums(values * values, lag)
+
+    # The variance from the sums isn't exactly 0 when the previous volumes don't move, so count the moves.
+    moves = np.zeros(values.shape)
+    moves[1:] = values[1:] != values[:-1]
+    prev_moves, _ = _previous_sums(moves, lag - 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prev_means = prev_sums / lag
+        prev_vars = np.maximum(prev_squares - prev_sums * prev_means, 0.0) / (lag - 1)
+        zscores = (values - prev_means) / np.sqrt(prev_vars)
+
+    valid = (prev_counts == lag) & (prev_moves > 0) & (prev_vars > 0)
+
+    return _like(volumes, np.where(valid, zscores, np.nan))
+
+
+VOLUME_TRANSFORMS = {
+    'mean_adjusted': mean_adjusted_volume_change,
+    'log': log_volume_change,
+    'zscore': turnover_zscore,
+}
+
+
+def volume_changes(volumes, transform='mean_adjusted', window=5):
+    '''
+    :param volumes: a (days x symbols) dataframe or array of traded volumes
+    :param transform: the name of one of VOLUME_TRANSFORMS, or a function taking (volumes, window)
+    :param window: the number of days in each window, including the current one
+    :return: the transformed volumes, with the same shape and labels as volumes
+
+    All the transforms work on the whole volume matrix at once from cumulative sums, so their cost doesn't
+    depend on the window length.
+    '''
+
+    if callable(transform):
+        return transform(volumes, window)
+
+    if transform not in VOLUME_TRANSFORMS:
+        raise ValueError('volume_changes: unknown transform ' + str(transform) +
+                         ', expected one of ' + str(sorted(VOLUME_TRANSFORMS)))
+
+    return VOLUME_TRANSFORMS[transform](volumes, window)
+
+
+def _lag(window):
+    if window < 2:
+        raise ValueError('volume_changes: window must be at least 2')
+    return window - 1
+
+
+def _as_float_array(volumes):
+    values = np.asarray(volumes, dtype=float)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    return values
+
+
+def _like(volumes, values):
+    if isinstance(volumes, pd.DataFrame):
+        return pd.DataFrame(values, index=volumes.index, columns=volumes.columns)
+    if isinstance(volumes, pd.Series):
+        return pd.Series(values[:, 0], index=volumes.index, name=volumes.name)
+    if np.ndim(volumes) == 1:
+        return values[:, 0]
+    return values
+
+
+def _column_means(values):
+    valid = ~np.isnan(values)
+    return np.where(valid, values, 0.0).sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+
+
+def _previous_sums(values, lag):
+    '''
+    :return sums: for every row, the sum of the non-nan values in the lag rows before it
+    :return counts: for every row, the number of non-nan values in the lag rows before it
+    '''
+
+    valid = ~np.isnan(values)
+    zero_row = np.zeros((1,) + values.shape[1:])
+
+    cum_values = np.concatenate((zero_row, np.cumsum(np.where(valid, values, 0.0), axis=0)))
+    cum_counts = np.concatenate((zero_row, np.cumsum(valid, axis=0)))
+
+    sums = np.zeros(values.shape)
+    counts = np.zeros(values.shape)
+    sums[lag:] = cum_values[lag:-1] - cum_values[:-lag - 1]
+    counts[lag:] = cum_counts[lag:-1] - cum_counts[:-lag - 1]
+
+    return sums, counts
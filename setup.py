@@ -14,6 +14,6 @@ setup(
 
     license='MIT License',
 
-    packages=['maroma.lab'],
+    packages=['maroma.lab', 'maroma.lab.benchmark'],
     zip_safe=False,
 )
\ No newline at end of file
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab.stockpanel import StockPanel
+
+
+def make_panel(num_stocks=8, num_days=700, seed=0, market_symbol='MKT'):
+    '''
+    :return: a StockPanel of adjusted_close and volume of a market and num_stocks stocks that follow it, on
+        business days
+    '''
+
+    rs = np.random.RandomState(seed)
+    dates = pd.bdate_range('2015-01-01', periods=num_days)
+    symbols = [market_symbol] + ['S' + str(i) for i in range(num_stocks)]
+
+    market = rs.normal(0.0003, 0.01, num_days)
+    betas = rs.uniform(0.5, 1.5, num_stocks)
+    returns = np.column_stack((market, market[:, np.newaxis] * betas + rs.normal(0, 0.015, (num_days, num_stocks))))
+    prices = 20 * np.cumprod(1 + returns, axis=0)
+    volumes = np.round(np.exp(rs.normal(12, 0.3, (num_days, len(symbols)))))
+
+    return StockPanel(dates, symbols, {'adjusted_close': prices, 'volume': volumes})
+
+
+def make_events(panel, event_positions):
+    '''
+    :return: an event matrix dataframe of make_panel's calendar and symbols, with an event on the first stock at
+        each of the positions
+    '''
+
+    events = pd.DataFrame(np.nan, index=panel.dates, columns=panel.symbols)
+    events.iloc[event_positions, 1] = 1
+    return events
+
+
+@pytest.fixture
+def panel():
+    return make_panel()
+
+
+@pytest.fixture
+def event_positions():
+    '''
+    :return: the positions of a few event dates, well inside make_panel's calendar
+    '''
+    return np.array([260, 301, 355, 420, 480, 533, 610])
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from maroma.lab.abnormalreturns import FactorModel, MarketAdjusted, MarketModel, regress_windows
+from maroma.lab.calculator import Calculator, StudyData, fit_market_models
+from maroma.lab.derivedseries import DerivedSeries
+
+from conftest import make_events
+
+
+def _lstsq(x, y):
+    '''
+    :return: the intercept and then the slopes of y on the columns of x, and the variance of the residuals
+    '''
+
+    design = np.column_stack((np.ones(len(x)), x))
+    coefficients, _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+    residuals = y - design.dot(coefficients)
+    return coefficients, residuals.dot(residuals) / (len(y) - design.shape[1])
+
+
+def test_window_regressions_are_those_of_lstsq():
+    rs = np.random.RandomState(1)
+    x = rs.normal(0.001, 0.01, 300)
+    y = 0.002 + x[:, np.newaxis] * [0.5, 1.0, 1.5] + rs.normal(0, 0.02, (300, 3))
+    starts = np.array([0, 17, 150, 240])
+    stops = starts + [30, 60, 100, 60]
+
+    slopes, intercepts = regress_windows(x, y, starts, stops)
+
+    for k, (start, stop) in enumerate(zip(starts, stops)):
+        for j in range(y.shape[1]):
+            (intercept, slope), _ = _lstsq(x[start:stop], y[start:stop, j])
+            assert slopes[k, j] == pytest.approx(slope, rel=1e-9)
+            assert intercepts[k, j] == pytest.approx(intercept, rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize('model', [MarketModel(), FactorModel(['S6', 'S7'])])
+def test_per_event_fits_are_those_of_lstsq(panel, event_positions, model):
+    estimation_window, buffer = 120, 5
+    study = StudyData(panel, 'MKT', factors=model.factors)
+    regressors = np.concatenate(([study.market], study.factor_cols)).astype(int)
+
+    fits = fit_market_models(study, event_positions, estimation_window, buffer, per_event_estimation=True,
+                             model=model)
+
+    for k, position in enumerate(event_positions):
+        days = slice(position - buffer - estimation_window + 1, position - buffer + 1)
+        for j, col in enumerate(study.stock_cols):
+            coefficients, variance = _lstsq(study.stock_ret[days][:, regressors], study.stock_ret[days, col])
+            assert fits.cars_intercepts[k, j] == pytest.approx(coefficients[0], rel=1e-7, abs=1e-12)
+            assert fits.cars_slopes[k, j] == pytest.approx(coefficients[1], rel=1e-7)
+            if model.factors:
+                np.testing.assert_allclose(fits.cars_factor_slopes[k, :, j], coefficients[2:], rtol=1e-7)
+            assert fits.cars_residual_variances[k, j] == pytest.approx(variance, rel=1e-7)
+
+            (intercept, slope), variance = _lstsq(study.vlm_changes[days, study.market], study.vlm_changes[days, col])
+            assert fits.cavs_intercepts[k, j] == pytest.approx(intercept, rel=1e-7, abs=1e-9)
+            assert fits.cavs_slopes[k, j] == pytest.approx(slope, rel=1e-7)
+            assert fits.cavcs_residual_variances[k, j] == pytest.approx(variance, rel=1e-7)
+
+
+@pytest.mark.parametrize('model', [MarketAdjusted(), MarketModel(), FactorModel(['S6', 'S7'])])
+def test_car_qstk_is_that_of_fitting_each_event_on_its_own(panel, event_positions, model):
+    look_back, look_forward, estimation_window, buffer = 5, 10, 120, 5
+    positions = np.concatenate(([100], event_positions))
+    events = make_events(panel, positions)
+
+    car, std_err, num_events = Calculator().calculate_car_qstk(events, panel, 'MKT', look_back, look_forward,
+                                                               model=model, estimation_window=estimation_window,
+                                                               buffer=buffer)
+
+    returns = DerivedSeries(panel).returns(padded=True)
+    regressors = returns[:, panel.symbol_positions(['MKT'] + list(model.factors))]
+
+    # an estimated model leaves out the event without the history for its estimation window
+    if model.estimated:
+        positions = positions[1:]
+
+    paths = []
+    for position in positions:
+        window = slice(position - look_back, position + look_forward + 1)
+        expected = regressors[window, 0]
+        if model.estimated:
+            days = slice(position - buffer - estimation_window + 1, position - buffer + 1)
+            coefficients, _ = _lstsq(regressors[days], returns[days, 1])
+            expected = coefficients[0] + regressors[window].dot(coefficients[1:])
+        path = np.cumprod(returns[window, 1] - expected + 1)
+        paths.append(path / path[look_back])
+
+    assert num_events == len(positions)
+    np.testing.assert_allclose(car, np.mean(paths, axis=0), rtol=1e-9)
+    np.testing.assert_allclose(std_err, np.std(paths, axis=0), rtol=1e-6, atol=1e-12)
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab.benchmark.synthetic import generate_stock_data
+from maroma.lab.stockdatastore import StockDataStore
+from maroma.lab.stockpanel import StockPanel
+
+
+FIELDS = ['adjusted_close', 'volume']
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    data_dir = str(tmpdir.mkdir('data')) + os.sep
+    generate_stock_data(data_dir, 3, 2)
+    return data_dir
+
+
+def _new_bars(store, symbol, start, periods, seed=0):
+    with open(store.symbol_file(symbol)) as f:
+        columns = f.readline().strip().split(',')[1:]
+    dates = pd.bdate_range(start, periods=periods)
+    bars = pd.DataFrame(np.random.RandomState(seed).rand(periods, len(columns)) * 100 + 1, index=dates,
+                        columns=columns)
+    bars['volume'] = np.round(bars['volume'] * 1000).astype(int)
+    return bars
+
+
+def _last_date(store, symbol):
+    return store.get_stock_data([symbol], FIELDS).loc[symbol].index.max()
+
+
+def test_appended_bars_read_back_as_a_fresh_load(data_dir, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    store = StockDataStore(data_dir, cache_dir=cache_dir)
+    before = store.get_stock_data(['S1'], FIELDS)
+    cache_file = os.path.join(cache_dir, 'S1', 'adjusted_close.npy')
+    inode = os.stat(cache_file).st_ino
+
+    bars = _new_bars(store, 'S1', _last_date(store, 'S1') + pd.Timedelta(days=1), 3)
+    assert store.append_bars('S1', bars) == 3
+    more = _new_bars(store, 'S1', bars.index[-1] + pd.Timedelta(days=1), 2, seed=1)
+    assert store.append_bars('S1', more) == 2
+
+    # the cache was extended in place and agrees with the csv files read without it
+    assert os.stat(cache_file).st_ino == inode
+    after = store.get_stock_data(['S1'], FIELDS)
+    assert after.equals(StockDataStore(data_dir).get_stock_data(['S1'], FIELDS))
+    assert StockDataStore(data_dir, cache_dir=cache_dir).get_stock_data(['S1'], FIELDS).equals(after)
+
+    assert np.array_equal(after.loc['S1'].values[:len(before)], before.loc['S1'].values)
+    # the values go through the text of the csv file
+    assert np.allclose(after.loc['S1']['adjusted_close'].values[-5:],
+                       np.concatenate((bars['adjusted_close'].values, more['adjusted_close'].values)), rtol=1e-12)
+
+
+def test_bars_that_do_not_fit_are_rejected(data_dir):
+    store = StockDataStore(data_dir)
+    start = _last_date(store, 'S1') + pd.Timedelta(days=1)
+    bars = _new_bars(store, 'S1', start, 3)
+    old_bars = _new_bars(store, 'S1', start - pd.Timedelta(days=30), 3)
+
+    for bad, message in ((old_bars, 'must come after'), (bars.iloc[::-1], 'increasing'),
+                         (bars.drop(columns=['volume']), 'miss'), (bars.assign(volume=np.nan), 'null')):
+        with pytest.raises(ValueError, match=message):
+            store.append_bars('S1', bad)
+
+    assert _last_date(store, 'S1') < start
+
+
+def test_panel_append_in_place(data_dir, tmpdir):
+    panel_dir = str(tmpdir.join('panel'))
+    panel = StockDataStore(data_dir).get_stock_panel(['MKT', 'S1'], FIELDS, panel_dir=panel_dir,
+                                                     calendar_symbol='MKT')
+    opened = StockPanel.open(panel_dir)
+    num_days = len(panel.dates)
+
+    dates = pd.bdate_range(panel.dates[-1] + pd.Timedelta(days=1), periods=2)
+    panel.append(dates, {'adjusted_close': np.ones((2, 2)), 'volume': np.full((2, 2), 5.0)})
+
+    assert len(panel.dates) == num_days + 2
+    assert isinstance(panel.field('volume'), np.memmap)
+
+    # a panel opened before keeps its rows, one opened after has the new ones
+    assert len(opened.dates) == num_days
+    assert np.array_equal(opened.field('volume'), panel.field('volume')[:num_days])
+
+    reopened = StockPanel.open(panel_dir)
+    assert reopened.dates.equals(panel.dates)
+    assert np.array_equal(reopened.field('adjusted_close'), panel.field('adjusted_close'))
@@ -0,0 +1,214 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pandas as pd
+import pytest
+
+from maroma.lab import stockdatastore
+from maroma.lab.benchmark.synthetic import generate_stock_data
+from maroma.lab.datafetcher import DailyAdjustedFetcher, StockDataFetchError
+from maroma.lab.stockdatastore import StockDataStore
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _vendor(source_dir, hits):
+    '''
+    :return: a stand-in for the vendor serving the csv files of source_dir. S1 is busy twice, S2 is over its quota
+        once, S3 is sent chunked, NOPE doesn't exist, MOVED redirects twice to S0 and LOOP redirects to itself.
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            symbol = self.path.split('symbol=')[1].split('&')[0]
+            hits[symbol] = hits.get(symbol, 0) + 1
+
+            if symbol == 'NOPE':
+                return self._reply(404, b'')
+            if symbol in ('MOVED', 'LOOP'):
+                location = {'MOVED': '/moved?symbol=MOVED2', 'LOOP': self.path}[symbol]
+                return self._reply(302, b'', location)
+            if symbol == 'MOVED2':
+                return self._reply(301, b'', 'http://127.0.0.1:' + str(self.server.server_address[1]) +
+                                   '/query?symbol=S0&datatype=csv')
+            if symbol == 'S1' and hits[symbol] <= 2:
+                return self._reply(503 if hits[symbol] == 1 else 429, b'')
+            if symbol == 'S2' and hits[symbol] == 1:
+                return self._reply(200, b'{"Note": "Thank you for using Alpha Vantage! Our standard API call '
+                                        b'frequency is 5 calls per minute"}')
+
+            with open(os.path.join(source_dir, 'daily_adjusted_' + symbol + '.csv'), 'rb') as f:
+                content = f.read()
+
+            if symbol != 'S3':
+                return self._reply(200, content)
+
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(content), 5000):
+                chunk = content[start:start + 5000]
+                self.wfile.write(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+        def _reply(self, status, content, location=None):
+            self.send_response(status)
+            if location is not None:
+                self.send_header('Location', location)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def vendor(tmpdir):
+    source_dir = str(tmpdir.mkdir('vendor'))
+    symbols = generate_stock_data(source_dir, 5, 2)
+    hits = {}
+    server = _vendor(source_dir, hits)
+    yield source_dir, symbols, hits, 'http://127.0.0.1:' + str(server.server_address[1]) + \
+        '/query?symbol={symbol}&datatype=csv'
+    server.shutdown()
+    server.server_close()
+
+
+def _read(file_name):
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_writes_the_vendors_files(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    data_dir = str(tmpdir.mkdir('data')) + os.sep
+    store = StockDataStore(data_dir, cache_dir=str(tmpdir.join('cache')))
+
+    fetcher = DailyAdjustedFetcher(store, url_template, concurrency=3, backoff=0.01)
+    assert sorted(fetcher.fetch(symbols)) == sorted(symbols)
+
+    # the busy and over quota symbols were tried again, the chunked one was put together
+    assert hits['S1'] == 3
+    assert hits['S2'] == 2
+    for symbol in symbols:
+        assert _read(store.symbol_file(symbol)) == _read(os.path.join(source_dir, 'daily_adjusted_' + symbol + '.csv'))
+
+    expected = StockDataStore(source_dir + os.sep).get_stock_data(symbols, ['adjusted_close', 'volume'])
+    assert store.get_stock_data(symbols, ['adjusted_close', 'volume']).equals(expected)
+
+    # nothing changed since
+    assert fetcher.fetch(symbols) == []
+
+
+def test_fetch_reports_the_symbols_it_could_not_fetch(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    store = StockDataStore(str(tmpdir.mkdir('data')) + os.sep)
+
+    fetcher = DailyAdjustedFetcher(store, url_template, backoff=0.01)
+    with pytest.raises(StockDataFetchError) as caught:
+        fetcher.fetch(['S4', 'NOPE'])
+
+    # a 404 isn't tried again, and the other symbols are written all the same
+    assert list(caught.value.failures) == ['NOPE']
+    assert caught.value.changed == ['S4']
+    assert hits['NOPE'] == 1
+    assert os.path.exists(store.symbol_file('S4'))
+
+
+def test_fetch_gives_up_after_the_retries(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    store = StockDataStore(str(tmpdir.mkdir('data')) + os.sep)
+
+    fetcher = DailyAdjustedFetcher(store, url_template, retries=1, backoff=0.01)
+    with pytest.raises(StockDataFetchError) as caught:
+        fetcher.fetch(['S1'])
+
+    assert list(caught.value.failures) == ['S1']
+    assert hits['S1'] == 2
+
+
+def _content_with_new_bar(content, changed_row=None):
+    lines = content.split(b'\n')
+    latest = lines[1].split(b',')
+    new_bar = b','.join([b'2019-01-02'] + latest[1:])
+    if changed_row is not None:
+        fields = lines[changed_row].split(b',')
+        lines[changed_row] = b','.join(fields[:5] + [fields[5] + b'9'] + fields[6:])
+    return b'\n'.join([lines[0], new_bar] + lines[1:])
+
+
+def test_write_symbol_csv_appends_new_bars_to_the_cache(vendor, tmpdir, monkeypatch):
+    source_dir, symbols, hits, url_template = vendor
+    data_dir = str(tmpdir.mkdir('data')) + os.sep
+    cache_dir = str(tmpdir.join('cache'))
+    store = StockDataStore(data_dir, cache_dir=cache_dir)
+
+    content = _read(os.path.join(source_dir, 'daily_adjusted_S1.csv'))
+    assert store.write_symbol_csv('S1', content)
+    cache_file = os.path.join(cache_dir, 'S1', 'volume.npy')
+    inode = os.stat(cache_file).st_ino
+
+    # the vendor's newest bar comes first. Only the new line is parsed, and the cache is extended in place.
+    with monkeypatch.context() as patch:
+        patch.setattr(stockdatastore, '_read_csv', None)
+        assert store.write_symbol_csv('S1', _content_with_new_bar(content))
+
+    assert os.stat(cache_file).st_ino == inode
+    loaded = store.get_stock_data(['S1'], ['adjusted_close', 'volume'])
+    assert loaded.index.get_level_values('timestamp')[-1] == pd.Timestamp('2019-01-02')
+    assert loaded.equals(StockDataStore(data_dir).get_stock_data(['S1'], ['adjusted_close', 'volume']))
+
+
+def test_write_symbol_csv_rebuilds_the_cache_when_earlier_rows_change(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    data_dir = str(tmpdir.mkdir('data')) + os.sep
+    store = StockDataStore(data_dir, cache_dir=str(tmpdir.join('cache')))
+
+    content = _read(os.path.join(source_dir, 'daily_adjusted_S1.csv'))
+    store.write_symbol_csv('S1', content)
+    store.write_symbol_csv('S1', _content_with_new_bar(content, changed_row=100))
+
+    loaded = store.get_stock_data(['S1'], ['adjusted_close', 'volume'])
+    assert loaded.equals(StockDataStore(data_dir).get_stock_data(['S1'], ['adjusted_close', 'volume']))
+    original = StockDataStore(source_dir + os.sep).get_stock_data(['S1'], ['adjusted_close', 'volume'])
+    assert (loaded['adjusted_close'].values[:len(original)] != original['adjusted_close'].values).sum() == 1
+
+
+def test_fetch_leaves_no_threads_behind(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    fetcher = DailyAdjustedFetcher(StockDataStore(str(tmpdir.mkdir('data')) + os.sep), url_template, backoff=0.01)
+
+    def pool_threads():
+        return [thread for thread in threading.enumerate()
+                if thread.name.startswith(('ThreadPoolExecutor', 'asyncio'))]
+
+    threads = pool_threads()
+    for _ in range(3):
+        fetcher.fetch(symbols)
+    assert pool_threads() == threads
+
+
+def test_fetch_follows_redirects(vendor, tmpdir):
+    source_dir, symbols, hits, url_template = vendor
+    store = StockDataStore(str(tmpdir.mkdir('data')) + os.sep)
+
+    fetcher = DailyAdjustedFetcher(store, url_template, backoff=0.01)
+    with pytest.raises(StockDataFetchError) as caught:
+        fetcher.fetch(['MOVED', 'LOOP'])
+
+    # a redirect loop ends after a few redirects and isn't tried again
+    assert list(caught.value.failures) == ['LOOP']
+    assert hits['LOOP'] == 6
+    assert caught.value.changed == ['MOVED']
+    assert _read(store.symbol_file('MOVED')) == _read(os.path.join(source_dir, 'daily_adjusted_S0.csv'))
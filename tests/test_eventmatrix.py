@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab.calculator import Calculator, event_dates
+from maroma.lab.eventmatrix import EventMatrix
+from maroma.lab.resultcache import ResultCache
+
+
+def _weighted_events():
+    dates = pd.bdate_range('2018-01-01', periods=40)
+    events = EventMatrix(dates, ['A', 'B', 'C'])
+    events.add_events([3, 10, 10, 25], [0, 1, 2, 1], [1.0, 0.5, 1.0, 0.0])
+    return events
+
+
+def _weighted_panel_events(panel):
+    events = EventMatrix(panel.dates, panel.symbols)
+    events.add_events([300, 400, 400, 520], [2, 3, 5, 1], [0.5, 1.0, 2.0, 0.0])
+    return events
+
+
+def test_dataframe_and_event_matrix_give_the_same_event_dates():
+    events = _weighted_events()
+    dense = events.event_matrix
+
+    assert event_dates(events).equals(event_dates(dense))
+    assert len(event_dates(dense)) == 3
+
+
+def test_events_of_any_weight_count():
+    events = _weighted_events()
+    assert events.num_events == 4
+    assert len(events.event_dates()) == 3
+
+
+def test_car_qstk_is_the_same_for_a_dataframe_and_an_event_matrix(panel):
+    events = _weighted_panel_events(panel)
+    calculator = Calculator()
+
+    for look in (5, 20):
+        car, std_err, num_events = calculator.calculate_car_qstk(events, panel, 'MKT', look, look)
+        dense_car, dense_std_err, dense_num_events = calculator.calculate_car_qstk(events.event_matrix, panel,
+                                                                                   'MKT', look, look)
+        assert num_events == dense_num_events == 4
+        assert np.array_equal(car, dense_car)
+        assert np.array_equal(std_err, dense_std_err)
+
+
+def test_car_qstk_places_dataframe_events_by_date(panel):
+    events = _weighted_panel_events(panel)
+    expected = Calculator().calculate_car_qstk(events, panel, 'MKT', 5, 5)
+
+    # a dataframe on a longer calendar than the data still puts its events on their dates
+    dates = pd.bdate_range(panel.dates[0] - pd.Timedelta(days=30), panel.dates[-1])
+    dense = events.event_matrix.reindex(dates)
+    car, std_err, num_events = Calculator().calculate_car_qstk(dense, panel, 'MKT', 5, 5)
+
+    assert num_events == expected[2]
+    assert np.array_equal(car, expected[0])
+
+
+@pytest.mark.parametrize('as_dataframe', [False, True])
+def test_car_qstk_rejects_events_on_symbols_without_data(panel, as_dataframe):
+    events = EventMatrix(panel.dates, panel.symbols + ['NODATA'])
+    events.add_events([300, 400], [2, len(panel.symbols)])
+
+    with pytest.raises(ValueError):
+        Calculator().calculate_car_qstk(events.event_matrix if as_dataframe else events, panel, 'MKT', 5, 5)
+
+
+def test_cached_car_qstk_is_the_one_computed_for_either_kind_of_event_matrix(panel, tmpdir):
+    events = _weighted_panel_events(panel)
+    expected = Calculator().calculate_car_qstk(events, panel, 'MKT', 5, 5)
+
+    calculator = Calculator(cache=ResultCache(str(tmpdir)))
+    computed = calculator.calculate_car_qstk(events.event_matrix, panel, 'MKT', 5, 5, data_version='v1')
+    cached = calculator.calculate_car_qstk(events, panel, 'MKT', 5, 5, data_version='v1')
+
+    assert len(tmpdir.listdir()) == 1
+    for result in (computed, cached):
+        assert np.array_equal(result[0], expected[0])
+        assert np.array_equal(result[1], expected[1])
+        assert result[2] == expected[2]
+
+
+def test_changing_the_dense_event_matrix_leaves_the_events_alone():
+    events = _weighted_events()
+    dense = events.event_matrix
+    dense.iloc[5, 0] = 1.0
+
+    assert events.num_events == 4
+    assert events.event_matrix.count().sum() == 4
+
+    events.event_matrix = dense
+    assert events.num_events == 5
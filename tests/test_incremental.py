@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab.abnormalreturns import FactorModel, MarketAdjusted, MarketModel
+from maroma.lab.calculator import Calculator
+from maroma.lab.incremental import IncrementalEventStudy
+from maroma.lab.stockpanel import StockPanel
+
+
+def _bars(panel, start, stop):
+    return StockPanel(panel.dates[start:stop], panel.symbols,
+                      dict((key, values[start:stop]) for key, values in panel.fields.items()))
+
+
+def _events(panel, dates):
+    events = pd.DataFrame(np.nan, index=pd.DatetimeIndex(dates), columns=panel.symbols)
+    events.iloc[:, 1] = 1
+    return events
+
+
+def _assert_same_results(expected, result):
+    for name in type(expected).__slots__:
+        if (name.endswith('regressions') or name in ('stages', 'abnormal_returns', 'abnormal_volume_changes') or
+                '_patell_' in name or '_bmp_' in name):
+            continue
+        if name in ('stocks', 'event_dates'):
+            assert list(getattr(expected, name)) == list(getattr(result, name)), name
+            continue
+        assert np.allclose(np.asarray(getattr(expected, name), dtype=float),
+                           np.asarray(getattr(result, name), dtype=float), rtol=1e-8), name
+
+
+@pytest.mark.parametrize('model', [MarketModel(), MarketAdjusted(), FactorModel(['S7'])])
+@pytest.mark.parametrize('per_event_estimation', [False, True])
+def test_incremental_study_matches_calculate_cars_cavcs(panel, event_positions, per_event_estimation, model):
+    dates = panel.dates
+    expected = Calculator().calculate_cars_cavcs(_events(panel, dates[event_positions]), panel, 'MKT',
+                                                 per_event_estimation=per_event_estimation, model=model)
+
+    study = IncrementalEventStudy(_bars(panel, 0, 250), 'MKT', per_event_estimation=per_event_estimation,
+                                  model=model)
+    study.add_events(_events(panel, dates[event_positions[:4]]))
+    for start in range(250, len(dates), 90):
+        study.append_bars(_bars(panel, start, start + 90))
+        if start == 340:
+            study.add_events(_events(panel, dates[event_positions[4:]]))
+
+    assert study.num_events == len(event_positions)
+    assert len(study.pending_events) == 0
+    _assert_same_results(expected, study.result())
+
+
+def test_future_event_on_a_weekend_moves_to_the_next_bar(panel, event_positions):
+    dates = panel.dates
+    monday = dates[dates.dayofweek == 0][60]
+    saturday = monday - pd.Timedelta(days=2)
+    position = dates.get_loc(monday)
+
+    study = IncrementalEventStudy(_bars(panel, 0, position - 10), 'MKT')
+    study.add_events(_events(panel, [dates[event_positions[0]], saturday]))
+    assert study.num_events == 1
+    assert list(study.pending_events) == [saturday]
+
+    study.append_bars(_bars(panel, position - 10, len(dates)))
+    assert study.num_events == 2
+    assert len(study.pending_events) == 0
+
+    # the weekend date was moved to the monday, and the monday itself is then already in
+    assert study.add_events(_events(panel, [monday])) == 0
+
+    expected = Calculator().calculate_cars_cavcs(_events(panel, [dates[event_positions[0]], monday]), panel, 'MKT')
+    _assert_same_results(expected, study.result())
+
+
+def test_weekend_event_within_the_bars_is_rejected_before_changing_the_study(panel, event_positions):
+    dates = panel.dates
+    saturday = dates[event_positions[1]] + pd.Timedelta(days=5 - dates[event_positions[1]].dayofweek)
+
+    study = IncrementalEventStudy(_bars(panel, 0, 400), 'MKT')
+    with pytest.raises(ValueError):
+        study.add_events(_events(panel, [dates[event_positions[0]], saturday]))
+    assert study.num_events == 0
+    assert len(study.pending_events) == 0
+
+    study.add_events(_events(panel, dates[event_positions[:2]]))
+    study.append_bars(_bars(panel, 400, len(dates)))
+    assert study.num_events == 2
+
+    expected = Calculator().calculate_cars_cavcs(_events(panel, dates[event_positions[:2]]), panel, 'MKT')
+    _assert_same_results(expected, study.result())
@@ -0,0 +1,56 @@
+import re
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+from maroma.lab.abnormalreturns import FactorModel
+from maroma.lab.calculator import Calculator
+from maroma.lab.plotter import Plotter, _regression_pages
+
+from conftest import make_events
+
+
+def test_market_model_page_is_the_fitted_line(panel, event_positions):
+    result = Calculator().calculate_cars_cavcs(make_events(panel, event_positions), panel, 'MKT')
+    regressions = result.cars_regressions
+
+    symbol, x, y, fitted, _ = _regression_pages(regressions, 0, 1)[0]
+    assert np.allclose(y - fitted, regressions.excess()[:, 0])
+    assert np.array_equal(x, regressions.x)
+
+
+def test_factor_model_page_plots_the_fitted_values(panel, event_positions, tmpdir):
+    result = Calculator().calculate_cars_cavcs(make_events(panel, event_positions), panel, 'MKT',
+                                               model=FactorModel(['S7']))
+    regressions = result.cars_regressions
+    assert regressions.factor_slopes is not None
+
+    for i, (symbol, x, y, fitted, _) in enumerate(_regression_pages(regressions, 0, len(regressions.symbols))):
+        # the residuals of the page are those of the whole model, factors included
+        assert np.allclose(y - fitted, regressions.excess()[:, i])
+
+    Plotter().plot_regressions(result, str(tmpdir.join('regressions.pdf')))
+    assert tmpdir.join('regressions.pdf').size() > 0
+
+
+def test_regression_pages_are_vector_graphics_unless_drawn_by_workers(panel, event_positions, tmpdir):
+    result = Calculator().calculate_cars_cavcs(make_events(panel, event_positions), panel, 'MKT')
+
+    for processes, raster in ((None, False), (2, True)):
+        pdf_filename = tmpdir.join('regressions_' + str(processes) + '.pdf')
+        Plotter().plot_regressions(result, str(pdf_filename), processes=processes, chunk_size=3)
+        content = pdf_filename.read_binary()
+        assert len(re.findall(br'/Type\s*/Page\b(?!s)', content)) == len(result.stocks)
+        assert (b'/Subtype /Image' in content) == raster
+
+
+def test_car_plots_take_lists(tmpdir):
+    car = [1.0, 1.01, 1.0, 1.02, 1.03]
+    std_err = [0.01] * 5
+
+    Plotter().plot_car(car, std_err, 3, 2, 2, show=False, pdf_filename=str(tmpdir.join('car.pdf')))
+    Plotter().plot_car_cavcs(3, car, std_err, [0.0, 0.1, 0.0, 0.2, 0.3], [[0.1] * 5, [0.2] * 5], 2, 2,
+                             show=False, pdf_filename=str(tmpdir.join('car_cavcs.pdf')))
+    assert tmpdir.join('car.pdf').size() > 0 and tmpdir.join('car_cavcs.pdf').size() > 0
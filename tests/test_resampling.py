@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from maroma.lab import resampling
+from maroma.lab.abnormalreturns import FactorModel, MarketAdjusted
+from maroma.lab.calculator import Calculator
+from maroma.lab.resampling import EventResampler
+
+from conftest import make_events
+
+
+def test_bootstrap_matches_resampling_the_events_one_at_a_time(panel, event_positions):
+    events = make_events(panel, event_positions)
+    study = Calculator().calculate_cars_cavcs(events, panel, 'MKT')
+    result = EventResampler(events, panel, 'MKT').bootstrap(200, seed=3)
+
+    assert np.allclose(result.cars, study.cars)
+    assert np.allclose(result.cavcs, study.cavcs)
+
+    # the whole run fits in one chunk, whose seed is the first one drawn from the seed of the run
+    event_cars = study.abnormal_returns.mean(axis=0)
+    event_cavcs = study.abnormal_volume_changes.mean(axis=0)
+    chunk_seed = np.random.RandomState(3).randint(0, 2 ** 31 - 1, size=1)[0]
+    draws = np.random.RandomState(chunk_seed).randint(0, len(event_cars), size=(200, len(event_cars)))
+
+    cars_paths = np.array([np.cumprod(event_cars[drawn].mean(axis=0) + 1) for drawn in draws])
+    cavcs_paths = np.array([np.cumsum(event_cavcs[drawn].mean(axis=0)) for drawn in draws])
+
+    assert np.allclose(result.cars_bands, np.percentile(cars_paths, [2.5, 97.5], axis=0))
+    assert np.allclose(result.cavcs_bands, np.percentile(cavcs_paths, [2.5, 97.5], axis=0))
+
+
+def test_resamples_do_not_depend_on_the_processes(panel, event_positions):
+    resampler = EventResampler(make_events(panel, event_positions), panel, 'MKT')
+
+    for resample in (resampler.bootstrap, resampler.placebo):
+        expected = resample(300, seed=5, memory_budget=20000)
+        result = resample(300, seed=5, memory_budget=20000, processes=2)
+
+        assert np.array_equal(result.cars_bands, expected.cars_bands)
+        assert np.array_equal(result.cavcs_bands, expected.cavcs_bands)
+        assert result.cars_p_value == expected.cars_p_value
+
+
+def test_placebo_p_values_count_the_study_itself(panel, event_positions):
+    result = EventResampler(make_events(panel, event_positions), panel, 'MKT').placebo(99, seed=1)
+
+    assert 1 / 100.0 <= result.cars_p_value <= 1
+    assert 1 / 100.0 <= result.cavcs_p_value <= 1
+    assert np.all(result.cars_bands[0] <= result.cars_bands[1])
+
+
+def test_placebo_days_stay_clear_of_the_events_and_the_warm_up(panel, event_positions, monkeypatch):
+    resampler = EventResampler(make_events(panel, event_positions), panel, 'MKT', estimation_window=200, buffer=5,
+                               pre_event_window=10, post_event_window=10, volume_window=30)
+    days = resampler.placebo_days
+
+    assert len(days) > 0
+    assert days.min() >= 205
+    assert days.max() < len(panel.dates) - 10
+    for position in event_positions:
+        assert not ((days >= position - 20) & (days <= position + 20)).any()
+
+    # the placebos are drawn from those days only
+    drawn = []
+    placebo_chunk = resampling._placebo_chunk
+
+    def recording_chunk(chunk):
+        daily_cars, daily_cavcs, chunk_days, num_events, pre_event_window, post_event_window, size, seed = chunk
+        drawn.append(chunk_days[np.random.RandomState(seed).randint(0, len(chunk_days), size=(size, num_events))])
+        return placebo_chunk(chunk)
+
+    monkeypatch.setattr(resampling, '_placebo_chunk', recording_chunk)
+    resampler.placebo(50, seed=2, memory_budget=20000)
+
+    drawn = np.concatenate([positions.ravel() for positions in drawn])
+    assert len(drawn) == 50 * len(event_positions)
+    assert np.isin(drawn, days).all()
+
+
+def test_placebo_windows_start_after_the_volume_warm_up(panel, event_positions):
+    resampler = EventResampler(make_events(panel, event_positions), panel, 'MKT', estimation_window=20, buffer=2,
+                               pre_event_window=10, post_event_window=10, volume_window=40)
+
+    # the first 39 volume changes are zero-filled, so the first window may start on day 39
+    assert resampler.placebo_days.min() == 49
+
+
+@pytest.mark.parametrize('model', [MarketAdjusted(), FactorModel(['S6', 'S7'])])
+def test_resamples_measure_the_model_of_the_study(panel, event_positions, model, monkeypatch):
+    events = make_events(panel, event_positions)
+    study = Calculator().calculate_cars_cavcs(events, panel, 'MKT', model=model)
+    resampler = EventResampler(events, panel, 'MKT', model=model)
+
+    result = resampler.bootstrap(50, seed=3)
+    assert np.allclose(result.cars, study.cars)
+    assert np.allclose(result.cavcs, study.cavcs)
+
+    # placebo days are measured against the same fits as the events
+    daily = []
+    placebo_chunk = resampling._placebo_chunk
+
+    def recording_chunk(chunk):
+        daily.append(chunk[0])
+        return placebo_chunk(chunk)
+
+    monkeypatch.setattr(resampling, '_placebo_chunk', recording_chunk)
+    resampler.placebo(50, seed=2)
+
+    windows = np.array([daily[0][position - 10:position + 11] for position in event_positions])
+    assert np.allclose(windows, study.abnormal_returns.mean(axis=0))
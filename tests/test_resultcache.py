@@ -0,0 +1,145 @@
+import os
+
+import json
+
+import numpy as np
+import pytest
+
+from maroma.lab import calculator as calculator_module
+from maroma.lab.abnormalreturns import FactorModel
+from maroma.lab.arrayfile import load_arrays, save_arrays
+from maroma.lab.calculator import CarsCavcsResult, Calculator
+from maroma.lab.instrumentation import Instrumentation
+from maroma.lab.resultcache import ResultCache
+
+from conftest import make_events
+
+
+def _cache_hits(instrumentation):
+    return [record.counts['hit'] for record in instrumentation.records if record.name == 'cache']
+
+
+def test_cached_results_are_the_computed_ones(panel, event_positions, tmpdir):
+    events = make_events(panel, event_positions)
+    expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True)
+
+    instrumentation = Instrumentation()
+    calculator = Calculator(instrumentation, ResultCache(str(tmpdir)))
+
+    for data_version in (None, None, 'v1', 'v1'):
+        result = calculator.calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True,
+                                                 data_version=data_version)
+        for name in type(expected).__slots__:
+            if name == 'stages' or name.endswith('regressions'):
+                continue
+            assert np.array_equal(np.asarray(getattr(result, name)), np.asarray(getattr(expected, name))), name
+
+    assert _cache_hits(instrumentation) == [0, 1, 0, 1]
+
+
+def test_changed_data_or_parameters_are_computed_again(panel, event_positions, tmpdir):
+    events = make_events(panel, event_positions)
+    instrumentation = Instrumentation()
+    calculator = Calculator(instrumentation, ResultCache(str(tmpdir)))
+
+    calculator.calculate_cars_cavcs(events, panel, 'MKT')
+    calculator.calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True)
+    calculator.calculate_cars_cavcs(events, panel, 'MKT', post_event_window=5)
+
+    panel.fields['adjusted_close'] = panel.fields['adjusted_close'] * 1.01
+    calculator.calculate_cars_cavcs(events, panel, 'MKT')
+
+    assert _cache_hits(instrumentation) == [0, 0, 0, 0]
+    assert len(tmpdir.listdir()) == 4
+
+
+def test_least_recently_used_results_are_evicted(panel, event_positions, tmpdir):
+    events = make_events(panel, event_positions)
+    calculator = Calculator(cache=ResultCache(str(tmpdir)))
+
+    calculator.calculate_cars_cavcs(events, panel, 'MKT', data_version='v1')
+    first, = tmpdir.listdir()
+    os.utime(str(first), (1, 1))
+
+    cache = ResultCache(str(tmpdir), max_bytes=first.size() + 1)
+    Calculator(cache=cache).calculate_cars_cavcs(events, panel, 'MKT', data_version='v2')
+
+    assert not first.exists()
+    assert len(tmpdir.listdir()) == 1
+
+
+class _SavedMeanwhile(object):
+    '''
+    An array that has another writer put the same key while it is being saved, after its own file is open.
+    '''
+
+    def __init__(self, cache, values, other_values):
+        self.cache = cache
+        self.values = values
+        self.other_values = other_values
+
+    def __array__(self, dtype=None, copy=None):
+        if self.other_values is not None:
+            other_values, self.other_values = self.other_values, None
+            self.cache.put('key', lambda file_name: save_arrays(file_name, {'values': other_values}))
+        return self.values
+
+
+def test_concurrent_puts_of_a_key_leave_one_whole_file(tmpdir):
+    cache = ResultCache(str(tmpdir))
+    values, other_values = np.full(200000, 1.0), np.full(200000, 2.0)
+
+    cache.put('key', lambda file_name: save_arrays(file_name,
+                                                   {'values': _SavedMeanwhile(cache, values, other_values)}))
+
+    # the last writer to finish wins, and nothing of the other is left over
+    assert [path.basename for path in tmpdir.listdir()] == ['key.npz']
+    stored = cache.get('key', lambda file_name: load_arrays(file_name, None)['values'])
+    assert np.array_equal(stored, values)
+
+
+def _saved_result(panel, event_positions, tmpdir):
+    events = make_events(panel, event_positions)
+    result = Calculator(Instrumentation()).calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True,
+                                                                model=FactorModel(['S7']))
+    file_name = str(tmpdir.join('result.npz'))
+    result.save(file_name)
+    return result, file_name
+
+
+@pytest.mark.parametrize('mmap_mode', ['r', None])
+def test_a_saved_result_loads_back_whole(panel, event_positions, tmpdir, mmap_mode):
+    expected, file_name = _saved_result(panel, event_positions, tmpdir)
+    result = CarsCavcsResult.load(file_name, mmap_mode)
+
+    # every slot is saved one way or another
+    assert set(CarsCavcsResult.__slots__) == (set(calculator_module._RESULT_SCALARS) |
+                                              set(calculator_module._RESULT_ARRAYS) |
+                                              {'cars_regressions', 'cavcs_regressions', 'stages', 'stocks'})
+
+    for name in CarsCavcsResult.__slots__:
+        value, loaded = getattr(expected, name), getattr(result, name)
+        assert value is not None, name
+        if name == 'stages':
+            assert [record.to_dict() for record in loaded] == [record.to_dict() for record in value]
+        elif name.endswith('regressions'):
+            assert (loaded.symbols, loaded.cumulate) == (value.symbols, value.cumulate)
+            for key in ('x', 'y', 'slopes', 'intercepts', 'factors', 'factor_slopes'):
+                np.testing.assert_array_equal(getattr(loaded, key), getattr(value, key), err_msg=name + '.' + key)
+        elif name in calculator_module._RESULT_SCALARS:
+            assert loaded == value or (np.isnan(loaded) and np.isnan(value)), name
+        else:
+            np.testing.assert_array_equal(np.asarray(loaded), np.asarray(value), err_msg=name)
+
+
+def test_a_result_saved_in_an_older_format_is_rejected(panel, event_positions, tmpdir):
+    _, file_name = _saved_result(panel, event_positions, tmpdir)
+
+    arrays = load_arrays(file_name, None)
+    meta = json.loads(str(arrays['meta']))
+    meta['format'] = calculator_module._RESULT_FORMAT - 1
+    arrays['meta'] = np.array(json.dumps(meta))
+    save_arrays(file_name, arrays)
+
+    with pytest.raises(ValueError, match='not a saved result of this version'):
+        CarsCavcsResult.load(file_name)
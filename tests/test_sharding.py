@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from maroma.lab.abnormalreturns import FactorModel
+from maroma.lab.calculator import Calculator
+from maroma.lab.stockpanel import StockPanel
+
+from conftest import make_events, make_panel
+
+
+def _assert_identical(expected, result):
+    for name in type(expected).__slots__:
+        if name == 'stages':
+            continue
+        value, other = getattr(expected, name), getattr(result, name)
+        if name.endswith('regressions'):
+            assert value.symbols == other.symbols
+            for array in ('y', 'slopes', 'intercepts'):
+                assert np.array_equal(getattr(value, array), getattr(other, array)), name
+        else:
+            np.testing.assert_array_equal(np.asarray(value), np.asarray(other), err_msg=name)
+
+
+@pytest.mark.parametrize('per_event_estimation', [False, True])
+def test_sharded_study_is_that_of_one_process(panel, event_positions, per_event_estimation):
+    events = make_events(panel, event_positions)
+    expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=per_event_estimation)
+    result = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=per_event_estimation,
+                                               processes=3)
+    _assert_identical(expected, result)
+
+
+def test_sharded_study_of_a_saved_panel_with_factors(panel, event_positions, tmpdir):
+    panel.save(str(tmpdir.join('panel')))
+    events = make_events(panel, event_positions)
+    model = FactorModel(['S7'])
+
+    expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', model=model)
+    result = Calculator().calculate_cars_cavcs(events, StockPanel.open(str(tmpdir.join('panel'))), 'MKT',
+                                               model=model, processes=2)
+    _assert_identical(expected, result)
+
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+def test_sharded_study_without_stocks_is_that_of_one_process(event_positions):
+    panel = make_panel(num_stocks=1)
+    events = make_events(panel, event_positions)
+    model = FactorModel(['S0'])
+
+    expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', model=model)
+    result = Calculator().calculate_cars_cavcs(events, panel, 'MKT', model=model, processes=2)
+    _assert_identical(expected, result)
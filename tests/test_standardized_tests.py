@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from maroma.lab.abnormalreturns import regress_factor_windows, residual_variances
+from maroma.lab.calculator import Calculator
+from maroma.lab.derivedseries import DerivedSeries
+
+from conftest import make_events
+
+
+ESTIMATION_WINDOW = 200
+BUFFER = 5
+PRE_EVENT_WINDOW = 10
+POST_EVENT_WINDOW = 10
+
+
+def _brute_force_tests(x, y, event_positions, per_event_estimation):
+    '''
+    :return: the Patell z and the BMP t of fits made one stock and one event at a time with lstsq
+    '''
+
+    window_length = PRE_EVENT_WINDOW + POST_EVENT_WINDOW + 1
+    dof = ESTIMATION_WINDOW - 2
+
+    scars = []
+    for position in event_positions:
+        fit_position = position if per_event_estimation else event_positions[0]
+        estimation = slice(fit_position - BUFFER - ESTIMATION_WINDOW + 1, fit_position - BUFFER + 1)
+        event = slice(position - PRE_EVENT_WINDOW, position + POST_EVENT_WINDOW + 1)
+
+        for stock in range(y.shape[1]):
+            design = np.column_stack((np.ones(ESTIMATION_WINDOW), x[estimation]))
+            coefficients, _, _, _ = np.linalg.lstsq(design, y[estimation, stock], rcond=None)
+            residuals = y[estimation, stock] - design.dot(coefficients)
+            abnormal = y[event, stock] - (coefficients[0] + coefficients[1] * x[event])
+            scars.append(abnormal.sum() / (np.sqrt(residuals.dot(residuals) / dof) * np.sqrt(window_length)))
+
+    scars = np.array(scars)
+    n = len(scars)
+    return scars.sum() / np.sqrt(n * dof / (dof - 2.0)), scars.mean() / (scars.std(ddof=1) / np.sqrt(n))
+
+
+@pytest.mark.parametrize('per_event_estimation', [False, True])
+def test_patell_and_bmp_match_a_brute_force_computation(panel, event_positions, per_event_estimation):
+    result = Calculator().calculate_cars_cavcs(make_events(panel, event_positions), panel, 'MKT',
+                                               per_event_estimation=per_event_estimation)
+
+    series = DerivedSeries(panel)
+    stock_cols = panel.symbol_positions(result.stocks)
+
+    for values, prefix in ((series.returns(), 'cars'), (series.volume_changes(), 'cavcs')):
+        patell_z, bmp_t = _brute_force_tests(values[:, 0], values[:, stock_cols], event_positions,
+                                             per_event_estimation)
+
+        assert np.isclose(getattr(result, prefix + '_patell_z'), patell_z, rtol=1e-8)
+        assert np.isclose(getattr(result, prefix + '_bmp_t'), bmp_t, rtol=1e-8)
+        assert np.isclose(getattr(result, prefix + '_patell_p_value'), 2 * stats.norm.sf(abs(patell_z)), rtol=1e-6)
+        assert np.isclose(getattr(result, prefix + '_bmp_p_value'),
+                          2 * stats.t.sf(abs(bmp_t), len(stock_cols) * len(event_positions) - 1), rtol=1e-6)
+
+
+def test_per_event_estimation_uses_each_events_residuals(panel, event_positions):
+    events = make_events(panel, event_positions)
+    first_fit = Calculator().calculate_cars_cavcs(events, panel, 'MKT')
+    per_event = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True)
+
+    assert per_event.cars_patell_z != first_fit.cars_patell_z
+    assert per_event.cavcs_bmp_t != first_fit.cavcs_bmp_t
+
+
+def test_residual_variances_match_the_residuals_of_each_window():
+    rs = np.random.RandomState(3)
+    x = rs.normal(0, 0.01, (600, 2))
+    y = x.dot(rs.uniform(0.5, 1.5, (2, 4))) + rs.normal(0.001, 0.015, (600, 4))
+    starts = np.array([0, 120, 390])
+    stops = starts + 200
+
+    coefficients = regress_factor_windows(x, y, starts, stops)
+    variances = residual_variances(x, y, starts, stops, coefficients)
+
+    for w, (start, stop) in enumerate(zip(starts, stops)):
+        residuals = y[start:stop] - np.column_stack((np.ones(stop - start), x[start:stop])).dot(coefficients[w])
+        assert np.allclose(variances[w], (residuals * residuals).sum(axis=0) / (stop - start - 3), rtol=1e-10)
+
+
+def test_sharded_per_event_tests_are_those_of_one_process(panel, event_positions):
+    events = make_events(panel, event_positions)
+    expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True)
+    result = Calculator().calculate_cars_cavcs(events, panel, 'MKT', per_event_estimation=True, processes=2)
+
+    for name in ('cars_patell_z', 'cars_bmp_t', 'cavcs_patell_z', 'cavcs_bmp_t'):
+        assert getattr(result, name) == getattr(expected, name), name
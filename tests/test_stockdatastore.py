@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab import stockdatastore
+from maroma.lab.benchmark.synthetic import generate_stock_data
+from maroma.lab.stockdatastore import StockDataLoadError, StockDataStore
+
+
+FIELDS = ['adjusted_close', 'volume']
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    data_dir = str(tmpdir.mkdir('data')) + os.sep
+    generate_stock_data(data_dir, 3, 2)
+    return data_dir
+
+
+def _count_parses(monkeypatch):
+    parses = []
+    read_csv = stockdatastore._read_csv
+
+    def counting_read_csv(file, keys):
+        parses.append(file)
+        return read_csv(file, keys)
+
+    monkeypatch.setattr(stockdatastore, '_read_csv', counting_read_csv)
+    return parses
+
+
+def test_a_rewritten_csv_is_parsed_again(data_dir, tmpdir, monkeypatch):
+    store = StockDataStore(data_dir, cache_dir=str(tmpdir.join('cache')))
+    symbols = ['MKT', 'S0']
+    parses = _count_parses(monkeypatch)
+
+    before = store.get_stock_data(symbols, FIELDS)
+    version = store.content_version(symbols, FIELDS)
+    assert store.get_stock_data(symbols, FIELDS).equals(before)
+    assert len(parses) == 2
+
+    file = store.symbol_file('S0')
+    stat = os.stat(file)
+    csv = pd.read_csv(file, index_col=0)
+    csv['adjusted_close'] = csv['adjusted_close'] * 2
+    csv.to_csv(file)
+    os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    after = store.get_stock_data(symbols, FIELDS)
+    assert parses[2:] == [file]
+    assert store.content_version(symbols, FIELDS) != version
+    assert after.loc['MKT'].equals(before.loc['MKT'])
+    np.testing.assert_allclose(after.loc['S0', 'adjusted_close'], before.loc['S0', 'adjusted_close'] * 2)
+    assert after.equals(StockDataStore(data_dir).get_stock_data(symbols, FIELDS))
+
+
+@pytest.mark.parametrize('workers, executor', [(None, 'thread'), (1, 'process'), (3, 'thread'), (3, 'process')])
+def test_every_file_that_cannot_be_loaded_is_reported(data_dir, tmpdir, workers, executor):
+    store = StockDataStore(data_dir, cache_dir=str(tmpdir.join('cache')), workers=workers, executor=executor)
+    with open(store.symbol_file('S1'), 'w') as f:
+        f.write('not,a\nstock,file\n')
+
+    with pytest.raises(StockDataLoadError) as error:
+        store.get_stock_data(['MKT', 'S0', 'S1', 'NONE'], FIELDS)
+
+    assert sorted(error.value.failures) == ['NONE', 'S1']
+    assert isinstance(error.value.failures['NONE'], IOError)
+    assert 'could not load 2 files' in str(error.value)
+
+
+def _expected_rows(full, symbols, start_date, end_date, lookback):
+    '''
+    :return: the rows of a full load from lookback trading days before start_date through end_date
+    '''
+
+    stocks = []
+    for symbol in symbols:
+        stock_df = full.loc[symbol]
+        dates = stock_df.index
+        inside = np.ones(len(dates), dtype=bool)
+        if start_date is not None:
+            inside &= dates >= pd.Timestamp(start_date)
+            inside[np.flatnonzero(dates < pd.Timestamp(start_date))[-lookback:] if lookback else []] = True
+        if end_date is not None:
+            inside &= dates <= pd.Timestamp(end_date)
+        stocks.append(stock_df[inside])
+    return pd.concat(stocks, keys=symbols)
+
+
+@pytest.mark.parametrize('start_date, end_date, lookback', [('2018-03-17', '2018-09-30', 0),
+                                                            ('2018-03-17', '2018-09-30', 20),
+                                                            ('2017-02-01', None, 1000),
+                                                            (None, '2017-06-01', 5)])
+def test_a_date_range_is_a_slice_of_the_full_load(data_dir, tmpdir, start_date, end_date, lookback):
+    symbols = ['MKT', 'S0', 'S2']
+    full = StockDataStore(data_dir).get_stock_data(symbols, FIELDS)
+    expected = _expected_rows(full, symbols, start_date, end_date, lookback)
+    assert 0 < len(expected) <= len(full)
+
+    for store in (StockDataStore(data_dir), StockDataStore(data_dir, cache_dir=str(tmpdir.join('cache')))):
+        for _ in range(2):
+            result = store.get_stock_data(symbols, FIELDS, start_date, end_date, lookback)
+            pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from maroma.lab.abnormalreturns import FactorModel, MarketAdjusted, MarketModel
+from maroma.lab.calculator import Calculator
+from maroma.lab.sweep import ParameterSweep
+
+from conftest import make_events
+
+
+@pytest.mark.parametrize('model', [MarketModel(), MarketAdjusted(), FactorModel(['S7'])])
+def test_sweep_runs_are_those_of_calculate_cars_cavcs(panel, event_positions, model):
+    events = make_events(panel, event_positions)
+    sweep = ParameterSweep(panel, 'MKT', per_event_estimation=True, model=model)
+
+    table = sweep.run(events, {'estimation_window': [100, 200], 'post_event_window': [5, 10]})
+
+    assert len(table) == 4
+    for (_, row), result in zip(table.iterrows(), sweep.results):
+        expected = Calculator().calculate_cars_cavcs(events, panel, 'MKT', estimation_window=row['estimation_window'],
+                                                     post_event_window=row['post_event_window'],
+                                                     per_event_estimation=True, model=model)
+        assert expected.stocks == result.stocks
+        assert np.allclose(expected.cars, result.cars)
+        assert np.allclose(expected.cavcs, result.cavcs)
+        assert row['cars_t_test'] == pytest.approx(expected.cars_t_test)
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from maroma.lab.derivedseries import DerivedSeries
+from maroma.lab.volumechanges import volume_changes
+
+from conftest import make_panel
+
+
+def _brute_force(volumes, transform, window):
+    '''
+    :return: the volume changes of a (days x symbols) dataframe, from a rolling window over the previous days
+    '''
+
+    if transform == 'log':
+        volumes = np.log1p(volumes)
+    previous = volumes.shift(1).rolling(window - 1)
+
+    changes = volumes - previous.apply(np.mean)
+    if transform == 'zscore':
+        changes = changes / previous.apply(lambda x: np.std(x, ddof=1))
+    return changes.replace([np.inf, -np.inf], np.nan)
+
+
+def _volumes():
+    panel = make_panel(num_stocks=3, num_days=120)
+    volumes = pd.DataFrame(panel.field('volume'), index=panel.dates, columns=panel.symbols)
+    volumes.iloc[30:33, 1] = np.nan
+    volumes.iloc[60:70, 2] = 5e5
+    volumes.iloc[90:95, 3] = 0
+    return volumes
+
+
+@pytest.mark.parametrize('transform', ['mean_adjusted', 'log', 'zscore'])
+@pytest.mark.parametrize('window', [3, 5, 21])
+def test_volume_changes_are_those_of_a_rolling_window(transform, window):
+    volumes = _volumes()
+    expected = _brute_force(volumes, transform, window)
+
+    result = volume_changes(volumes, transform, window)
+
+    assert result.index.equals(volumes.index) and list(result.columns) == list(volumes.columns)
+    np.testing.assert_array_equal(result.isnull().values, expected.isnull().values)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-9, atol=1e-6)
+
+
+@pytest.mark.parametrize('transform', ['mean_adjusted', 'log', 'zscore'])
+def test_derived_volume_changes_are_zero_where_there_is_no_change(transform):
+    volumes = _volumes()
+    panel = make_panel(num_stocks=3, num_days=120)
+    panel.fields['volume'] = volumes.values
+    expected = _brute_force(volumes, transform, 5).fillna(0)
+
+    result = DerivedSeries(panel).volume_changes(transform, 5)
+
+    assert not result[:4].any()
+    np.testing.assert_allclose(result, expected.values, rtol=1e-9, atol=1e-6)